@@ -51,18 +51,22 @@ LOG.info("checking for config files at: %s", CFG_PATHS)
 
 LOG.info("found config files: %s", CONFIG.read(CFG_PATHS))
 
-if sys.version_info.major == 2:
-    from io import BytesIO as Memfile
-else:
-    from io import StringIO as Memfile
-
-from ctree.util import highlight
 
-CONFIGFILE = Memfile()
-CONFIG.write(CONFIGFILE)
-CONFIG_TXT = CONFIGFILE.getvalue()
-LOG.info("using configuration:\n%s", highlight(CONFIG_TXT, language='ini'))
-CONFIGFILE.close()
+def _config_text():
+    """Returns the configuration in use, serialized as an ini file."""
+    if sys.version_info.major == 2:
+        from io import BytesIO as Memfile
+    else:
+        from io import StringIO as Memfile
+    configfile = Memfile()
+    CONFIG.write(configfile)
+    return configfile.getvalue()
+
+
+if LOG.isEnabledFor(logging.INFO):
+    from ctree.util import highlight
+    LOG.info("using configuration:\n%s",
+             highlight(_config_text(), language='ini'))
 if CONFIG.has_option('log','level'):
     logging.basicConfig(level=getattr(logging,CONFIG.get('log','level')))
 
@@ -122,22 +126,92 @@ if not CONFIG.getboolean('jit', 'CACHE'):
 _TYPE_CODEGENERATORS = {}
 _TYPE_RECOGNIZERS = {}
 
-OCL_ENABLED = True
-try:
-    import pycl
-except ImportError:
-    OCL_ENABLED = False
 
-import ctree.np
+def _import_pycl():
+    """Returns whether pycl, and so OpenCL support, can be imported."""
+    try:
+        import pycl
+    except ImportError:
+        return False
+    return True
+
+
+class _LazyValue(object):
+    """
+    Stands in for the module attribute 'name' until it is first used, then
+    computes it with 'compute' and puts the result in its place (python 2
+    and 3.4 have no module __getattr__). Code that kept the stand-in keeps
+    working, as it forwards everything to the value.
+    """
+
+    def __init__(self, name, compute):
+        self._name = name
+        self._compute = compute
+
+    def get(self):
+        """Returns the value, computing it on first use."""
+        if '_value' not in self.__dict__:
+            self.__dict__['_value'] = self._compute()
+            if globals().get(self._name) is self:
+                globals()[self._name] = self._value
+        return self.__dict__['_value']
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __bool__(self):
+        return bool(self.get())
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return str(self.get())
+
+    def __repr__(self):
+        return repr(self.get())
+
+    def __eq__(self, other):
+        return self.get() == other
+
+    def __ne__(self, other):
+        return self.get() != other
+
+    def __hash__(self):
+        return hash(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __contains__(self, item):
+        return item in self.get()
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __add__(self, other):
+        return self.get() + other
+
+    def __radd__(self, other):
+        return other + self.get()
+
+
+# Optional parts load on first use: OpenCL support (pycl) when OpenCL code
+# is built, numpy support (ctree.np) when ctree.types first meets a numpy
+# object, and pygments and the visualization modules when something is
+# highlighted or drawn. OCL_ENABLED tries to import pycl the first time it
+# is tested, and CONFIG_TXT serializes the configuration the first time it
+# is read.
+OCL_ENABLED = _LazyValue('OCL_ENABLED', _import_pycl)
 
-import ast
-import inspect
-import ctree.frontend
-from ctree.visual.dot_manager import DotManager
+CONFIG_TXT = _LazyValue('CONFIG_TXT', _config_text)
 
 
 def get_ast(func):
     """convenience method for displaying a callable objects ast"""
+    import ctree.frontend
     return ctree.frontend.get_ast(func)
 
 
@@ -148,6 +222,7 @@ def ipython_show_ast(tree):
     then renders that into a png file
     """
     import ctree.dotgen
+    from ctree.visual.dot_manager import DotManager
     return DotManager.dot_ast_to_image(tree)
 
 
@@ -158,4 +233,5 @@ def browser_show_ast(tree, file_name=None):
     then renders that into a png file
     """
     import ctree.dotgen
+    from ctree.visual.dot_manager import DotManager
     return DotManager.dot_ast_to_browser(tree, file_name)
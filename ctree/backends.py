@@ -0,0 +1,442 @@
+"""
+Compiler backends that turn generated C program text into callable code.
+
+The backend for each config target is chosen by the BACKEND option of its
+configuration section ([c], [omp], ...):
+
+  cc   runs the external compiler named by CC (gcc by default) and keeps
+       the resulting shared objects in the artifact store. Slow to start,
+       but produces the best code.
+  tcc  compiles in-process and in memory with libtcc (TinyCC). Compiles are
+       very cheap, so it suits autotuning sweeps and, via [jit]
+       FAST_BACKEND, tiered compilation.
+
+Code for hot program configurations is built with the HOT_CFLAGS of the
+config target in place of CFLAGS (see build_options()). With [jit]
+PRECOMPILED_HEADERS, cc precompiles the #includes that start each file.
+"""
+
+import os
+import shlex
+import ctypes
+import ctypes.util
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import ctree
+from ctree.store import get_store, compiler_identity
+
+log = logging.getLogger(__name__)
+
+
+def run_compiler(compile_cmd, program_text):
+    """
+    Runs compile_cmd (a list of arguments, no shell involved) with
+    program_text on its standard input.
+    """
+    compiler = subprocess.Popen(compile_cmd, stdin=subprocess.PIPE)
+    compiler.communicate(program_text.encode())
+    if compiler.returncode:
+        raise subprocess.CalledProcessError(compiler.returncode, compile_cmd)
+
+
+def _read_source(source_file):
+    """
+    Returns the source saved for a file found in the persistent cache, or
+    raises NotImplementedError if it was not saved ([jit] SAVE_SOURCE).
+    """
+    if not os.path.exists(source_file):
+        raise NotImplementedError('No Cached version found')
+    with open(source_file) as src:
+        return src.read()
+
+
+class Backend(object):
+    """Base class for compiler backends."""
+
+    # whether the backend can compile files to objects and link those
+    # into a single submodule (see Project.codegen)
+    links_objects = False
+
+    def compile(self, cfile, program_text, program_hash):
+        """
+        Compiles the program of 'cfile' and returns a submodule for
+        JitModule._link_in. program_text is None if the program must be
+        read back from the source file saved by a previous run.
+        """
+        raise NotImplementedError()
+
+    def compile_object(self, cfile, program_text, program_hash):
+        """
+        Like compile(), but returns an object to be passed to link().
+        """
+        raise NotImplementedError()
+
+    def link(self, cfiles, objects):
+        """
+        Links the objects compiled from 'cfiles' into one submodule for
+        JitModule._link_in.
+        """
+        raise NotImplementedError()
+
+
+def _lto_flags():
+    return ["-flto"] if ctree.CONFIG.getboolean('jit', 'LTO') else []
+
+
+class CcBackend(Backend):
+    """Compiles with the external compiler [<target>] CC."""
+
+    links_objects = True
+
+    def __init__(self):
+        self._failed_headers = set()  # keys of headers gcc can't precompile
+
+    def _build(self, key, ext, compile_cmd, read_program=None):
+        """
+        Returns the artifact for 'key' from the store, running compile_cmd
+        (with @OUTPUT@ standing for the output file) to build it on a miss.
+        compile_cmd may also be a function returning the command, for
+        commands that take work to put together. read_program returns the
+        text to pipe to the compiler, if any.
+        """
+        store = get_store()
+        artifact = store.get(key, ext)
+        if artifact is not None:
+            log.debug("Found %s in artifact store: %s", ext, artifact)
+            return artifact
+
+        log.debug('Regenerating %s.', ext)
+        if callable(compile_cmd):
+            compile_cmd = compile_cmd()
+        tmp_file = store.temp_path(ext)
+        compile_cmd = [tmp_file if arg == '@OUTPUT@' else arg
+                       for arg in compile_cmd]
+        log.info("compilation command: %s", " ".join(compile_cmd))
+        try:
+            run_compiler(compile_cmd, read_program() if read_program else "")
+        except subprocess.CalledProcessError:
+            if os.path.exists(tmp_file):  # the linker removes it on errors
+                os.remove(tmp_file)
+            raise
+        return store.put(key, tmp_file, ext)
+
+    def _compile(self, cfile, program_text, program_hash, ext, mode_flags):
+        config_target = cfile.config_target
+        CC = ctree.CONFIG.get(config_target, 'CC')
+        CFLAGS = get_cflags(config_target)
+        LDFLAGS = ctree.CONFIG.get(config_target, 'LDFLAGS')
+        if ext == ".o":
+            LDFLAGS = ""  # applied when linking
+        key = get_store().key(program_hash, compiler_identity(CC), CC, CFLAGS,
+                              LDFLAGS, *mode_flags)
+
+        def read_program():
+            if program_text is None:
+                return _read_source(
+                    os.path.join(cfile.path, cfile.get_filename()))
+            return program_text
+
+        def compile_cmd():
+            cmd = shlex.split(CC) + mode_flags + shlex.split(CFLAGS)
+            header = self._precompiled_header(cfile, CC, CFLAGS)
+            if header is not None:
+                # gcc silently compiles without a header it can't use
+                cmd += ["-Winvalid-pch", "-include", header]
+            return cmd + ["-o", "@OUTPUT@", "-x", "c", "-", "-x", "none"] + \
+                shlex.split(LDFLAGS)
+
+        return self._build(key, ext, compile_cmd, read_program)
+
+    def _precompiled_header(self, cfile, CC, CFLAGS):
+        """
+        Returns the path of a header holding the #includes that start
+        cfile, precompiled next to it (as gcc's <header>.gch) for CC and
+        CFLAGS, or None if there is nothing to precompile. Both are stored
+        under one key, so the store evicts them together. The program
+        still includes the headers itself; their include guards make that
+        free once the precompiled header is loaded.
+        """
+        if not ctree.CONFIG.getboolean('jit', 'PRECOMPILED_HEADERS'):
+            return None
+        includes = cfile._leading_includes()
+        if not includes:
+            return None
+        store = get_store()
+        key = store.key("precompiled header", includes, compiler_identity(CC),
+                        CC, CFLAGS)
+        if key in self._failed_headers:
+            return None
+        header = store.get(key, ".h")
+        if header is None:
+            tmp_header = store.temp_path(".h")
+            with open(tmp_header, 'w') as header_file:
+                header_file.write(includes)
+            header = store.put(key, tmp_header, ".h")
+        try:
+            self._build(key, ".h.gch", shlex.split(CC) + ["-x", "c-header"] +
+                        shlex.split(CFLAGS) + ["-o", "@OUTPUT@", header])
+        except subprocess.CalledProcessError:
+            log.warning("could not precompile %s, compiling without it",
+                        " ".join(includes.split()))
+            self._failed_headers.add(key)
+            return None
+        return header
+
+    def compile(self, cfile, program_text, program_hash):
+        return self._compile(cfile, program_text, program_hash, ".so",
+                             ["-shared"])
+
+    def compile_object(self, cfile, program_text, program_hash):
+        return self._compile(cfile, program_text, program_hash, ".o",
+                             ["-c"] + _lto_flags())
+
+    def link(self, cfiles, objects):
+        # the compiler and flags of the first file's config target drive
+        # the link, plus the flags of every other target involved (e.g.
+        # -fopenmp), since each file would have been linked with them
+        config_targets = []
+        for cfile in cfiles:
+            if cfile.config_target not in config_targets:
+                config_targets.append(cfile.config_target)
+        CC = ctree.CONFIG.get(config_targets[0], 'CC')
+        cflags, ldflags = [], []
+        for config_target in config_targets:
+            cflags += shlex.split(get_cflags(config_target))
+            ldflags += shlex.split(ctree.CONFIG.get(config_target, 'LDFLAGS'))
+        link_cmd = shlex.split(CC) + ["-shared"] + _lto_flags() + cflags + \
+            ["-o", "@OUTPUT@"] + list(objects) + ldflags
+        key = get_store().key(compiler_identity(CC), *link_cmd)
+        return self._build(key, ".so", link_cmd)
+
+
+# constants from libtcc.h
+TCC_OUTPUT_MEMORY = 1
+TCC_RELOCATE_AUTO = ctypes.c_void_p(1)
+
+_TCC_ERROR_FUNC = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_char_p)
+
+# libtcc keeps global state and is not reentrant; held around every call
+# into it (Project compiles files and builds run in pool threads); reentrant
+# since collecting a TccModule during a compile deletes its state
+_TCC_LOCK = threading.RLock()
+
+
+def load_libtcc():
+    """Returns libtcc loaded with ctypes, or None if it is not installed."""
+    name = ctypes.util.find_library('tcc') or 'libtcc.so'
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError:
+        return None
+    lib.tcc_new.restype = ctypes.c_void_p
+    lib.tcc_delete.argtypes = [ctypes.c_void_p]
+    lib.tcc_set_error_func.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+                                       _TCC_ERROR_FUNC]
+    lib.tcc_set_options.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.tcc_add_library_path.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.tcc_add_library.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.tcc_set_output_type.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.tcc_compile_string.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    # newer libtcc's tcc_relocate takes no second argument; passing
+    # TCC_RELOCATE_AUTO anyway is harmless under the C calling convention
+    lib.tcc_relocate.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.tcc_get_symbol.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.tcc_get_symbol.restype = ctypes.c_void_p
+    return lib
+
+
+class TccModule(object):
+    """
+    Code compiled into memory by libtcc. The code stays mapped for as long
+    as this object is alive.
+    """
+
+    def __init__(self, lib, state):
+        self._lib = lib
+        self._state = state
+
+    def get_callable(self, entry_point_name, entry_point_typesig):
+        with _TCC_LOCK:
+            address = self._lib.tcc_get_symbol(self._state,
+                                               entry_point_name.encode())
+        if not address:
+            raise AttributeError("undefined symbol: %s" % entry_point_name)
+        function = entry_point_typesig(address)
+        # the code is freed along with this module
+        function._module = self
+        return function
+
+    def __del__(self):
+        if self._state:
+            with _TCC_LOCK:
+                self._lib.tcc_delete(self._state)
+            self._state = None
+
+
+class TccBackend(Backend):
+    """Compiles in-process with libtcc."""
+
+    # flags from CFLAGS/LDFLAGS that tcc understands
+    _passed_flags = ('-I', '-D', '-U')
+
+    def __init__(self):
+        self._lib = None
+
+    @property
+    def lib(self):
+        if self._lib is None:
+            self._lib = load_libtcc()
+            if self._lib is None:
+                raise RuntimeError("libtcc not found; install TinyCC to use "
+                                   "the tcc backend.")
+        return self._lib
+
+    def compile(self, cfile, program_text, program_hash):
+        lib = self.lib
+        if program_text is None:
+            program_text = _read_source(
+                os.path.join(cfile.path, cfile.get_filename()))
+        config_target = cfile.config_target
+        cflags = shlex.split(get_cflags(config_target))
+        ldflags = shlex.split(ctree.CONFIG.get(config_target, 'LDFLAGS'))
+
+        errors = []
+        error_func = _TCC_ERROR_FUNC(
+            lambda opaque, msg: errors.append(msg.decode(errors='replace')))
+        options = [flag for flag in cflags
+                   if flag.startswith(self._passed_flags)]
+        log.info("compiling %s in-process with libtcc", cfile.get_filename())
+        with _TCC_LOCK:
+            state = lib.tcc_new()
+            module = TccModule(lib, state)
+            module._error_func = error_func  # keep the callback alive
+            lib.tcc_set_error_func(state, None, error_func)
+            if options:
+                lib.tcc_set_options(state, " ".join(options).encode())
+            lib.tcc_set_output_type(state, TCC_OUTPUT_MEMORY)
+            for flag in ldflags:
+                if flag.startswith('-L'):
+                    lib.tcc_add_library_path(state, flag[2:].encode())
+                elif flag.startswith('-l'):
+                    lib.tcc_add_library(state, flag[2:].encode())
+            failed = lib.tcc_compile_string(
+                state, program_text.encode()) == -1 or \
+                lib.tcc_relocate(state, TCC_RELOCATE_AUTO) < 0
+        if failed:
+            raise RuntimeError("libtcc failed to compile %s:\n%s" %
+                               (cfile.get_filename(), "\n".join(errors)))
+        return module
+
+
+BACKENDS = {
+    'cc': CcBackend(),
+    'tcc': TccBackend(),
+}
+
+_overrides = threading.local()
+
+
+@contextmanager
+def build_options(backend=None, hot=None):
+    """
+    Overrides how everything in the current thread is compiled for the
+    duration of the block: 'backend' forces a backend regardless of
+    configuration, and 'hot' selects the HOT_CFLAGS of each config target
+    instead of CFLAGS. Options left as None keep their current value.
+    """
+    previous = current_build_options()
+    if backend is not None:
+        _overrides.backend = backend
+    if hot is not None:
+        _overrides.hot = hot
+    try:
+        yield
+    finally:
+        _overrides.backend = previous['backend']
+        _overrides.hot = previous['hot']
+
+
+def current_build_options():
+    """Returns the options set by build_options() in the current thread."""
+    return {'backend': getattr(_overrides, 'backend', None),
+            'hot': getattr(_overrides, 'hot', None)}
+
+
+def use_backend(name):
+    """Compiles everything in the current thread with backend 'name'."""
+    return build_options(backend=name)
+
+
+def get_cflags(config_target):
+    """
+    Returns the compiler flags for config_target, which are its HOT_CFLAGS
+    when building hot code.
+    """
+    if getattr(_overrides, 'hot', None) and \
+            ctree.CONFIG.has_option(config_target, 'HOT_CFLAGS'):
+        return ctree.CONFIG.get(config_target, 'HOT_CFLAGS')
+    return ctree.CONFIG.get(config_target, 'CFLAGS')
+
+
+def get_backend_name(config_target):
+    """Returns the name of the backend that compiles for config_target."""
+    name = getattr(_overrides, 'backend', None)
+    if name is None:
+        if ctree.CONFIG.has_option(config_target, 'BACKEND'):
+            name = ctree.CONFIG.get(config_target, 'BACKEND')
+        else:
+            name = 'cc'
+    return name
+
+
+def get_backend(config_target):
+    """Returns the backend that compiles files for config_target."""
+    name = get_backend_name(config_target)
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown compiler backend '%s' for config target "
+                         "'%s'." % (name, config_target))
+
+
+def build_info(cfile, program_text, program_hash):
+    """
+    Returns a dict describing how the program of cfile is built: its
+    source and hash, and the backend, compiler and flags in effect.
+    """
+    config_target = cfile.config_target
+    return {
+        'file': cfile.get_filename(),
+        'config_target': config_target,
+        'backend': get_backend_name(config_target),
+        'hot': bool(getattr(_overrides, 'hot', None)),
+        'CC': ctree.CONFIG.get(config_target, 'CC'),
+        'CFLAGS': get_cflags(config_target),
+        'LDFLAGS': ctree.CONFIG.get(config_target, 'LDFLAGS'),
+        'LTO': ctree.CONFIG.getboolean('jit', 'LTO'),
+        'program_hash': program_hash,
+        'source': program_text,
+    }
+
+
+def dump_build_info(cfile, program_text, program_hash):
+    """
+    Writes build_info() for cfile as JSON into [log] DUMP_PATH, if that is
+    set, and returns the path written (or None).
+    """
+    dump_path = ctree.CONFIG.get('log', 'DUMP_PATH')
+    if not dump_path:
+        return None
+    import json
+    if not os.path.isdir(dump_path):
+        os.makedirs(dump_path)
+    path = os.path.join(dump_path, "%s-%s.json" % (cfile.get_filename(),
+                                                   program_hash[:16]))
+    with open(path, 'w') as dump_file:
+        json.dump(build_info(cfile, program_text, program_hash), dump_file,
+                  indent=2, sort_keys=True)
+    log.debug("wrote build information to %s", path)
+    return path
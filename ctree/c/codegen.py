@@ -40,10 +40,10 @@ class CCodeGen(CommonCodeGen):
     # visitor methods
 
     def visit_MultiNode(self, node):
-        return self._genblock(node.body, insert_curly_brackets=False, increase_indent=False)
+        self._writeblock(node.body, insert_curly_brackets=False, increase_indent=False)
 
     def visit_FunctionDecl(self, node):
-        params = ", ".join(map(str, node.params))
+        params = ", ".join(map(self._gen, node.params))
         s = ""
         if node.kernel:
             s += "__kernel "
@@ -51,10 +51,12 @@ class CCodeGen(CommonCodeGen):
             s += "static "
         if node.inline:
             s += "inline "
-        s += "%s %s(%s)" % (codegen_type(node.return_type), node.name, params)
+        s += "%s %s(%s)" % (codegen_type(node.return_type), self._gen(node.name),
+                             params)
+        self._out.append(s)
         if node.defn:
-            s += " %s" % self._genblock(node.defn)
-        return s
+            self._out.append(" ")
+            self._writeblock(node.defn)
 
     def visit_UnaryOp(self, node):
         op  = self._parenthesize(node, node.op)
@@ -73,7 +75,8 @@ class CCodeGen(CommonCodeGen):
             return "%s %s %s" % (left, node.op, right)
 
     def visit_AugAssign(self, node):
-        return "%s %s= %s" % (node.target, node.op, node.value)
+        return "%s %s= %s" % (self._gen(node.target), node.op,
+                               self._gen(node.value))
 
     def visit_TernaryOp(self, node):
         cond = self._parenthesize(node, node.cond)
@@ -103,53 +106,56 @@ class CCodeGen(CommonCodeGen):
             s += "const "
         if node.type is not None:
             s += "%s " % codegen_type(node.type)
-        return "%s%s" % (s, node.name)
+        return "%s%s" % (s, self._gen(node.name))
 
     def visit_Block(self, node):
-        return self._genblock(node.body)
+        self._writeblock(node.body)
 
     def visit_Return(self, node):
         if node.value:
-            return "return %s" % node.value
+            return "return %s" % self._gen(node.value)
         else:
             return "return"
 
     def visit_If(self, node):
-        then = self._genblock(node.then)
+        self._out.append("if (%s) " % self._gen(node.cond))
+        self._writeblock(node.then)
         if node.elze:
-            elze = self._genblock(node.elze)
-            return "if (%s) %s else %s" % (node.cond, then, elze)
-        else:
-            return "if (%s) %s" % (node.cond, then)
+            self._out.append(" else ")
+            self._writeblock(node.elze)
 
     def visit_While(self, node):
-        body = self._genblock(node.body)
-        return "while (%s) %s" % (node.cond, body)
+        self._out.append("while (%s) " % self._gen(node.cond))
+        self._writeblock(node.body)
 
     def visit_DoWhile(self, node):
-        body = self._genblock(node.body)
-        return "do %s while (%s)" % (body, node.cond)
+        self._out.append("do ")
+        self._writeblock(node.body)
+        self._out.append(" while (%s)" % self._gen(node.cond))
 
     def visit_For(self, node):
-        body = self._genblock(node.body)
         s = ""
         if node.pragma:
             s += "#pragma %s\n" % node.pragma + self._tab()
-        return s + "for (%s; %s; %s) %s" % (node.init, node.test, node.incr, body)
+        self._out.append(s + "for (%s; %s; %s) " % (
+            self._gen(node.init), self._gen(node.test), self._gen(node.incr)))
+        self._writeblock(node.body)
 
     def visit_FunctionCall(self, node):
-        args = ", ".join(map(str, node.args))
-        return "%s(%s)" % (node.func, args)
+        args = ", ".join(map(self._gen, node.args))
+        return "%s(%s)" % (self._gen(node.func), args)
 
     def visit_String(self, node):
         return '"%s"' % '" "'.join(node.values)
 
     def visit_CFile(self, node):
-        stmts = self._genblock(node.body, insert_curly_brackets=False, increase_indent=False)
-        return '// <file: %s>%s' % (node.get_filename(), stmts)
+        self._out.append('// <file: %s>' % node.get_filename())
+        self._writeblock(node.body, insert_curly_brackets=False,
+                         increase_indent=False, memoize=True)
 
     def visit_ArrayDef(self, node):
-        return "%s[%s] = " % (node.target, node.size) + self.visit(node.body)
+        return "%s[%s] = " % (self._gen(node.target), self._gen(node.size)) + \
+            self._gen(node.body)
 
     def visit_Break(self, node):
         return 'break'
@@ -158,7 +164,7 @@ class CCodeGen(CommonCodeGen):
         return 'continue'
 
     def visit_Array(self, node):
-        return "{%s}" % ', '.join([i.codegen() for i in node.body])
+        return "{%s}" % ', '.join(map(self._gen, node.body))
 
     def visit_Hex(self, node):
         return hex(node.value)
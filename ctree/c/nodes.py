@@ -4,7 +4,6 @@ AST nodes for C constructs.
 
 import os
 import types
-import subprocess
 
 import logging
 
@@ -15,6 +14,7 @@ from ctree.nodes import CtreeNode, File
 import ctree
 from ctree.util import singleton, highlight, truncate
 from ctree.types import get_ctype, get_common_ctype
+from ctree.backends import get_backend, dump_build_info
 import hashlib
 import ctypes
 
@@ -22,11 +22,7 @@ import ctypes
 class CNode(CtreeNode):
     """Base class for all C nodes in ctree."""
 
-    def codegen(self, indent=0):
-        from ctree.c.codegen import CCodeGen
-        from ctree.transforms import DeclarationFiller
-
-        return CCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.c.codegen.CCodeGen"
 
     def label(self):
         from ctree.c.dotgen import CDotGenLabeller
@@ -90,67 +86,81 @@ class CFile(CNode, File):
     def get_so_filename(self):
         return "{}.so".format(self.name)
 
-    def _compile(self, program_text):
-        # print(repr(self.path), repr(self.get_filename()))
+    def _program(self, program_text):
+        """
+        Returns (program_text, program_hash) for compiling this file. The
+        program is only written to disk if [jit] SAVE_SOURCE is set. An
+        empty program refers to the program of a previous run, known by
+        its hash (see LazySpecializedFunction.get_transform_result), and
+        comes back as None; backends look it up in the artifact store by
+        its hash, and fall back on its saved source.
+        """
         c_src_file = os.path.join(self.path, self.get_filename())
-        so_file = os.path.join(self.path, self.get_so_filename())
-        program_hash = hashlib.sha512(program_text.strip().encode()).hexdigest()
-        so_file_exists = os.path.exists(so_file)
-        old_hash = self.program_hash
-        hash_match = old_hash == program_hash
-        log.debug("Old hash: %s \n New hash: %s", old_hash, program_hash)
-        recreate_c_src = program_text and program_text != self.empty and not hash_match
-        recreate_so = recreate_c_src or not so_file_exists
-
-        log.debug("RECREATE_C_SRC: %s \t RECREATE_so: %s \t HASH_MATCH: %s",
-                 recreate_c_src, recreate_so, hash_match)
-
-        if not program_text:
+        if program_text and program_text != self.empty:
+            program_hash = hashlib.sha512(program_text.strip().encode()).hexdigest()
+            if ctree.CONFIG.getboolean('jit', 'SAVE_SOURCE'):
+                old_hash = self.program_hash
+                log.debug("Old hash: %s \n New hash: %s", old_hash, program_hash)
+                if old_hash != program_hash:
+                    with open(c_src_file, 'w') as c_file:
+                        c_file.write(program_text)
+                    log.info("file for generated C: %s", c_src_file)
+                    self.program_hash = program_hash
+            else:
+                # recorded in the persistent cache's info.json
+                self._program_hash = program_hash
+            # syntax-highlight and print C program, only if anyone listens
+            if log.isEnabledFor(logging.INFO):
+                log.info("generated C program: (((\n%s\n)))",
+                         highlight(program_text, 'c'))
+            dump_build_info(self, program_text, program_hash)
+        else:
             log.debug("Program not found. Attempting to use cached version")
+            program_hash = self.program_hash
+            if not program_hash:
+                raise NotImplementedError('No Cached version found')
+            program_text = None
+        return program_text, program_hash
 
-        #create c_src
-        if recreate_c_src:
-            with open(c_src_file, 'w') as c_file:
-                c_file.write(program_text)
-            log.info("file for generated C: %s", c_src_file)
-            # syntax-highlight and print C program
-            highlighted = highlight(program_text, 'c')
-            log.info("generated C program: (((\n%s\n)))", highlighted)
-            self.program_hash = program_hash
-
-
-        #create ll_bc_file
-        if recreate_so:
-            # call clang to generate LLVM bitcode file
-            log.debug('Regenerating so.')
-            CC = ctree.CONFIG.get(self.config_target, 'CC')
-            CFLAGS = ctree.CONFIG.get(self.config_target, 'CFLAGS')
-            LDFLAGS = ctree.CONFIG.get(self.config_target, 'LDFLAGS')
-            compile_cmd = "%s -shared %s -o %s %s %s" % (CC, CFLAGS, so_file,
-                    c_src_file, LDFLAGS)
-            log.info("compilation command: %s", compile_cmd)
-            subprocess.check_call(compile_cmd, shell=True)
-            # log.info("file for generated so: %s", so_file)
-
-        #use cached version otherwise
-        if not (so_file_exists or recreate_so):
-            raise NotImplementedError('No Cached version found')
-
-
-        # load llvm bitcode
-        # import llvm.core
-        # import llvmlite.binding as llvm
-
-        # with open(ll_bc_file, 'rb') as bc:
-        #     ll_module = llvm.module.parse_bitcode(bc.read())
-
-        # syntax-highlight and print LLVM program
-        #preserve_src_drhighlighted = highlight(str(ll_module), 'llvm')
-        #log.debug("generated LLVM Program: (((\n%s\n)))", highlighted)
+    def _compile(self, program_text):
+        """
+        Compiles program_text with the backend configured for this file's
+        config_target (see ctree.backends) and returns the submodule.
+        """
+        program_text, program_hash = self._program(program_text)
+        return get_backend(self.config_target).compile(
+            self, program_text, program_hash)
 
-        return so_file
+    def _links_objects(self):
+        return get_backend(self.config_target).links_objects
 
+    def _leading_includes(self):
+        """
+        Returns the #include <...> lines at the start of this file, which
+        backends may precompile, as one string ('' if there are none).
+        """
+        from ctree.cpp.nodes import CppInclude
+        lines = []
+        for stmt in self.body:
+            # quoted includes are looked up relative to the source file,
+            # so they would resolve differently from a separate header
+            if not isinstance(stmt, CppInclude) or not stmt.angled_brackets:
+                break
+            lines.append(stmt.codegen() + "\n")
+        return "".join(lines)
+
+    def _compile_object(self, program_text):
+        """
+        Compiles program_text to an object for linking together with the
+        other files of a Project.
+        """
+        program_text, program_hash = self._program(program_text)
+        return get_backend(self.config_target).compile_object(
+            self, program_text, program_hash)
 
+    def _link(self, cfiles, objects):
+        """Links objects compiled from cfiles (this file first)."""
+        return get_backend(self.config_target).link(cfiles, objects)
 
 
 class Statement(CNode):
@@ -164,6 +174,7 @@ class Expression(CNode):
 
 class Return(Statement):
     """Section B.2.3 6.6.6 line 4."""
+    __slots__ = ('value',)
     _fields = ['value']
 
     def __init__(self, value=None):
@@ -173,6 +184,7 @@ class Return(Statement):
 
 class If(Statement):
     """Cite me."""
+    __slots__ = ('cond', 'then', 'elze')
     _fields = ['cond', 'then', 'elze']
 
     def __init__(self, cond=None, then=None, elze=None):
@@ -184,6 +196,7 @@ class If(Statement):
 
 class While(Statement):
     """Cite me."""
+    __slots__ = ('cond', 'body')
     _fields = ['cond', 'body']
     _requires_semicolon = lambda self: False
 
@@ -194,6 +207,7 @@ class While(Statement):
 
 
 class DoWhile(Statement):
+    __slots__ = ('body', 'cond')
     _fields = ['body', 'cond']
 
     def __init__(self, body=None, cond=None):
@@ -203,6 +217,7 @@ class DoWhile(Statement):
 
 
 class For(Statement):
+    __slots__ = ('init', 'test', 'incr', 'body', 'pragma')
     _fields = ['init', 'test', 'incr', 'body']
 
     def __init__(self, init=None, test=None, incr=None, body=None, pragma=None):
@@ -222,6 +237,7 @@ class For(Statement):
 
 class FunctionCall(Expression):
     """Cite me."""
+    __slots__ = ('func', 'args')
     _fields = ['func', 'args']
 
     def __init__(self, func=None, args=None):
@@ -237,6 +253,7 @@ class Literal(Expression):
 
 class Constant(Literal):
     """Section B.1.4 6.1.3."""
+    __slots__ = ('value',)
     _fields = ['value']
 
     def __init__(self, value=None):
@@ -252,6 +269,7 @@ class Hex(Constant):
 
 class Block(Statement):
     """Cite me."""
+    __slots__ = ('body',)
     _fields = ['body']
 
     def __init__(self, body=None):
@@ -271,6 +289,7 @@ class MultiNode(Block):
 
 class String(Literal):
     """Cite me."""
+    __slots__ = ('values',)
 
     def __init__(self, *values):
         self.values = values
@@ -279,6 +298,7 @@ class String(Literal):
 
 class SymbolRef(Literal):
     """Cite me."""
+    __slots__ = ('name', 'type', '_global', '_local', '_const', '_static')
     _next_id = 0
     _fields = ['name','type']
 
@@ -333,6 +353,8 @@ class SymbolRef(Literal):
 
 class FunctionDecl(Statement):
     """Cite me."""
+    __slots__ = ('return_type', 'name', 'params', 'defn', 'inline', 'static',
+                 'kernel')
     _fields = ['params', 'defn']
 
     def __init__(self, return_type=None, name=None, params=None, defn=None):
@@ -381,6 +403,7 @@ class FunctionDecl(Statement):
 
 class UnaryOp(Expression):
     """Cite me."""
+    __slots__ = ('op', 'arg')
     _fields = ['arg']
 
     def __init__(self, op=None, arg=None):
@@ -391,6 +414,7 @@ class UnaryOp(Expression):
 
 class BinaryOp(Expression):
     """Cite me."""
+    __slots__ = ('left', 'op', 'right')
     _fields = ['left', 'op', 'right']
 
     def __init__(self, left=None, op=None, right=None):
@@ -425,6 +449,7 @@ class BinaryOp(Expression):
 
 class AugAssign(Expression):
     """Cite me."""
+    __slots__ = ('target', 'op', 'value')
     _fields = ['target', 'value']
 
     def __init__(self, target=None, op=None, value=None):
@@ -436,6 +461,7 @@ class AugAssign(Expression):
 
 class TernaryOp(Expression):
     """Cite me."""
+    __slots__ = ('cond', 'then', 'elze')
     _fields = ['cond', 'then', 'elze']
 
     def __init__(self, cond=None, then=None, elze=None):
@@ -447,6 +473,7 @@ class TernaryOp(Expression):
 
 class Cast(Expression):
     """doc"""
+    __slots__ = ('type', 'value')
     _fields = ['value']
 
     def __init__(self, sym_type=None, value=None):
@@ -457,6 +484,7 @@ class Cast(Expression):
 
 class ArrayDef(Expression):
     """doc"""
+    __slots__ = ('target', 'size', 'body')
     _fields = ['target', 'size', 'body']
 
     def __init__(self, target=None, size=None, body=None):
@@ -466,6 +494,7 @@ class ArrayDef(Expression):
         super(ArrayDef, self).__init__()
 
 class Array(Expression):
+    __slots__ = ('type', 'size', 'body')
     _fields = ['type', 'size', 'body']
 
     def __init__(self, type=None, size = None, body = None):
@@ -490,6 +519,8 @@ class Pass(Statement):
 @singleton
 class Op:
     class _Op(object):
+        __slots__ = ('_force_parentheses',)
+
         def __init__(self):
             self._force_parentheses = False
 
@@ -497,105 +528,139 @@ class Op:
             return self._c_str
 
     class PreInc(_Op):
+        __slots__ = ()
         _c_str = "++"
 
     class PreDec(_Op):
+        __slots__ = ()
         _c_str = "--"
 
     class PostInc(_Op):
+        __slots__ = ()
         _c_str = "++"
 
     class PostDec(_Op):
+        __slots__ = ()
         _c_str = "--"
 
     class Ref(_Op):
+        __slots__ = ()
         _c_str = "&"
 
     class Deref(_Op):
+        __slots__ = ()
         _c_str = "*"
 
     class SizeOf(_Op):
+        __slots__ = ()
         _c_str = "sizeof"
 
     class Add(_Op):
+        __slots__ = ()
         _c_str = "+"
 
     class AddUnary(_Op):
+        __slots__ = ()
         _c_str = "+"
 
     class Sub(_Op):
+        __slots__ = ()
         _c_str = "-"
 
     class SubUnary(_Op):
+        __slots__ = ()
         _c_str = "-"
 
     class Mul(_Op):
+        __slots__ = ()
         _c_str = "*"
 
     class Div(_Op):
+        __slots__ = ()
         _c_str = "/"
 
     class Mod(_Op):
+        __slots__ = ()
         _c_str = "%"
 
     class Gt(_Op):
+        __slots__ = ()
         _c_str = ">"
 
     class Lt(_Op):
+        __slots__ = ()
         _c_str = "<"
 
     class GtE(_Op):
+        __slots__ = ()
         _c_str = ">="
 
     class LtE(_Op):
+        __slots__ = ()
         _c_str = "<="
 
     class Eq(_Op):
+        __slots__ = ()
         _c_str = "=="
 
     class NotEq(_Op):
+        __slots__ = ()
         _c_str = "!="
 
     class BitAnd(_Op):
+        __slots__ = ()
         _c_str = "&"
 
     class BitOr(_Op):
+        __slots__ = ()
         _c_str = "|"
 
     class BitNot(_Op):
+        __slots__ = ()
         _c_str = "~"
 
     class BitShL(_Op):
+        __slots__ = ()
         _c_str = "<<"
 
     class BitShR(_Op):
+        __slots__ = ()
         _c_str = ">>"
 
     class BitXor(_Op):
+        __slots__ = ()
         _c_str = "^"
 
     class And(_Op):
+        __slots__ = ()
         _c_str = "&&"
 
     class Or(_Op):
+        __slots__ = ()
         _c_str = "||"
 
     class Not(_Op):
+        __slots__ = ()
         _c_str = "!"
 
     class Comma(_Op):
+        __slots__ = ()
         _c_str = ","
 
     class Dot(_Op):
+        __slots__ = ()
         _c_str = "."
 
     class Arrow(_Op):
+        __slots__ = ()
         _c_str = "->"
 
     class Assign(_Op):
+        __slots__ = ()
         _c_str = "="
 
     class ArrayRef(_Op):
+        __slots__ = ()
         _c_str = "[]"
 
 
@@ -8,10 +8,7 @@ from ctree.nodes import CtreeNode
 class CilkNode(CtreeNode):
     """Base class for all Cilk nodes supported by ctree."""
 
-    def codegen(self, indent=0):
-        from ctree.cilk.codegen import CilkCodeGen
-
-        return CilkCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.cilk.codegen.CilkCodeGen"
 
     def _to_dot(self, _):
         from ctree.cilk.dotgen import CilkDotLabeller
@@ -3,17 +3,284 @@ from __future__ import print_function
 """
 base class for generating code appropriate to the selected backend
 """
+import ast
+import collections
+import importlib
+import threading
+
 from ctree.visitors import NodeVisitor
-from ctree.util import flatten
+from ctree.util import flatten, _digest
+from ctree.types import registry_generation
+import ctree
+
+
+# -----------------------------------------------------------------------------
+# memo of rendered top-level declarations
+
+class _NotMemoizable(Exception):
+    pass
+
+
+def subtree_key(node):
+    """
+    Returns a digest of everything about the subtree under node that its
+    generated code depends on, or None if it holds values that cannot be
+    told apart structurally (foreign objects, deleted nodes, ...).
+    """
+    out = []
+    try:
+        _encode_subtree(node, out, set())
+    except _NotMemoizable:
+        return None
+    return _digest("".join(out).encode()).digest()
+
+
+# type -> its tag in subtree encodings
+_TYPE_TAGS = {}
+
+# node class -> (tag, names of its slots), or (tag, None) without slots
+_NODE_LAYOUTS = {}
+
+# other class -> (tag, whether its instances are ctypes scalars)
+_TOKEN_LAYOUTS = {}
+
+_SCALAR_TYPES = frozenset((type(None), bool, int, float, str, bytes))
+
+
+def _type_tag(cls):
+    tag = _TYPE_TAGS.get(cls)
+    if tag is None:
+        tag = "%s.%s.%s" % (cls.__module__,
+                            getattr(cls, '__qualname__', cls.__name__),
+                            cls.__name__)
+        _TYPE_TAGS[cls] = tag
+    return tag
+
+
+def _node_layout(cls):
+    layout = _NODE_LAYOUTS.get(cls)
+    if layout is None:
+        layout = (_type_tag(cls) + "(", cls._slot_names() or None)
+        _NODE_LAYOUTS[cls] = layout
+    return layout
+
+
+def _token_layout(cls):
+    layout = _TOKEN_LAYOUTS.get(cls)
+    if layout is None:
+        scalar = hasattr(cls, '_type_') and hasattr(cls, 'value')
+        layout = (_type_tag(cls) + ";", scalar)
+        _TOKEN_LAYOUTS[cls] = layout
+    return layout
+
+
+def _encode_subtree(value, out, open_nodes):
+    value_type = type(value)
+    if value_type in _SCALAR_TYPES:
+        # repr() tells these types apart
+        out.append(repr(value))
+    elif value_type is list or value_type is tuple:
+        out.append("[")
+        for item in value:
+            if type(item) in _SCALAR_TYPES:
+                out.append(repr(item))
+            else:
+                _encode_subtree(item, out, open_nodes)
+        out.append("]")
+    elif isinstance(value, ctree.nodes.CtreeNode):
+        # nodes may refer back to their ancestors (path references to
+        # the file they are in, ...)
+        if value.deleted or id(value) in open_nodes:
+            raise _NotMemoizable()
+        open_nodes.add(id(value))
+        tag, slots = _node_layout(value_type)
+        out.append(tag)
+        if slots is not None:
+            for name in slots:
+                child = getattr(value, name, None)
+                if type(child) in _SCALAR_TYPES:
+                    out.append(repr(child))
+                else:
+                    _encode_subtree(child, out, open_nodes)
+            out.append("|")
+        # slotted nodes may carry more attributes in their __dict__ too
+        attributes = getattr(value, '__dict__', None)
+        if attributes:
+            for name, child in sorted(attributes.items()):
+                # templates point their children back at themselves; node
+                # indexes are no part of the code
+                if name != 'parent' and name != '_node_index':
+                    out.append(name + "=")
+                    _encode_subtree(child, out, open_nodes)
+        out.append("!)" if value._force_parentheses else ")")
+        open_nodes.discard(id(value))
+    elif value_type is dict:
+        out.append("{")
+        for key, item in sorted(value.items()):
+            out.append(repr(key))
+            _encode_subtree(item, out, open_nodes)
+        out.append("}")
+    elif isinstance(value, ast.AST):
+        raise _NotMemoizable()
+    elif isinstance(value, type):
+        out.append("<%s>" % _type_tag(value))
+    elif hasattr(value, 'template') and hasattr(value, 'safe_substitute'):
+        out.append("template:%r;" % value.template)
+    else:
+        # ctypes instances, ops and other simple tokens are rendered by
+        # their type (and ctypes scalars by their value)
+        if getattr(value, '__dict__', None):
+            raise _NotMemoizable()
+        tag, scalar = _token_layout(value_type)
+        out.append(tag)
+        if scalar:
+            out.append(repr(value.value))
+        if getattr(value, '_force_parentheses', False):
+            out.append("!")
+
+
+class CodegenMemo(object):
+    """
+    A bounded, least-recently-used map from (subtree_key, indent, type
+    registry generation) to the code generated for such a subtree, shared
+    by all code generators.
+    """
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            text = self._entries.pop(key, None)
+            if text is not None:
+                # reinserted as the most recently used
+                self._entries[key] = text
+            return text
+
+    def put(self, key, text, max_count):
+        with self._lock:
+            self._entries[key] = text
+            while len(self._entries) > max_count:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+CODEGEN_MEMO = CodegenMemo()
+
+
+
+# node class -> (visitor class, visit method, whether the node class
+# overrides codegen(), or None if it is not a ctree node at all), shared
+# by all code generators
+_RULES = {}
+
+
+def _codegen_rule(node_class):
+    rule = _RULES.get(node_class)
+    if rule is None:
+        rule = _RULES[node_class] = _make_rule(node_class)
+    return rule
+
+
+def _make_rule(node_class):
+    if not issubclass(node_class, ctree.nodes.CtreeNode):
+        return None, None, None
+    path = node_class._codegen_visitor
+    overridden = node_class.codegen is not ctree.nodes.CtreeNode.codegen
+    if path is None:
+        return None, None, overridden
+    module_name, _, class_name = path.rpartition(".")
+    visitor_class = getattr(importlib.import_module(module_name), class_name)
+    method = getattr(visitor_class, "visit_" + node_class.__name__,
+                     visitor_class.generic_visit)
+    return visitor_class, method, overridden
 
 
 class CodeGenVisitor(NodeVisitor):
     """
     Return a string containing the program text.
+
+    Visitor methods either return the text for a node, or write it in
+    fragments to the shared list self._out and return None. Nodes with
+    large bodies (blocks, loops, functions, files) do the latter, so the
+    text of a file is built once at the end, and not re-concatenated at
+    every level of nesting.
+
+    Child nodes are generated with _gen() (expressions) or _writeblock()
+    (statements), which look up the visitor for their node family (the
+    class named by _codegen_visitor on the node class) and its visit
+    method in a table, and reuse one visitor of each family per output.
     """
 
-    def __init__(self, indent=0):
+    def __init__(self, indent=0, out=None, visitors=None):
         self._indent = indent
+        self._out = out if out is not None else []
+        # visitor class -> the visitor of that class writing to self._out
+        self._visitors = visitors if visitors is not None else {}
+        self._visitors.setdefault(type(self), self)
+
+    def _dispatch(self, node, indent):
+        """Writes the code for node to the output, at the given indent."""
+        visitor_class, method, _ = _RULES.get(type(node)) or \
+            _codegen_rule(type(node))
+        if visitor_class is None:
+            raise Exception("Node class %s should override codegen()" % type(node))
+        text = self._run(visitor_class, method, node, indent)
+        if text is not None:
+            self._out.append(text)
+
+    def _run(self, visitor_class, method, node, indent):
+        """
+        Applies the visit method of visitor_class to node. Returns its text,
+        or None if it was written to the output.
+        """
+        visitor = self._visitors.get(visitor_class)
+        if visitor is None:
+            visitor = visitor_class(indent, self._out, self._visitors)
+        saved_indent, visitor._indent = visitor._indent, indent
+        text = method(visitor, node)
+        visitor._indent = saved_indent
+        return text
+
+    def _write_node(self, node, indent):
+        """
+        Like _dispatch, but for a child node, which may also be deleted,
+        come from elsewhere, or generate its code itself.
+        """
+        visitor_class, method, overridden = _RULES.get(type(node)) or \
+            _codegen_rule(type(node))
+        if overridden is None:
+            self._out.append(str(node))
+        elif node.deleted:
+            return
+        elif overridden:
+            self._out.append(node.codegen(indent))
+        else:
+            text = self._run(visitor_class, method, node, indent)
+            if text is not None:
+                self._out.append(text)
+
+    def _gen(self, node):
+        """Returns the code for (child) node, like str(node) would."""
+        visitor_class, method, overridden = _RULES.get(type(node)) or \
+            _codegen_rule(type(node))
+        if overridden is None:
+            return str(node)
+        elif node.deleted:
+            return ""
+        elif overridden:
+            return node.codegen()
+        out = self._out
+        start = len(out)
+        text = self._run(visitor_class, method, node, 0)
+        if text is None:
+            text = "".join(out[start:])
+            del out[start:]
+        return text
 
     # -------------------------------------------------------------------------
     # common support methods
@@ -25,31 +292,72 @@ class CodeGenVisitor(NodeVisitor):
     def _genblock(self, forest, insert_curly_brackets=True,
                   increase_indent=True):
         """generate block of code adding semi colons as necessary"""
+        out = self._out
+        start = len(out)
+        self._writeblock(forest, insert_curly_brackets, increase_indent)
+        text = "".join(out[start:])
+        del out[start:]
+        return text
+
+    def _writeblock(self, forest, insert_curly_brackets=True,
+                    increase_indent=True, memoize=False):
+        """
+        Like _genblock, but writes the block to the output. With memoize,
+        the code for each statement is looked up in (and added to) the
+        CODEGEN_MEMO, if [jit] CODEGEN_MEMO allows.
+        """
+        out = self._out
+        out.append("{\n" if insert_curly_brackets else "\n")
         if increase_indent:
             self._indent += 1
-        body = ""
+        tab = self._tab()
+        max_count = memoize and ctree.CONFIG.getint('jit', 'CODEGEN_MEMO')
         for tree in flatten(forest):
             if not hasattr(tree, '_requires_semicolon'):
-                body += self._tab() + str(tree) + "\n"
+                out.extend((tab, str(tree), "\n"))
+                continue
+            start = len(out)
+            out.append(tab)
+            if max_count:
+                self._write_memoized(tree, max_count)
             else:
-                semicolon_opt = ";" if tree._requires_semicolon() else ""
-                block = tree.codegen(self._indent)
-                if block is not "":
-                    body += self._tab() + block + semicolon_opt + "\n"
+                self._write_node(tree, self._indent)
+            for index in range(start + 1, len(out)):
+                if out[index]:
+                    out.append(";\n" if tree._requires_semicolon() else "\n")
+                    break
+            else:
+                # nothing to show for this statement (deleted, pass, ...)
+                del out[start:]
         if increase_indent:
             self._indent -= 1
         if insert_curly_brackets:
-            return "{\n%s%s}" % (body, self._tab())
-        else:
-            return "\n%s" % body
+            out.extend((self._tab(), "}"))
+
+    def _write_memoized(self, tree, max_count):
+        key = subtree_key(tree)
+        if key is None:
+            self._write_node(tree, self._indent)
+            return
+        # types render as registered when the code is generated
+        key = (key, self._indent, registry_generation())
+        text = CODEGEN_MEMO.get(key)
+        if text is None:
+            out = self._out
+            start = len(out)
+            self._write_node(tree, self._indent)
+            text = "".join(out[start:])
+            del out[start:]
+            CODEGEN_MEMO.put(key, text, max_count)
+        self._out.append(text)
 
     def _parenthesize(self, parent, child):
         """A format string that includes parentheses if needed."""
         if self._requires_parentheses(parent, child) or \
                 child._force_parentheses is True:
-            return "(%s)" % child
+            return "(%s)" % self._gen(child)
         else:
-            return "%s" % child
+            return self._gen(child)
 
     def _requires_parentheses(self, parent, child):
         """True by default."""
@@ -21,5 +21,5 @@ class CppCodeGen(CodeGenVisitor):
             node.text.splitlines())
 
     def visit_CppDefine(self, node):
-        params = ", ".join(map(str, node.params))
-        return "#define %s(%s) (%s)" % (node.name, params, node.body)
+        params = ", ".join(map(self._gen, node.params))
+        return "#define %s(%s) (%s)" % (node.name, params, self._gen(node.body))
@@ -8,10 +8,7 @@ from ctree.nodes import CtreeNode
 class CppNode(CtreeNode):
     """Base class for all C Preprocessor nodes in ctree."""
 
-    def codegen(self, indent=0):
-        from ctree.cpp.codegen import CppCodeGen
-
-        return CppCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.cpp.codegen.CppCodeGen"
 
     def label(self):
         from ctree.cpp.dotgen import CppDotLabeller
@@ -5,28 +5,113 @@ Just-in-time compilation support.
 import abc
 import copy
 import os
+import sys
 import re
 import ast
 import logging
 import inspect
 import hashlib
 import json
-from collections import namedtuple
+import time
+import linecache
+import itertools
+import weakref
+import threading
+from collections import namedtuple, OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # pragma: no cover
+    from collections import MutableMapping
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import tempfile
 
 
 import ctree
 from ctree.nodes import Project
+from ctree.backends import use_backend, build_options
 from ctree.analyses import VerifyOnlyCtreeNodes
 from ctree.frontend import get_ast
+from ctree.util import structural_hash
 from ctree.transforms import DeclarationFiller
 from ctree.c.nodes import CFile, MultiNode
-if ctree.OCL_ENABLED:
-    from ctree.ocl.nodes import OclFile
 from ctree.nodes import File
 
 log = logging.getLogger(__name__)
 
+# class -> (source filename, mtime, source text)
+_SOURCE_CACHE = {}
+
+
+def _class_source(klass):
+    """
+    Returns (mtime, source) for klass. The source is only re-read when the
+    file defining klass has been modified since it was last read.
+    """
+    cached = _SOURCE_CACHE.get(klass)
+    if cached is not None:
+        filename = cached[0]
+    else:
+        try:
+            filename = inspect.getsourcefile(klass)
+        except TypeError:
+            filename = None
+    try:
+        mtime = os.path.getmtime(filename)
+    except (OSError, TypeError):
+        mtime = None
+    if cached is not None and cached[1] == mtime:
+        return mtime, cached[2]
+
+    if filename is not None:
+        linecache.checkcache(filename)
+    try:
+        source = inspect.getsource(klass)
+    except (IOError, TypeError):
+        # means source can't be found. Well, can't do anything
+        # about that I don't think
+        source = None
+    _SOURCE_CACHE[klass] = (filename, mtime, source)
+    return mtime, source
+
+
+_COMPILE_POOL = None
+
+
+def _compile_pool():
+    """Returns the shared pool that runs background builds."""
+    global _COMPILE_POOL
+    if _COMPILE_POOL is None:
+        jobs = ctree.CONFIG.getint('jit', 'COMPILE_JOBS') or cpu_count()
+        _COMPILE_POOL = ThreadPool(jobs)
+    return _COMPILE_POOL
+
+
+def _unload_library(handle, so_file_name):
+    """dlcloses a library loaded by JitModule."""
+    import _ctypes
+    dlclose = getattr(_ctypes, 'dlclose', None)
+    if dlclose is None:  # pragma: no cover
+        return
+    log.debug("unloading %s", so_file_name)
+    dlclose(handle)
+    ctree.STATS.log("shared library unloaded")
+
+
+# weak references to the libraries loaded by JitModule, whose callbacks
+# unload them; kept here so that the references outlive the libraries
+_LOADED_LIBRARIES = set()
+
+
+def _unload_when_collected(lib, so_file_name):
+    """Unloads lib, loaded from so_file_name, once it is garbage collected."""
+    handle = lib._handle
+
+    def unload(ref):
+        _LOADED_LIBRARIES.discard(ref)
+        _unload_library(handle, so_file_name)
+    _LOADED_LIBRARIES.add(weakref.ref(lib, unload))
+
 
 def getFile(filepath):
     """
@@ -35,6 +120,7 @@ def getFile(filepath):
     """
     file_types = [CFile]
     if ctree.OCL_ENABLED:
+        from ctree.ocl.nodes import OclFile
         file_types.append(OclFile)
     ext_map = {'.'+t._ext: t for t in file_types}
     path, filename = os.path.split(filepath)
@@ -59,23 +145,48 @@ class JitModule(object):
         self.compilation_dir = tempfile.mkdtemp(prefix="run-", dir=ctree_dir)
         self.ll_module = None
         self.exec_engine = None
+        self.submodules = []
+        self.so_file_name = None
 
     def _link_in(self, submodule):
+        # each submodule is either the path of a shared object or, for
+        # in-process backends, an object providing get_callable()
+        self.submodules.append(submodule)
         self.so_file_name = submodule
         # if self.ll_module is not None:
         #     self.ll_module.link_in(submodule)
         # else:
         #     self.ll_module = submodule
 
-    def get_callable(self, entry_point_name, entry_point_typesig):
+    def _get_c_function(self, entry_point_name, entry_point_typesig):
         """
-        Returns a python callable that dispatches to the requested C function.
+        Returns the requested C function, from whichever submodule defines
+        it, as a ctypes function.
         """
+        for submodule in reversed(self.submodules[1:]):
+            try:
+                return self._get_submodule_function(
+                    submodule, entry_point_name, entry_point_typesig)
+            except AttributeError:
+                pass
+        return self._get_submodule_function(
+            self.submodules[0] if self.submodules else None,
+            entry_point_name, entry_point_typesig)
+
+    @staticmethod
+    def _get_submodule_function(submodule, entry_point_name,
+                                entry_point_typesig):
+        if hasattr(submodule, 'get_callable'):
+            return submodule.get_callable(entry_point_name,
+                                          entry_point_typesig)
 
         # get llvm represetation of function
         # ll_function = self.ll_module.get_function(entry_point_name)
         import ctypes
-        lib = ctypes.cdll.LoadLibrary(self.so_file_name)
+        lib = ctypes.cdll.LoadLibrary(submodule)
+        # functions taken from lib keep it alive; once they are all gone,
+        # unload it so that evicted configs don't stay mapped
+        _unload_when_collected(lib, submodule)
         func_ptr = getattr(lib, entry_point_name)
         func_ptr.argtypes = entry_point_typesig._argtypes_
         func_ptr.restype = entry_point_typesig._restype_
@@ -90,6 +201,28 @@ class JitModule(object):
         # cast c_func_ptr to python callable using ctypes
         return func_ptr
 
+    def get_callable(self, entry_point_name, entry_point_typesig):
+        """
+        Returns a python callable that dispatches to the requested C function.
+        """
+        func_ptr = self._get_c_function(entry_point_name, entry_point_typesig)
+        if ctree.CONFIG.getboolean('jit', 'THUNKS'):
+            from ctree.thunks import make_thunk
+            thunk = make_thunk(func_ptr, entry_point_typesig)
+            if thunk is not None:
+                return thunk
+        return func_ptr
+
+    def get_batch_callable(self, entry_point_name, entry_point_typesig):
+        """
+        Returns a python callable that takes a sequence of argument tuples
+        and calls the requested C function with each of them from a C loop,
+        or None if the function's signature isn't supported.
+        """
+        from ctree.thunks import make_thunk
+        func_ptr = self._get_c_function(entry_point_name, entry_point_typesig)
+        return make_thunk(func_ptr, entry_point_typesig, batch=True)
+
 
 class ConcreteSpecializedFunction(object):
     """
@@ -97,6 +230,12 @@ class ConcreteSpecializedFunction(object):
     """
     __metaclass__ = abc.ABCMeta
 
+    # Set to True by subclasses whose __call__ passes its arguments
+    # unchanged to the entry point and returns its result, so that batch()
+    # may call the entry point directly.
+    direct_call = False
+    _batch_function = None
+
     def _compile(self, entry_point_name, project_node, entry_point_typesig,
                  **kwargs):
         """
@@ -108,6 +247,7 @@ class ConcreteSpecializedFunction(object):
         VerifyOnlyCtreeNodes().visit(project_node)
 
         self._module = project_node.codegen(**kwargs)
+        self._entry_point = (entry_point_name, entry_point_typesig)
 
         # if log.getEffectiveLevel() == 'debug':
         #     highlighted = highlight(str(self._module.ll_module), 'llvm')
@@ -115,20 +255,241 @@ class ConcreteSpecializedFunction(object):
 
         return self._module.get_callable(entry_point_name, entry_point_typesig)
 
+    def batch(self, args_list):
+        """
+        Calls this function with each tuple of arguments in args_list and
+        returns the list of results. For direct_call functions the calls
+        are made from a generated C loop.
+        """
+        if self.direct_call and hasattr(self, '_entry_point'):
+            if self._batch_function is None:
+                self._batch_function = \
+                    self._module.get_batch_callable(*self._entry_point) or False
+            if self._batch_function:
+                return self._batch_function(args_list)
+        return [self(*args) for args in args_list]
+
     @abc.abstractmethod
     def __call__(self, *args, **kwargs):
         pass
 
 
+class FunctionCache(MutableMapping):
+    """
+    The concrete functions of a LazySpecializedFunction, keyed by program
+    config. Holds at most max_count functions whose shared objects total
+    at most max_size bytes (0 for no limit); lookups mark a function as
+    used, and the least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_count=0, max_size=0, on_evict=None):
+        """
+        on_evict, if given, is called with the key of each evicted function,
+        after the cache has been updated.
+        """
+        self.max_count = max_count
+        self.max_size = max_size
+        self.total_size = 0
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (function, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(csf):
+        size = 0
+        for submodule in getattr(getattr(csf, '_module', None),
+                                 'submodules', ()):
+            try:
+                size += os.path.getsize(submodule)
+            except (OSError, TypeError):
+                pass
+        return size
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        with self._lock:
+            # reinserted as the most recently used
+            entry = self._entries[key] = self._entries.pop(key)
+        return entry[0]
+
+    def __setitem__(self, key, csf):
+        size = self._size(csf)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_size -= old[1]
+            self._entries[key] = (csf, size)
+            self.total_size += size
+            evicted = self._evict()
+        if self.on_evict is not None:
+            for key in evicted:
+                self.on_evict(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.total_size -= self._entries.pop(key)[1]
+
+    def _evict(self):
+        """Evicts the least recently used functions, returning their keys."""
+        evicted = []
+        while len(self._entries) > 1 and (
+                self.max_count and len(self._entries) > self.max_count or
+                self.max_size and self.total_size > self.max_size):
+            key, (csf, size) = self._entries.popitem(last=False)
+            self.total_size -= size
+            log.info("evicting concrete function for %s", key)
+            ctree.STATS.log("specialized function cache eviction")
+            evicted.append(key)
+        return evicted
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+ARG_FEATURES = ('type', 'dtype', 'ndim', 'shape', 'strides', 'contiguous',
+                'aligned')
+
+
+def _ndarray_type():
+    """
+    Returns numpy.ndarray, or None if numpy has not been imported (so no
+    argument can be an array).
+    """
+    numpy = sys.modules.get('numpy')
+    return None if numpy is None else numpy.ndarray
+
+
+class ArgInfo(namedtuple('ArgInfo', ARG_FEATURES)):
+    """
+    The features of one argument that an ArgumentSignature declared as
+    relevant; the others are None. contiguous is 'C', 'F' or None.
+    """
+    __slots__ = ()
+
+    def is_array(self):
+        ndarray = _ndarray_type()
+        return ndarray is not None and issubclass(self.type, ndarray)
+
+    def as_ctype(self):
+        """
+        Returns the ctypes type to pass the argument with: an ndpointer for
+        arrays, otherwise the type recognized for its Python type.
+        """
+        if self.is_array():
+            import numpy as np
+            flags = {'C': ['C_CONTIGUOUS'],
+                     'F': ['F_CONTIGUOUS']}.get(self.contiguous)
+            return np.ctypeslib.ndpointer(self.dtype, self.ndim, self.shape,
+                                          flags)
+        from ctree.types import get_ctype
+        return type(get_ctype(self.type()))
+
+
+class ArgumentSignature(object):
+    """
+    Declares which features of the arguments (see ARG_FEATURES) select the
+    generated code, e.g. ArgumentSignature('dtype', 'ndim', 'shape').
+    Calling it on the arguments of a call returns their args_subconfig: a
+    tuple of ArgInfo, one per positional argument, followed by a
+    (name, ArgInfo) pair per keyword argument, in name order. The type of
+    each argument always counts; the other features only describe numpy
+    arrays. Classifications are cached on (type, dtype, shape, strides),
+    so repeated calls with similar arguments cost a dictionary lookup.
+    """
+    # classifications cached at most, beyond which the cache starts over
+    max_cached = 1024
+
+    def __init__(self, *features, **kwargs):
+        """
+        Create a signature depending on 'features'. With 'aligned', arrays
+        count as aligned when their data is aligned to 'alignment' bytes.
+        """
+        unknown = set(features) - set(ARG_FEATURES)
+        if unknown:
+            raise ValueError("Unknown argument features: %s" %
+                             ", ".join(sorted(unknown)))
+        self.features = frozenset(features) | frozenset(['type'])
+        self.alignment = kwargs.pop('alignment', 64)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ", ".join(sorted(kwargs)))
+        self._cache = {}  # fast keys -> args_subconfig
+
+    def _fast_key(self, arg, ndarray):
+        if ndarray is None or not isinstance(arg, ndarray):
+            return type(arg)
+        if 'aligned' in self.features:
+            address = arg.__array_interface__['data'][0]
+            return (type(arg), arg.dtype, arg.shape, arg.strides,
+                    address % self.alignment == 0)
+        return (type(arg), arg.dtype, arg.shape, arg.strides)
+
+    def _classify(self, arg, fast_key):
+        features = self.features
+        if not isinstance(fast_key, tuple):
+            return ArgInfo(fast_key, None, None, None, None, None, None)
+        flags = arg.flags
+        if flags.c_contiguous:
+            contiguous = 'C'
+        elif flags.f_contiguous:
+            contiguous = 'F'
+        else:
+            contiguous = None
+        return ArgInfo(
+            type(arg),
+            arg.dtype if 'dtype' in features else None,
+            arg.ndim if 'ndim' in features else None,
+            arg.shape if 'shape' in features else None,
+            arg.strides if 'strides' in features else None,
+            contiguous if 'contiguous' in features else None,
+            fast_key[4] if 'aligned' in features else None)
+
+    def __call__(self, args, kwargs=None):
+        ndarray = _ndarray_type()
+        fast_key = tuple([self._fast_key(arg, ndarray) for arg in args])
+        names = tuple(sorted(kwargs)) if kwargs else ()
+        keyword_keys = tuple([self._fast_key(kwargs[name], ndarray)
+                              for name in names])
+        try:
+            return self._cache[fast_key, names, keyword_keys]
+        except KeyError:
+            pass
+        subconfig = tuple(
+            [self._classify(arg, key) for arg, key in zip(args, fast_key)] +
+            [(name, self._classify(kwargs[name], key))
+             for name, key in zip(names, keyword_keys)])
+        if len(self._cache) >= self.max_cached:
+            self._cache.clear()
+        self._cache[fast_key, names, keyword_keys] = subconfig
+        return subconfig
+
+
 class LazySpecializedFunction(object):
     """
     A callable object that will produce executable
-    code just-in-time.
+    code just-in-time. With async_compile, new program
+    configurations are built in the background and calls
+    are serviced by interpret() until the build finishes.
+    Configurations called hot_calls times or for hot_time
+    seconds are rebuilt in the background with HOT_CFLAGS.
     """
 
     ProgramConfig = namedtuple('ProgramConfig',
                                ['args_subconfig', 'tuner_subconfig'])
     _directory_fields = ['__class__.__name__', 'backend_name']
+    # an ArgumentSignature classifying the arguments, used by the default
+    # args_to_subconfig
+    arg_signature = None
+    _hash_memo = None  # (class sources, hash value) from the last __hash__
+    _tree_dump = None
 
     class NameExtractor(ast.NodeVisitor):
         """
@@ -150,29 +511,54 @@ class LazySpecializedFunction(object):
                     if res:
                         return res
 
-    def __init__(self, py_ast=None, sub_dir=None, backend_name="default"):
+    def __init__(self, py_ast=None, sub_dir=None, backend_name="default",
+                 async_compile=False):
         if py_ast is not None and \
                 self.apply is not LazySpecializedFunction.apply:
             raise TypeError('Cannot define apply and pass py_ast')
         self.original_tree = py_ast or \
             (get_ast(self.apply)
              if self.apply is not LazySpecializedFunction.apply else None)
-        self.concrete_functions = {}  # config -> callable map
+        # program config -> callable map
+        self.concrete_functions = FunctionCache(
+            ctree.CONFIG.getint('jit', 'MAX_FUNCTIONS'),
+            ctree.CONFIG.getint('jit', 'MAX_FUNCTIONS_SIZE') * 1024 * 1024,
+            self._forget)
+        self.async_compile = async_compile
+        self._pending = {}  # program config -> background build
+        # guards _pending, _installed, profiles and _promoted; reentrant
+        # since _build evicts from concrete_functions while holding it
+        self._lock = threading.RLock()
+        # builds are numbered as they are started; program config -> the
+        # number of the build of its function in concrete_functions, which
+        # builds started earlier (but finishing later) don't replace
+        self._builds = itertools.count()
+        self._installed = {}
+        # program config -> [number of calls, seconds spent in calls]
+        self.profiles = {}
+        self._promoted = set()
+        self.hot_calls = ctree.CONFIG.getint('jit', 'HOT_CALLS')
+        self.hot_time = ctree.CONFIG.getfloat('jit', 'HOT_TIME')
         self._tuner = self.get_tuning_driver()
         self.sub_dir = sub_dir or \
-            self.NameExtractor().visit(self.original_tree) or \
+            self.NameExtractor().visit(self._original_tree) or \
             hex(hash(self))[2:]
         self.backend_name = backend_name
 
     @property
     def original_tree(self):
+        """
+        A private copy of the tree, safe for the caller to mutate. Internal
+        readers that only inspect the tree use _original_tree directly so
+        that the copy is made at most once per transform.
+        """
         return copy.deepcopy(self._original_tree)
 
     @original_tree.setter
     def original_tree(self, value):
         if not hasattr(self, '_original_tree'):
             self._original_tree = value
-        elif ast.dump(self.__original_tree, True, True) != \
+        elif ast.dump(self._original_tree, True, True) != \
                 ast.dump(value, True, True):
             raise AttributeError('Cannot redefine the ast')
 
@@ -194,31 +580,65 @@ class LazySpecializedFunction(object):
 
     @staticmethod
     def _hash(o):
+        """
+        Returns a hash of the (sub)config o that is stable across processes,
+        since it names the config's directory in the persistent cache.
+        """
+        return structural_hash(o)
+
+    @staticmethod
+    def _freeze(o):
+        """Returns a hashable equivalent of o, converting dicts and lists."""
         if isinstance(o, dict):
-            return hash(frozenset(
-                LazySpecializedFunction._hash(item) for item in o.items()
-            ))
-        else:
-            return hash(str(o))
+            return frozenset(
+                (key, LazySpecializedFunction._freeze(value))
+                for key, value in o.items()
+            )
+        elif isinstance(o, list):
+            return tuple(LazySpecializedFunction._freeze(item) for item in o)
+        return o
+
+    def _config_key(self, program_config):
+        """
+        Returns the key under which the concrete function for program_config
+        is stored in concrete_functions.
+        """
+        try:
+            hash(program_config)
+            return program_config
+        except TypeError:
+            pass
+        key = self.ProgramConfig(
+            self._freeze(program_config.args_subconfig),
+            self._freeze(program_config.tuner_subconfig))
+        try:
+            hash(key)
+            return key
+        except TypeError:
+            # some component is still unhashable; fall back on its structural hash
+            return self.ProgramConfig(
+                self._hash(program_config.args_subconfig),
+                self._hash(program_config.tuner_subconfig))
 
     def __hash__(self):
-        mro = type(self).mro()
+        sources = tuple(_class_source(klass) for klass in type(self).mro()
+                        if issubclass(klass, LazySpecializedFunction))
+        if self._hash_memo is not None and self._hash_memo[0] == sources:
+            return self._hash_memo[1]
+
         result = hashlib.sha512(''.encode())
-        for klass in mro:
-            if issubclass(klass, LazySpecializedFunction):
-                try:
-                    result.update(inspect.getsource(klass).encode())
-                except IOError:
-                    # means source can't be found. Well, can't do anything
-                    # about that I don't think
-                    pass
-            else:
-                pass
-        if self.original_tree is not None:
-            tree_str = ast.dump(self.original_tree,
-                                annotate_fields=True, include_attributes=True)
-            result.update(tree_str.encode())
-        return int(result.hexdigest(), 16)
+        for _, source in sources:
+            if source is not None:
+                result.update(source.encode())
+        if self._original_tree is not None:
+            if self._tree_dump is None:
+                self._tree_dump = ast.dump(self._original_tree,
+                                           annotate_fields=True,
+                                           include_attributes=True)
+            result.update(self._tree_dump.encode())
+        value = int(result.hexdigest(), 16)
+        self._hash_memo = (sources, value)
+        return value
 
     def config_to_dirname(self, program_config):
         """Returns the subdirectory name under .compiled/funcname"""
@@ -233,8 +653,8 @@ class LazySpecializedFunction(object):
 
         path_parts = [
             self.sub_dir,
-            str(self._hash(program_config.args_subconfig)),
-            str(self._hash(program_config.tuner_subconfig))
+            self._hash(program_config.args_subconfig),
+            self._hash(program_config.tuner_subconfig)
             ]
 
         for attrib in self._directory_fields:
@@ -247,11 +667,16 @@ class LazySpecializedFunction(object):
         return re.sub('_+', '_', path)
 
     def get_program_config(self, args, kwargs):
-        # Don't break old specializers that don't support kwargs
-        try:
-            args_subconfig = self.args_to_subconfig(args, kwargs)
-        except TypeError:
-            args_subconfig = self.args_to_subconfig(args)
+        if self.arg_signature is not None and \
+                type(self).args_to_subconfig is \
+                LazySpecializedFunction.args_to_subconfig:
+            args_subconfig = self.arg_signature(args, kwargs)
+        else:
+            # Don't break old specializers that don't support kwargs
+            try:
+                args_subconfig = self.args_to_subconfig(args, kwargs)
+            except TypeError:
+                args_subconfig = self.args_to_subconfig(args)
 
         tuner_subconfig = next(self._tuner.configs)
         log.info("tuner subconfig: %s", tuner_subconfig)
@@ -261,9 +686,14 @@ class LazySpecializedFunction(object):
 
     def get_transform_result(self, program_config, dir_name, cache=True):
         info = self.get_info(dir_name)
-        # check to see if the necessary code is in the persistent cache
-        if hash(self) != info['hash'] and self.original_tree is not None \
-                or not cache:
+        # check to see if the necessary code is in the persistent cache: each
+        # file's program is known by its hash (to look its build up in the
+        # artifact store), or by its source, saved with [jit] SAVE_SOURCE
+        programs = info.get('programs', {})
+        cached = all(path in programs or os.path.exists(path)
+                     for path in info['files'])
+        if hash(self) != info['hash'] and self._original_tree is not None \
+                or not cached or not cache:
             # need to run transform() for code generation
             log.info('Hash miss. Running Transform')
             ctree.STATS.log("Filesystem cache miss")
@@ -284,9 +714,29 @@ class LazySpecializedFunction(object):
             log.info('Hash hit. Skipping transform')
             ctree.STATS.log('Filesystem cache hit')
             files = [getFile(path) for path in info['files']]
+            for cached_file in files:
+                cached_file._program_hash = programs.get(
+                    os.path.join(cached_file.path, cached_file.get_filename()))
             transform_result = files
         return transform_result
 
+    def _save_program_hashes(self, dir_name, transform_result):
+        """
+        Records the hashes of the programs compiled for the files of
+        transform_result in the persistent cache (see get_transform_result).
+        """
+        info = self.get_info(dir_name)
+        programs = dict(info.get('programs', {}))
+        for source_file in transform_result:
+            program_hash = getattr(source_file, '_program_hash', None)
+            if program_hash:
+                programs[os.path.join(source_file.path,
+                                      source_file.get_filename())] = \
+                    program_hash
+        if programs != info.get('programs', {}):
+            info['programs'] = programs
+            self.set_info(dir_name, info)
+
     def __call__(self, *args, **kwargs):
         """
         Determines the program_configuration to be run. If it has yet to be
@@ -296,39 +746,255 @@ class LazySpecializedFunction(object):
         """
         ctree.STATS.log("specialized function call")
 
-        log.info("detected specialized function call with arg types: %s",
-                 [type(a) for a in args] +
-                 [type(kwargs[key]) for key in kwargs])
+        if log.isEnabledFor(logging.INFO):
+            log.info("detected specialized function call with arg types: %s",
+                     [type(a) for a in args] +
+                     [type(kwargs[key]) for key in kwargs])
 
         program_config = self.get_program_config(args, kwargs)
-        dir_name = self.config_to_dirname(program_config)
-
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
+        config_key = self._config_key(program_config)
 
-        config_hash = dir_name
+        # checks to see if the necessary code is in the run-time cache,
+        # which is keyed directly on the program config so that a hit never
+        # touches the filesystem. Asynchronous mode always consults it, since
+        # that is how finished background builds are picked up.
+        csf = None
+        if self._uses_cache():
+            csf = self.concrete_functions.get(config_key)
 
-        # checks to see if the necessary code is in the run-time cache
-        if ctree.CONFIG.getboolean('jit', 'CACHE') and \
-                config_hash in self.concrete_functions:
+        if csf is not None:
             ctree.STATS.log("specialized function cache hit")
             log.info("specialized function cache hit!")
-            csf = self.concrete_functions[config_hash]
-
         else:
             ctree.STATS.log("specialized function cache miss")
             log.info("specialized function cache miss.")
-            transform_result = self.get_transform_result(
-                program_config, dir_name)
-
-            csf = self.finalize(transform_result, program_config)
-            assert isinstance(csf, ConcreteSpecializedFunction), \
-                "Expected a ctree.jit.ConcreteSpecializedFunction, \
-                 but got a %s." % type(csf)
-            self.concrete_functions[config_hash] = csf
+            if self.async_compile:
+                return self._call_async(program_config, config_key,
+                                        args, kwargs)
+            fast_backend = ctree.CONFIG.get('jit', 'FAST_BACKEND')
+            if fast_backend and ctree.CONFIG.getboolean('jit', 'CACHE'):
+                # tiered compilation: get going with cheaply compiled code,
+                # then replace it with the optimized build once that's
+                # done (without the cache, it would never be used)
+                with use_backend(fast_backend):
+                    csf = self._build(program_config, config_key)
+                self._submit(self._build, program_config, config_key)
+            elif config_key in self._promoted:
+                # only without the cache, where each call builds anew
+                csf = self._build_hot(program_config, config_key)
+            else:
+                csf = self._build(program_config, config_key)
 
+        if self.hot_calls or self.hot_time:
+            return self._call_profiled(csf, program_config, config_key,
+                                       args, kwargs)
         return csf(*args, **kwargs)
 
+    def batch(self, args_list):
+        """
+        Calls this function once for each tuple of arguments in args_list
+        and returns the list of results, in order. The calls are grouped by
+        program configuration and each group is made with a single call to
+        ConcreteSpecializedFunction.batch, which for direct_call functions
+        runs the whole group from a generated C loop.
+        """
+        args_list = [tuple(args) for args in args_list]
+        ctree.STATS.log("specialized function batch call")
+        groups = OrderedDict()  # program config -> (config, indices)
+        for index, args in enumerate(args_list):
+            program_config = self.get_program_config(args, {})
+            config_key = self._config_key(program_config)
+            group = groups.get(config_key)
+            if group is None:
+                group = groups[config_key] = (program_config, [])
+            group[1].append(index)
+
+        results = [None] * len(args_list)
+        for config_key, (program_config, indices) in groups.items():
+            group_args = [args_list[index] for index in indices]
+            csf = None
+            if self._uses_cache():
+                csf = self.concrete_functions.get(config_key)
+            if csf is None and self.async_compile:
+                # not built yet; let __call__ interpret or wait per call
+                group_results = [self(*args) for args in group_args]
+            else:
+                if csf is None:
+                    ctree.STATS.log("specialized function cache miss")
+                    csf = self._build(program_config, config_key)
+                else:
+                    ctree.STATS.log("specialized function cache hit")
+                group_results = csf.batch(group_args)
+            for index, result in zip(indices, group_results):
+                results[index] = result
+        return results
+
+    def map(self, *iterables):
+        """
+        Like the builtin map: calls this function with arguments taken from
+        each of the iterables in turn, as a single batch().
+        """
+        return self.batch(zip(*iterables))
+
+    def _uses_cache(self):
+        """Whether calls look their config up in concrete_functions."""
+        return self.async_compile or ctree.CONFIG.getboolean('jit', 'CACHE')
+
+    def _call_profiled(self, csf, program_config, config_key, args, kwargs):
+        """
+        Calls csf, accounting the call to program_config. Once the config
+        is hot, it is rebuilt with HOT_CFLAGS in the background (once no
+        other build of it is pending), or, without the cache, built with
+        them from then on.
+        """
+        start = time.time()
+        result = csf(*args, **kwargs)
+        elapsed = time.time() - start
+
+        with self._lock:
+            profile = self.profiles.get(config_key)
+            if profile is None:
+                profile = self.profiles[config_key] = [0, 0.0]
+            profile[0] += 1
+            profile[1] += elapsed
+            if config_key not in self._promoted and \
+                    (self.hot_calls and profile[0] >= self.hot_calls or
+                     self.hot_time and profile[1] >= self.hot_time) and \
+                    (not self._uses_cache() or
+                     self._submit(self._build_hot, program_config,
+                                  config_key)):
+                log.info("promoting hot config after %d calls, %f seconds.",
+                         profile[0], profile[1])
+                ctree.STATS.log("specialized function promoted")
+                self._promoted.add(config_key)
+        return result
+
+    def _build_hot(self, program_config, config_key, number=None):
+        with build_options(hot=True):
+            return self._build(program_config, config_key, number)
+
+    def _build(self, program_config, config_key, number=None):
+        """
+        Transforms, compiles and finalizes the code for program_config and
+        stores the result in concrete_functions, unless a build started
+        later than this one (numbered 'number', by default the next number)
+        has stored its result already.
+        """
+        if number is None:
+            number = next(self._builds)
+        dir_name = self.config_to_dirname(program_config)
+        if not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+
+        transform_result = self.get_transform_result(
+            program_config, dir_name)
+
+        try:
+            csf = self.finalize(transform_result, program_config)
+        except NotImplementedError:
+            if not all(isinstance(f, File) and not f.body
+                       for f in transform_result):
+                raise
+            # files from the persistent cache whose builds were evicted
+            # from the artifact store, without saved sources
+            log.info("cached build not found, running transform")
+            transform_result = self.get_transform_result(
+                program_config, dir_name, cache=False)
+            csf = self.finalize(transform_result, program_config)
+        self._save_program_hashes(dir_name, transform_result)
+        assert isinstance(csf, ConcreteSpecializedFunction), \
+            "Expected a ctree.jit.ConcreteSpecializedFunction, \
+             but got a %s." % type(csf)
+        with self._lock:
+            if self._installed.get(config_key, -1) > number:
+                log.info("keeping the newer build for %s", config_key)
+                return csf
+            self._installed[config_key] = number
+            self.concrete_functions[config_key] = csf
+        return csf
+
+    def _forget(self, config_key):
+        """Drops what is known about config_key once its function is evicted."""
+        with self._lock:
+            self._installed.pop(config_key, None)
+            self.profiles.pop(config_key, None)
+            self._promoted.discard(config_key)
+
+    def _can_interpret(self):
+        return type(self).interpret is not LazySpecializedFunction.interpret \
+            or self.apply is not LazySpecializedFunction.apply
+
+    def _call_async(self, program_config, config_key, args, kwargs):
+        """
+        Starts building program_config in the background, if it isn't
+        already, and runs the interpreted version until the build finishes.
+        """
+        csf = None
+        with self._lock:
+            pending = self._pending.get(config_key)
+            if pending is None:
+                csf = self.concrete_functions.get(config_key)
+                if csf is None:
+                    log.info("starting background build.")
+                    pending = self._pending[config_key] = \
+                        _compile_pool().apply_async(
+                            self._build_in_background,
+                            (self._build, program_config, config_key,
+                             next(self._builds)))
+        if csf is not None:
+            # the build finished since __call__ checked
+            return csf(*args, **kwargs)
+
+        if not self._can_interpret():
+            log.info("no interpreted fallback, waiting for build.")
+            pending.wait()
+
+        if pending.ready():
+            with self._lock:
+                if self._pending.get(config_key) is pending:
+                    del self._pending[config_key]
+            # re-raises any exception from the background build
+            return pending.get()(*args, **kwargs)
+
+        ctree.STATS.log("specialized function interpreted")
+        return self.interpret(*args, **kwargs)
+
+    def _submit(self, build, program_config, config_key):
+        """
+        Starts build(program_config, config_key, number) in the background
+        to replace the function of a config that already has one, unless a
+        build of the config is pending. Returns whether it was started.
+        """
+        with self._lock:
+            if config_key in self._pending:
+                return False
+            self._pending[config_key] = _compile_pool().apply_async(
+                self._build_in_background,
+                (build, program_config, config_key, next(self._builds),
+                 False))
+        return True
+
+    def _build_in_background(self, build, program_config, config_key,
+                             number, collected=True):
+        """
+        Runs build(program_config, config_key, number) in a pool thread,
+        'number' being the build's number, taken when it was started. Once
+        it succeeds, the config is no longer pending since its function is
+        in concrete_functions. A failure is logged; if the build is
+        collected by a call (see _call_async), it stays pending until then
+        and is re-raised there, otherwise the current function is kept.
+        """
+        try:
+            csf = build(program_config, config_key, number)
+        except Exception:
+            log.exception("background build for %s failed", config_key)
+            if collected:
+                raise
+            csf = None
+        with self._lock:
+            self._pending.pop(config_key, None)
+        return csf
+
     def run_transform(self, program_config):
         transform_result = self.transform(
             self.original_tree,
@@ -397,13 +1063,23 @@ class LazySpecializedFunction(object):
         """
         Extract features from the arguments to define uniqueness of
         this particular invocation. The return value must be a hashable
-        object, or a dictionary of hashable objects.
+        object, or a dictionary of hashable objects. By default, arguments
+        are classified by arg_signature if it is set.
         """
+        if self.arg_signature is not None:
+            return self.arg_signature(args)
         log.warn("arguments will not influence program_config. " +
                  "Consider overriding args_to_subconfig() in %s.",
                  type(self).__name__)
         return dict()
 
+    def interpret(self, *args, **kwargs):
+        """
+        Pure-Python implementation run while code is compiled in the
+        background (see async_compile). Defaults to apply().
+        """
+        return self.apply(*args, **kwargs)
+
     @staticmethod
     def apply(*args):
         raise NotImplementedError()
@@ -9,32 +9,188 @@ log = logging.getLogger(__name__)
 
 import ast
 import collections
+import heapq
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from ctree.codegen import CodeGenVisitor
 from ctree.dotgen import DotGenVisitor, DotGenLabeller
 from ctree.util import flatten
+from ctree.backends import build_options, current_build_options
 import ctree
 import os
 
 
+# the current mutation epoch; node indexes built in earlier epochs are stale
+_mutation_epoch = 0
+
+
+def mark_mutated():
+    """
+    Starts a new mutation epoch, after which the node indexes of all trees
+    (see CtreeNode.index_nodes) are rebuilt on their next use. Indexes do
+    not check their trees, so code that changes an indexed tree in place
+    must call it before the next lookup. ctree's NodeTransformer (see
+    ctree.visitors), PassManager runs and lift() call it themselves.
+    """
+    global _mutation_epoch
+    _mutation_epoch += 1
+
+
+class _NodeIndex(object):
+    """
+    The nodes of a tree by class, and by the values of some of their
+    attributes, as of one mutation epoch. Nodes are kept with their
+    position in the order of ast.walk().
+    """
+
+    def __init__(self, attrs):
+        self.attrs = tuple(attrs)
+        self.epoch = None
+
+    def build(self, root):
+        by_class = {}
+        by_attr = {}
+        attrs = self.attrs
+        for position, node in enumerate(ast.walk(root)):
+            cls = type(node)
+            entry = (position, node)
+            entries = by_class.get(cls)
+            if entries is None:
+                entries = by_class[cls] = []
+            entries.append(entry)
+            for attr in attrs:
+                value = getattr(node, attr, _NodeIndex)
+                if value is _NodeIndex:
+                    continue
+                try:
+                    by_attr.setdefault((cls, attr, value), []).append(entry)
+                except TypeError:
+                    # unhashable value, only found by walking the entries
+                    pass
+        self._by_class = by_class
+        self._by_attr = by_attr
+        # node_class -> the indexed classes that are subclasses of it
+        self._subclasses = {}
+        self.epoch = _mutation_epoch
+
+    def is_current(self):
+        """Returns whether no mutation epoch has started since the build."""
+        return self.epoch == _mutation_epoch
+
+    def find_all(self, node_class, kwargs, pred):
+        """
+        Yields the nodes of (a subclass of) node_class for which pred holds,
+        looking them up by one of kwargs if it is indexed.
+        """
+        classes = self._subclasses.get(node_class)
+        if classes is None:
+            classes = self._subclasses[node_class] = [
+                cls for cls in self._by_class if issubclass(cls, node_class)]
+        lists = None
+        for attr in self.attrs:
+            if attr in kwargs:
+                try:
+                    lists = [self._by_attr.get((cls, attr, kwargs[attr]), ())
+                             for cls in classes]
+                except TypeError:
+                    continue
+                break
+        if lists is None:
+            lists = [self._by_class[cls] for cls in classes]
+        entries = lists[0] if len(lists) == 1 else heapq.merge(*lists)
+        for _, node in entries:
+            if pred(node):
+                yield node
+
+
 class CtreeNode(ast.AST):
-    """Base class for all AST nodes in ctree."""
+    """
+    Base class for all AST nodes in ctree.
+
+    Node classes may declare their fields in __slots__ to keep large trees
+    compact. ast.AST still gives every node a (lazily created) __dict__,
+    so other attributes can be set on any node, and rarely set flags are
+    class-level defaults that only take up space once overridden.
+    """
     _fields = []
+    deleted = False
+    _force_parentheses = False
+    # dotted name of the CodeGenVisitor subclass that generates code for
+    # this family of nodes
+    _codegen_visitor = None
+    # the _NodeIndex of the subtree, if index_nodes() was called
+    _node_index = None
 
     def __init__(self):
         """Initialize a new AST Node."""
         super(CtreeNode, self).__init__()
-        self.deleted = False
-        self._force_parentheses = False
+
+    @classmethod
+    def _slot_names(cls):
+        """Names of all slots declared by cls and its bases."""
+        names = cls.__dict__.get('_all_slots')
+        if names is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name not in names:
+                        names.append(name)
+            names = tuple(names)
+            cls._all_slots = names
+        return names
+
+    def _state(self):
+        """All attributes of this node, from its slots and __dict__."""
+        state = dict(self.__dict__)
+        state.pop('_node_index', None)
+        for name in self._slot_names():
+            try:
+                state[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __reduce__(self):
+        # ast.AST.__reduce__ only saves __dict__, which would drop the
+        # slots in copies and pickles
+        slots = {}
+        for name in self._slot_names():
+            try:
+                slots[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        state = self.__dict__
+        if '_node_index' in state:
+            # copies build their own
+            state = dict(state)
+            del state['_node_index']
+        return type(self), (), (state or None, slots)
 
     def __str__(self):
         return self.codegen()
 
     def codegen(self, indent=0):
-        raise Exception("Node class %s should override codegen()" % type(self))
+        out = []
+        self._codegen_into(out, indent)
+        return "".join(out)
+
+    def _codegen_into(self, out, indent=0):
+        """Appends the program text for this subtree to the list out."""
+        CodeGenVisitor(indent, out)._dispatch(self, indent)
+
+    def write_code(self, stream, indent=0):
+        """
+        Writes the program text for this subtree to the file-like stream,
+        without first building it up as one string.
+        """
+        out = []
+        self._codegen_into(out, indent)
+        stream.writelines(out)
 
     def delete(self):
         self.codegen = self.no_code_gen
+        self._codegen_into = self.no_code_gen
         self.deleted = True
 
     def no_code_gen(self, *args):
@@ -73,8 +229,26 @@ class CtreeNode(ast.AST):
                     return True
             return False
 
+        index = self._node_index
+        if index is not None:
+            if not index.is_current():
+                index.build(self)
+            return index.find_all(node_class, kwargs, pred)
         return self.find_if(pred)
 
+    def index_nodes(self, attrs=('name',)):
+        """
+        Makes find() and find_all() on this node look nodes up in an index
+        of its subtree by class (and by the given attributes), instead of
+        walking the subtree in Python every time; a lookup takes time in the
+        number of matches. The index is built on the next lookup, and again
+        on the first lookup in a new mutation epoch: code that changes the
+        subtree in place other than through ctree's NodeTransformer must
+        call mark_mutated() before looking nodes up again. Returns this node.
+        """
+        self._node_index = _NodeIndex(attrs)
+        return self
+
     def find(self, node_class, **kwargs):
         """
         Returns one node of type 'node_class' whose attributes
@@ -102,10 +276,13 @@ class CtreeNode(ast.AST):
             attr = "_lift_%s" % key
             setattr(self, attr, getattr(self, attr, []) + val)
             type(self)._fields.append(attr)
+        mark_mutated()
 
     def __eq__(self, other):
         """Two nodes are equal if their attributes are equal."""
-        return self.__dict__ == getattr(other, '__dict__', None)
+        if isinstance(other, CtreeNode):
+            return self._state() == other._state()
+        return self._state() == getattr(other, '__dict__', None)
 
 
 
@@ -114,9 +291,7 @@ class CtreeNode(ast.AST):
 
 class CommonNode(CtreeNode):
     """Miscellaneous IR nodes."""
-
-    def codegen(self, indent=0):
-        return CommonCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.nodes.CommonCodeGen"
 
     def label(self):
         return CommonDotGen().visit(self)
@@ -149,13 +324,43 @@ class Project(CommonNode):
         # if resolver.count:
         #     log.info("automatically resolved %d GeneratedPathRef node(s).", resolver.count)
 
-        # transform all files into llvm modules and link them into the master module
-        for f in self.files:
-            submodule = f._compile(f.codegen())
+        # compile all files and link them into the master module. Files
+        # whose backend can link objects (normally all C files) are linked
+        # into a single shared object, so calls between them can resolve
+        # (and, with [jit] LTO, be inlined) and the module is loaded once
+        options = current_build_options()
+        programs = [(f, f.codegen(), options) for f in self.files]
+        linked = [program for program in programs
+                  if program[0]._links_objects()]
+        if len(linked) > 1:
+            separate = [program for program in programs
+                        if not program[0]._links_objects()]
+            objects = self._compile_all(_compile_object_program, linked)
+            cfiles = [program[0] for program in linked]
+            submodules = [cfiles[0]._link(cfiles, objects)] + \
+                self._compile_all(_compile_program, separate)
+        else:
+            submodules = self._compile_all(_compile_program, programs)
+
+        for submodule in submodules:
             if submodule:
                 self._module._link_in(submodule)
         return self._module
 
+    @staticmethod
+    def _compile_all(compile_program, programs):
+        """Maps compile_program over programs, concurrently if allowed."""
+        jobs = ctree.CONFIG.getint('jit', 'COMPILE_JOBS') or cpu_count()
+        jobs = min(jobs, len(programs))
+        if jobs > 1:
+            log.info("compiling %d files with %d jobs", len(programs), jobs)
+            pool = ThreadPool(jobs)
+            try:
+                return pool.map(compile_program, programs)
+            finally:
+                pool.close()
+        return [compile_program(program) for program in programs]
+
     @property
     def module(self):
         if self._module:
@@ -163,6 +368,24 @@ class Project(CommonNode):
         return self.codegen(indent=self.indent)
 
 
+def _compile_program(program):
+    """
+    Compiles one (File, program text, build options) triple of a Project.
+    The build options are passed along explicitly since the compile may
+    run in a pool thread.
+    """
+    f, program_text, options = program
+    with build_options(**options):
+        return f._compile(program_text)
+
+
+def _compile_object_program(program):
+    """Like _compile_program, but compiles the file to an object."""
+    f, program_text, options = program
+    with build_options(**options):
+        return f._compile_object(program_text)
+
+
 class File(CommonNode):
     """Holds a list of statements."""
     _fields = ['body']
@@ -199,10 +422,10 @@ class File(CommonNode):
 
     @property
     def program_hash(self):
-        if not os.path.exists(os.path.join(self.path, self.get_hash_filename())):
-            return False
         if self._program_hash:
             return self._program_hash
+        if not os.path.exists(os.path.join(self.path, self.get_hash_filename())):
+            return False
         with open(os.path.join(self.path, self.get_hash_filename())) as h_file:
             return h_file.read().strip()
 
@@ -212,14 +435,17 @@ class File(CommonNode):
         with open(os.path.join(self.path, self.get_hash_filename()), 'w') as h_file:
             h_file.write(value)
 
-    def codegen(self, *args):
-        """Convert this substree into program text (a string)."""
-        raise Exception("%s should override codegen()." % type(self))
-
     def _compile(self, program_text, compilation_sub_dir):
         """Construct an LLVM module with the translated contents of this file."""
         raise Exception("%s should override _compile()." % type(self))
 
+    def _links_objects(self):
+        """
+        Whether this file can be compiled with _compile_object() and linked
+        with the other such files of its Project by _link().
+        """
+        return False
+
     def get_generated_path_ref(self):
         """Returns an object that can resolve the full file path at compile time."""
         return GeneratedPathRef(self)
@@ -242,7 +468,7 @@ class CommonCodeGen(CodeGenVisitor):
     """Manages conversion of all common nodes to txt."""
 
     def visit_File(self, node):
-        return ";\n".join(map(str, node.body)) + ";\n"
+        return ";\n".join(map(self._gen, node.body)) + ";\n"
 
     def visit_GeneratedPathRef(self, node):
         return '"%s"'% (os.path.join(node.target.path, node.target.get_filename()))
@@ -9,11 +9,7 @@ import hashlib
 class OclNode(CtreeNode):
     """Base class for all OpenCL nodes supported by ctree."""
 
-    def codegen(self, indent=0):
-        """generate ocl code for this node"""
-        from ctree.ocl.codegen import OclCodeGen
-
-        return OclCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.ocl.codegen.OclCodeGen"
 
     def label(self, indent=0):
         """generate dot element for this node"""
@@ -41,8 +37,8 @@ class OclFile(OclNode, File):
         cl_src_file = os.path.join(self.path, self.get_filename())
         if recreate_source:
             log.info('Recreating source')
-            log.info("file for generated OpenCL: %s" % cl_src_file)
-            log.info("generated OpenCL code: (((\n%s\n)))" % program_text)
+            log.info("file for generated OpenCL: %s", cl_src_file)
+            log.info("generated OpenCL code: (((\n%s\n)))", program_text)
 
             # write program text to CL file
             with open(cl_src_file, 'w') as cl_file:
@@ -13,34 +13,34 @@ class OmpCodeGen(CodeGenVisitor):
     def visit_OmpParallel(self, node):
         s = "#pragma omp parallel"
         if node.clauses:
-            s += " " + ", ".join(map(str, node.clauses))
+            s += " " + ", ".join(map(self._gen, node.clauses))
         return s
 
     def visit_OmpParallelFor(self, node):
         s = "#pragma omp parallel for"
         if node.clauses:
-            s += " " + ", ".join(map(str, node.clauses))
+            s += " " + ", ".join(map(self._gen, node.clauses))
         return s
 
     def visit_OmpParallelSections(self, node):
         s = "#pragma omp parallel sections"
         if node.clauses:
-            s += " " + ", ".join(map(str, node.clauses))
-        s += "\n%s%s" % (self._tab(), self._genblock(node.sections))
-        return s
+            s += " " + ", ".join(map(self._gen, node.clauses))
+        self._out.append("%s\n%s" % (s, self._tab()))
+        self._writeblock(node.sections)
 
     def visit_OmpSection(self, node):
         s = "#pragma omp section"
         if node.clauses:
-            s += " " + ", ".join(map(str, node.clauses))
-        s += "\n%s%s" % (self._tab(), self._genblock(node.body))
-        return s
+            s += " " + ", ".join(map(self._gen, node.clauses))
+        self._out.append("%s\n%s" % (s, self._tab()))
+        self._writeblock(node.body)
 
     def visit_OmpIfClause(self, node):
-        return "if(%s)" % node.exp
+        return "if(%s)" % self._gen(node.exp)
 
     def visit_OmpNumThreadsClause(self, node):
-        return "num_threads(%s)" % node.val
+        return "num_threads(%s)" % self._gen(node.val)
 
     def visit_OmpNoWaitClause(self, node):
         return "nowait"
@@ -48,5 +48,5 @@ class OmpCodeGen(CodeGenVisitor):
     def visit_OmpIvDep(self, node):
         s = "#pragma IVDEP"
         if node.clauses:
-          s += " " + ", ".join(map(str, node.clauses))
+          s += " " + ", ".join(map(self._gen, node.clauses))
         return s     
@@ -15,10 +15,7 @@ from ctree.nodes import CtreeNode
 class OmpNode(CtreeNode):
     """Base class for all OpenMP nodes supported by ctree."""
 
-    def codegen(self, indent=0):
-        from ctree.omp.codegen import OmpCodeGen
-
-        return OmpCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.omp.codegen.OmpCodeGen"
 
     def label(self):
         from ctree.omp.dotgen import OmpDotLabeller
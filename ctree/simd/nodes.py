@@ -8,10 +8,7 @@ from ctree.nodes import CtreeNode
 class SimdNode(CtreeNode):
     """Base class for all SIMD nodes supported by ctree."""
 
-    def codegen(self, indent=0):
-        from ctree.sse.codegen import SimdCodeGen
-
-        return SimdCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.simd.codegen.SimdCodeGen"
 
     def label(self):
         from ctree.sse.dotgen import SimdDotLabeller
@@ -0,0 +1,269 @@
+"""
+Content-addressed store for compiled artifacts.
+
+Artifacts are files named by the SHA-512 of everything that determines
+their contents (the program text and the compiler identity and flags), so
+identical kernels produced by different specializers or processes share a
+single file. Entries are published with atomic renames/links and evicted
+least-recently-used first once the store exceeds [jit] STORE_SIZE; the
+artifacts stored under one key (with different extensions, such as a
+header and its precompiled form) are evicted together.
+Artifacts used within the last [jit] STORE_GRACE seconds are never
+evicted, since the process that got them may not have loaded them yet.
+"""
+
+import os
+import shlex
+import hashlib
+import logging
+import time
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+import ctree
+
+log = logging.getLogger(__name__)
+
+_LOCK_FILENAME = ".lock"
+_TEMP_PREFIX = ".tmp-"
+# temporary files older than this (in seconds) were left by writers that
+# died before publishing them
+_STALE_TEMP_AGE = 24 * 60 * 60
+# put() scans the store at least this often (in seconds), even while its
+# own additions keep it within max_size, to catch other processes' ones
+_RESCAN_INTERVAL = 60
+
+# compiler command -> version string
+_COMPILER_IDENTITIES = {}
+
+
+def compiler_identity(compiler):
+    """
+    Returns a string identifying the compiler invoked by the command
+    'compiler', so that upgrading it invalidates stored artifacts.
+    """
+    try:
+        return _COMPILER_IDENTITIES[compiler]
+    except KeyError:
+        pass
+    try:
+        identity = subprocess.check_output(
+            shlex.split(compiler) + ["--version"],
+            stderr=subprocess.STDOUT).decode(errors='replace')
+    except (OSError, subprocess.CalledProcessError):
+        log.warning("could not determine version of compiler '%s'", compiler)
+        identity = compiler
+    _COMPILER_IDENTITIES[compiler] = identity
+    return identity
+
+
+@contextmanager
+def _locked(lock_path):
+    """Holds an exclusive lock on lock_path for the duration of the block."""
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class ArtifactStore(object):
+    """
+    A directory of compiled artifacts keyed by content hash, safe to share
+    between processes.
+    """
+
+    def __init__(self, path, max_size=0, grace=60):
+        """
+        Create a store rooted at 'path' holding at most 'max_size' bytes
+        (0 for no limit), beyond which artifacts that were not used in the
+        last 'grace' seconds are evicted.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.grace = grace
+        # the size of the store as of the last scan, plus what this object
+        # put since; None before the first scan
+        self._size_estimate = None
+        self._scanned = 0
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created concurrently by another process
+                if not os.path.isdir(path):
+                    raise
+
+    @staticmethod
+    def key(*parts):
+        """Returns the key for an artifact determined by 'parts'."""
+        result = hashlib.sha512()
+        for part in parts:
+            result.update(part.encode())
+            result.update(b'\0')
+        return result.hexdigest()
+
+    def entry_path(self, key, ext=".so"):
+        """Returns the path at which the artifact for 'key' is stored."""
+        return os.path.join(self.path, key[:2], key + ext)
+
+    def get(self, key, ext=".so"):
+        """
+        Returns the path of the artifact for 'key', or None if it is not in
+        the store. A hit marks the artifact as recently used.
+        """
+        path = self.entry_path(key, ext)
+        try:
+            os.utime(path, None)
+        except OSError:
+            ctree.STATS.log("artifact store miss")
+            return None
+        ctree.STATS.log("artifact store hit")
+        return path
+
+    def temp_path(self, ext=".so"):
+        """
+        Returns a fresh path inside the store to build an artifact at, so
+        that put() can publish it with a rename.
+        """
+        fd, path = tempfile.mkstemp(prefix=_TEMP_PREFIX, suffix=ext,
+                                    dir=self.path)
+        os.close(fd)
+        return path
+
+    def put(self, key, temp_path, ext=".so"):
+        """
+        Publishes the artifact built at 'temp_path' (from temp_path()) under
+        'key' and returns its final path. If another process published the
+        same artifact first, that copy is kept and temp_path is discarded.
+        """
+        path = self.entry_path(key, ext)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        size = os.path.getsize(temp_path)
+        try:
+            # link() fails rather than replacing an existing entry
+            os.link(temp_path, path)
+        except OSError:
+            if not os.path.exists(path):
+                os.rename(temp_path, path)
+                temp_path = None
+            else:
+                ctree.STATS.log("artifact store duplicate")
+                size = 0
+        if temp_path is not None:
+            os.remove(temp_path)
+        ctree.STATS.log("artifact store put")
+        if self._size_estimate is not None:
+            self._size_estimate += size
+        if self._size_estimate is None or \
+                self.max_size and self._size_estimate > self.max_size or \
+                time.time() - self._scanned > _RESCAN_INTERVAL:
+            self.evict()
+        return path
+
+    def _entries(self):
+        """Yields (path, stat) for every artifact in the store."""
+        for subdir in os.listdir(self.path):
+            subdir_path = os.path.join(self.path, subdir)
+            if subdir.startswith('.') or not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                path = os.path.join(subdir_path, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    # evicted concurrently
+                    pass
+
+    def size(self):
+        """Returns the total size in bytes of all artifacts in the store."""
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _sweep(self):
+        """Removes the temporary files of writers that died long ago."""
+        stale = time.time() - _STALE_TEMP_AGE
+        for name in os.listdir(self.path):
+            if not name.startswith(_TEMP_PREFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if os.stat(path).st_mtime < stale:
+                    log.info("removing stale temporary file %s", path)
+                    os.remove(path)
+            except OSError:
+                # published or removed concurrently
+                pass
+
+    def evict(self):
+        """
+        Removes stale temporary files, and least-recently-used keys (with
+        all their artifacts) until the store fits within max_size. Keys
+        used in the last 'grace' seconds are kept even if the store stays
+        over max_size.
+        """
+        self._sweep()
+        self._scanned = time.time()
+        if not self.max_size:
+            self._size_estimate = 0
+            return
+        with _locked(os.path.join(self.path, _LOCK_FILENAME)):
+            # key -> [time last used, total size, paths]
+            keys = {}
+            total = 0
+            for path, stat in self._entries():
+                key = os.path.basename(path).split('.', 1)[0]
+                entry = keys.setdefault(key, [stat.st_mtime, 0, []])
+                entry[0] = max(entry[0], stat.st_mtime)
+                entry[1] += stat.st_size
+                entry[2].append(path)
+                total += stat.st_size
+            self._size_estimate = total
+            if total <= self.max_size:
+                return
+            recent = time.time() - self.grace
+            for used, size, paths in sorted(keys.values()):
+                if total <= self.max_size or used >= recent:
+                    break
+                for path in paths:
+                    log.info("evicting %s from artifact store", path)
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+                ctree.STATS.log("artifact store eviction")
+            self._size_estimate = total
+
+
+# path -> ArtifactStore
+_STORES = {}
+
+
+def get_store():
+    """Returns the artifact store selected by the [jit] configuration."""
+    path = ctree.CONFIG.get('jit', 'STORE_PATH') or \
+        os.path.join(ctree.CONFIG.get('jit', 'COMPILE_PATH'), 'store')
+    path = os.path.abspath(os.path.expanduser(path))
+    max_size = ctree.CONFIG.getint('jit', 'STORE_SIZE') * 1024 * 1024
+    grace = ctree.CONFIG.getint('jit', 'STORE_GRACE')
+    store = _STORES.get(path)
+    if store is None:
+        store = _STORES[path] = ArtifactStore(path, max_size, grace)
+    store.max_size = max_size
+    store.grace = grace
+    return store
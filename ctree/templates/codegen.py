@@ -19,12 +19,12 @@ class TemplateCodeGen(CodeGenVisitor):
         """
         children = list(flatten(value))
         if len(children) == 1:
-            return children[0].codegen()
+            return self._gen(children[0])
         else:
             body = ""
             for child in children:
                 semicolon_opt = ";" if child._requires_semicolon() else ""
-                body += self._tab() + child.codegen() + semicolon_opt + "\n"
+                body += self._tab() + self._gen(child) + semicolon_opt + "\n"
             return body
 
     def visit_TemplateNode(self, node):
@@ -21,10 +21,7 @@ class TemplateNode(CtreeNode):
         self._fields = child_dict.keys()
         super(TemplateNode, self).__init__()
 
-    def codegen(self, indent=0):
-        from ctree.templates.codegen import TemplateCodeGen
-
-        return TemplateCodeGen(indent).visit(self)
+    _codegen_visitor = "ctree.templates.codegen.TemplateCodeGen"
 
     def label(self):
         from ctree.templates.dotgen import TemplateDotLabeller
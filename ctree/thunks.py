@@ -0,0 +1,408 @@
+"""
+Native call thunks for compiled entry points.
+
+Calling a kernel through ctypes converts and re-validates every argument
+(for ndpointer arguments: dtype, ndim, shape and flags) in Python on each
+call. A thunk is a tiny generated CPython extension function that takes
+the arguments directly, checks arrays through the buffer protocol, and
+calls the C entry point itself. Thunks depend only on the entry point's
+signature, so they are compiled once per signature and cached in the
+artifact store.
+
+Enable them with [jit] THUNKS; signatures a thunk can't express fall back
+to ctypes. The same modules also provide batch functions, which make a
+whole list of calls in one transition from Python (see
+LazySpecializedFunction.batch).
+"""
+
+import os
+import sys
+import shlex
+import ctypes
+import logging
+import sysconfig
+import subprocess
+
+import ctree
+from ctree.store import get_store, compiler_identity
+from ctree.backends import run_compiler
+
+log = logging.getLogger(__name__)
+
+# ctypes scalar type -> (C type, conversion from PyObject *arg)
+_SCALAR_ARGS = {
+    ctypes.c_bool: ("_Bool", "PyObject_IsTrue(%s)"),
+    ctypes.c_byte: ("signed char", "PyLong_AsLong(%s)"),
+    ctypes.c_ubyte: ("unsigned char", "PyLong_AsUnsignedLong(%s)"),
+    ctypes.c_short: ("short", "PyLong_AsLong(%s)"),
+    ctypes.c_ushort: ("unsigned short", "PyLong_AsUnsignedLong(%s)"),
+    ctypes.c_int: ("int", "PyLong_AsLong(%s)"),
+    ctypes.c_uint: ("unsigned int", "PyLong_AsUnsignedLong(%s)"),
+    ctypes.c_long: ("long", "PyLong_AsLong(%s)"),
+    ctypes.c_ulong: ("unsigned long", "PyLong_AsUnsignedLong(%s)"),
+    ctypes.c_longlong: ("long long", "PyLong_AsLongLong(%s)"),
+    ctypes.c_ulonglong: ("unsigned long long",
+                         "PyLong_AsUnsignedLongLong(%s)"),
+    ctypes.c_float: ("float", "PyFloat_AsDouble(%s)"),
+    ctypes.c_double: ("double", "PyFloat_AsDouble(%s)"),
+}
+
+# ctypes return type -> (C type, conversion to PyObject *)
+_SCALAR_RETURNS = {
+    ctypes.c_bool: ("_Bool", "PyBool_FromLong(%s)"),
+    ctypes.c_byte: ("signed char", "PyLong_FromLong(%s)"),
+    ctypes.c_ubyte: ("unsigned char", "PyLong_FromLong(%s)"),
+    ctypes.c_short: ("short", "PyLong_FromLong(%s)"),
+    ctypes.c_ushort: ("unsigned short", "PyLong_FromLong(%s)"),
+    ctypes.c_int: ("int", "PyLong_FromLong(%s)"),
+    ctypes.c_uint: ("unsigned int", "PyLong_FromUnsignedLong(%s)"),
+    ctypes.c_long: ("long", "PyLong_FromLong(%s)"),
+    ctypes.c_ulong: ("unsigned long", "PyLong_FromUnsignedLong(%s)"),
+    ctypes.c_longlong: ("long long", "PyLong_FromLongLong(%s)"),
+    ctypes.c_ulonglong: ("unsigned long long",
+                         "PyLong_FromUnsignedLongLong(%s)"),
+    ctypes.c_float: ("float", "PyFloat_FromDouble(%s)"),
+    ctypes.c_double: ("double", "PyFloat_FromDouble(%s)"),
+}
+
+# array flags from numpy/ndarraytypes.h
+NPY_ARRAY_C_CONTIGUOUS = 0x0001
+NPY_ARRAY_F_CONTIGUOUS = 0x0002
+NPY_ARRAY_WRITEABLE = 0x0400
+
+_SCALAR_CHECK = """\
+    a%(i)d = (%(ctype)s) %(convert)s;
+    if (PyErr_Occurred()) goto done;
+"""
+
+_BUFFER_CHECK = """\
+    if (PyObject_GetBuffer(args[%(i)d], &b%(i)d, %(flags)s) < 0) goto done;
+    n_buffers = %(n)d;
+    if (b%(i)d.itemsize != %(itemsize)d || format_kind(b%(i)d.format) != '%(kind)s') {
+        PyErr_SetString(PyExc_TypeError,
+                        "argument %(i)d: array must have dtype %(dtype)s");
+        goto done;
+    }
+"""
+
+_NDIM_CHECK = """\
+    if (b%(i)d.ndim != %(ndim)d) {
+        PyErr_SetString(PyExc_TypeError,
+                        "argument %(i)d: array must have %(ndim)d dimension(s)");
+        goto done;
+    }
+"""
+
+_SHAPE_CHECK = """\
+    if (b%(i)d.shape[%(dim)d] != %(extent)d) {
+        PyErr_SetString(PyExc_TypeError,
+                        "argument %(i)d: array must have shape %(shape)s");
+        goto done;
+    }
+"""
+
+_CALL = """\
+{
+        %(restype)s value;
+        Py_BEGIN_ALLOW_THREADS
+        value = %(call)s;
+        Py_END_ALLOW_THREADS
+        result = %(convert)s;
+    }"""
+
+_VOID_CALL = """\
+Py_BEGIN_ALLOW_THREADS
+    %(call)s;
+    Py_END_ALLOW_THREADS
+    Py_INCREF(Py_None);
+    result = Py_None;"""
+
+_THUNK_TEMPLATE = """\
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+typedef %(restype)s (*target_t)(%(params)s);
+
+/*
+ * The numpy dtype kind of the items of a buffer with the given struct
+ * module format, or 0 if they are not single numbers in native byte
+ * order. Formats of the same kind and item size are interchangeable
+ * ('l' and 'q' on LP64 systems, say).
+ */
+static char
+format_kind(const char *format)
+{
+    if (format == NULL)
+        return 'u';
+    if (*format == '@' || *format == '=' || *format == '%(byteorder)s')
+        format++;
+    if (*format == 'Z')
+        return format[1] && strchr("efdg", format[1]) && !format[2] ? 'c' : 0;
+    if (!*format || format[1])
+        return 0;
+    if (*format == '?')
+        return 'b';
+    if (strchr("bhilqn", *format))
+        return 'i';
+    if (strchr("BHILQN", *format))
+        return 'u';
+    if (strchr("efdg", *format))
+        return 'f';
+    return 0;
+}
+
+static PyObject *
+call_target(target_t target, PyObject *const *args, Py_ssize_t nargs)
+{
+    PyObject *result = NULL;
+%(locals)s
+    int n_buffers = 0;
+    if (nargs != %(nargs)d) {
+        PyErr_Format(PyExc_TypeError, "expected %(nargs)d argument(s), got %%zd",
+                     nargs);
+        return NULL;
+    }
+%(checks)s
+    %(call)s
+done:
+%(release)s
+    return result;
+}
+
+static PyObject *
+thunk_call(PyObject *self, PyObject *const *args, Py_ssize_t nargs)
+{
+    return call_target((target_t) PyCapsule_GetPointer(self, NULL),
+                       args, nargs);
+}
+
+static PyObject *
+batch_call(PyObject *self, PyObject *batch)
+{
+    target_t target = (target_t) PyCapsule_GetPointer(self, NULL);
+    PyObject *calls, *results, *call_args, *result;
+    Py_ssize_t i, n_calls;
+    calls = PySequence_Fast(batch, "batch must be a sequence of argument tuples");
+    if (calls == NULL)
+        return NULL;
+    n_calls = PySequence_Fast_GET_SIZE(calls);
+    results = PyList_New(n_calls);
+    if (results == NULL)
+        goto error;
+    for (i = 0; i < n_calls; i++) {
+        call_args = PySequence_Fast(PySequence_Fast_GET_ITEM(calls, i),
+                                    "batch items must be argument tuples");
+        if (call_args == NULL)
+            goto error;
+        result = call_target(target, PySequence_Fast_ITEMS(call_args),
+                             PySequence_Fast_GET_SIZE(call_args));
+        Py_DECREF(call_args);
+        if (result == NULL)
+            goto error;
+        PyList_SET_ITEM(results, i, result);
+    }
+    Py_DECREF(calls);
+    return results;
+error:
+    Py_XDECREF(results);
+    Py_DECREF(calls);
+    return NULL;
+}
+
+static PyMethodDef thunk_def = {
+    "thunk", (PyCFunction) (void (*)(void)) thunk_call, METH_FASTCALL, NULL
+};
+
+static PyMethodDef batch_def = {
+    "batch", batch_call, METH_O, NULL
+};
+
+static void
+release_owner(PyObject *capsule)
+{
+    Py_XDECREF((PyObject *) PyCapsule_GetContext(capsule));
+}
+
+static PyObject *
+bind(PyObject *module, PyObject *args)
+{
+    PyObject *address, *owner, *capsule, *thunk;
+    void *target;
+    int batch = 0;
+    if (!PyArg_ParseTuple(args, "OO|p", &address, &owner, &batch))
+        return NULL;
+    target = PyLong_AsVoidPtr(address);
+    if (target == NULL) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_ValueError, "null function pointer");
+        return NULL;
+    }
+    capsule = PyCapsule_New(target, NULL, release_owner);
+    if (capsule == NULL)
+        return NULL;
+    Py_INCREF(owner);
+    PyCapsule_SetContext(capsule, owner);
+    thunk = PyCFunction_New(batch ? &batch_def : &thunk_def, capsule);
+    Py_DECREF(capsule);
+    return thunk;
+}
+
+static PyMethodDef module_methods[] = {
+    {"bind", bind, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef module_def = {
+    PyModuleDef_HEAD_INIT, "@MODULE_NAME@", NULL, -1, module_methods
+};
+
+PyMODINIT_FUNC
+PyInit_@MODULE_NAME@(void)
+{
+    return PyModule_Create(&module_def);
+}
+"""
+
+
+def _is_ndpointer(argtype):
+    return hasattr(argtype, '_dtype_') and hasattr(argtype, '_ndim_')
+
+
+def thunk_source(entry_point_typesig):
+    """
+    Returns the C source of a thunk module for entry_point_typesig, with
+    the module name left as the @MODULE_NAME@ placeholder. Raises
+    NotImplementedError for signatures that thunks don't support.
+    """
+    argtypes = entry_point_typesig._argtypes_ or ()
+    restype = entry_point_typesig._restype_
+
+    params, local_decls, checks, call_args, releases = [], [], [], [], []
+    n_buffers = 0
+    for i, argtype in enumerate(argtypes):
+        if argtype in _SCALAR_ARGS:
+            ctype, convert = _SCALAR_ARGS[argtype]
+            params.append(ctype)
+            local_decls.append("    %s a%d;" % (ctype, i))
+            checks.append(_SCALAR_CHECK % {
+                'i': i, 'ctype': ctype, 'convert': convert % ("args[%d]" % i)})
+            call_args.append("a%d" % i)
+        elif _is_ndpointer(argtype):
+            dtype = argtype._dtype_
+            if dtype is None:
+                raise NotImplementedError("ndpointer without a dtype")
+            flags = argtype._flags_ or 0
+            buffer_flags = ["PyBUF_FORMAT"]
+            if flags & NPY_ARRAY_C_CONTIGUOUS:
+                buffer_flags.append("PyBUF_C_CONTIGUOUS")
+            elif flags & NPY_ARRAY_F_CONTIGUOUS:
+                buffer_flags.append("PyBUF_F_CONTIGUOUS")
+            else:
+                buffer_flags.append("PyBUF_STRIDES")
+            if flags & NPY_ARRAY_WRITEABLE:
+                buffer_flags.append("PyBUF_WRITABLE")
+            n_buffers += 1
+            params.append("void *")
+            local_decls.append("    Py_buffer b%d;" % i)
+            checks.append(_BUFFER_CHECK % {
+                'i': i, 'n': n_buffers, 'flags': " | ".join(buffer_flags),
+                'itemsize': dtype.itemsize, 'kind': dtype.kind,
+                'dtype': dtype.name})
+            if argtype._ndim_ is not None:
+                checks.append(_NDIM_CHECK % {'i': i, 'ndim': argtype._ndim_})
+            if argtype._shape_ is not None:
+                for dim, extent in enumerate(argtype._shape_):
+                    checks.append(_SHAPE_CHECK % {
+                        'i': i, 'dim': dim, 'extent': extent,
+                        'shape': tuple(argtype._shape_)})
+            call_args.append("b%d.buf" % i)
+            releases.append("    if (n_buffers >= %d) PyBuffer_Release(&b%d);"
+                            % (n_buffers, i))
+        else:
+            raise NotImplementedError("no thunk conversion for %s" % argtype)
+
+    # the kernel runs without the GIL, as it does when called by ctypes
+    call = "target(%s)" % ", ".join(call_args)
+    if restype is None:
+        c_restype = "void"
+        call = _VOID_CALL % {'call': call}
+    elif restype in _SCALAR_RETURNS:
+        c_restype, convert = _SCALAR_RETURNS[restype]
+        call = _CALL % {'restype': c_restype, 'call': call,
+                        'convert': convert % "value"}
+    else:
+        raise NotImplementedError("no thunk conversion for %s" % restype)
+
+    return _THUNK_TEMPLATE % {
+        'restype': c_restype,
+        'params': ", ".join(params) or "void",
+        'locals': "\n".join(local_decls),
+        'nargs': len(argtypes),
+        'checks': "".join(checks),
+        'call': call,
+        'release': "\n".join(reversed(releases)),
+        'byteorder': '<' if sys.byteorder == 'little' else '>',
+    }
+
+
+# module name -> loaded thunk module
+_THUNK_MODULES = {}
+
+
+def _load_extension(name, path):
+    import importlib.machinery
+    import importlib.util
+    loader = importlib.machinery.ExtensionFileLoader(name, path)
+    spec = importlib.util.spec_from_file_location(name, path, loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def get_thunk_module(entry_point_typesig):
+    """Returns the (compiled and loaded) thunk module for a signature."""
+    source = thunk_source(entry_point_typesig)
+    CC = ctree.CONFIG.get('c', 'CC')
+    include = sysconfig.get_paths()['include']
+    store = get_store()
+    key = store.key(source, compiler_identity(CC), CC, include)
+    name = "_ctree_thunk_%s" % key[:16]
+    module = _THUNK_MODULES.get(name)
+    if module is not None:
+        return module
+
+    so_file = store.get(key)
+    if so_file is None:
+        tmp_so_file = store.temp_path()
+        compile_cmd = shlex.split(CC) + [
+            "-shared", "-fPIC", "-O2", "-I", include, "-o", tmp_so_file,
+            "-x", "c", "-"]
+        log.info("thunk compilation command: %s", " ".join(compile_cmd))
+        try:
+            run_compiler(compile_cmd, source.replace('@MODULE_NAME@', name))
+        except subprocess.CalledProcessError:
+            os.remove(tmp_so_file)
+            raise
+        so_file = store.put(key, tmp_so_file)
+    module = _THUNK_MODULES[name] = _load_extension(name, so_file)
+    return module
+
+
+def make_thunk(c_function, entry_point_typesig, batch=False):
+    """
+    Returns a thunk calling the ctypes function c_function, or None if its
+    signature isn't supported (the caller should keep using c_function).
+    With batch=True the thunk instead takes a sequence of argument tuples
+    and returns the list of results, calling c_function from a C loop.
+    """
+    if sys.version_info < (3, 7):
+        return None  # METH_FASTCALL
+    try:
+        module = get_thunk_module(entry_point_typesig)
+    except NotImplementedError as e:
+        log.info("not using a call thunk: %s", e)
+        return None
+    address = ctypes.cast(c_function, ctypes.c_void_p).value
+    ctree.STATS.log("batch thunk created" if batch else "call thunk created")
+    return module.bind(address, c_function, batch)
@@ -43,6 +43,7 @@ class PyCtxScrubber(NodeTransformer):
     Removes pesky ctx attributes from Python ast.Name nodes,
     yielding much cleaner python asts.
     """
+    fusable = True
 
     def visit_Name(self, node):
         node.ctx = None
@@ -398,6 +399,7 @@ class ResolveGeneratedPathRefs(NodeTransformer):
     Converts any instances of ctree.nodes.GeneratedPathRef into strings
     containing the absolute path of the target file.
     """
+    fusable = True
 
     def __init__(self, compilation_dir):
         self.compilation_dir = compilation_dir
@@ -1,2 +1,3 @@
 from ctree.transforms.constant_fold import ConstantFold
 from ctree.transforms.declaration_filler import DeclarationFiller
+from ctree.transforms.pass_manager import PassManager
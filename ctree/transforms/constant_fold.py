@@ -1,54 +1,631 @@
-import ctree.c.nodes as C
+"""
+Constant folding and algebraic simplification of C expressions.
+
+Constants are folded with C's semantics: integer literals are ints (or
+longs, if they do not fit), operands go through the usual arithmetic
+conversions, integer division truncates, and unsigned types wrap around.
+Expressions whose value C leaves undefined (signed overflow, division by
+zero, shifts past the width of a type, ...) are left for the compiler.
+"""
+
 import ast
+import copy
+import ctypes
+import math
+import struct
+
+import ctree.c.nodes as C
+from ctree.visitors import NodeTransformer
+
+Op = C.Op
+
+try:
+    _INTEGER_VALUES = (int, long)
+except NameError:
+    # python 3
+    _INTEGER_VALUES = (int,)
+
+
+# -----------------------------------------------------------------------------
+# arithmetic types
+
+# integer ctypes -> (conversion rank, width in bits, whether signed)
+_INTEGERS = {}
+for _rank, _types in enumerate([(ctypes.c_byte, ctypes.c_ubyte),
+                                (ctypes.c_short, ctypes.c_ushort),
+                                (ctypes.c_int, ctypes.c_uint),
+                                (ctypes.c_long, ctypes.c_ulong),
+                                (ctypes.c_longlong, ctypes.c_ulonglong)]):
+    for _type in _types:
+        _INTEGERS[_type] = (_rank + 1, 8 * ctypes.sizeof(_type),
+                            _type(-1).value < 0)
+_INTEGERS[ctypes.c_bool] = (0, 1, False)
+
+# signed integer ctypes -> the unsigned type of the same rank
+_UNSIGNED = {ctypes.c_byte: ctypes.c_ubyte, ctypes.c_short: ctypes.c_ushort,
+             ctypes.c_int: ctypes.c_uint, ctypes.c_long: ctypes.c_ulong,
+             ctypes.c_longlong: ctypes.c_ulonglong}
+
+# long double is left alone, Python cannot compute with it
+_FLOATS = (ctypes.c_float, ctypes.c_double)
+
+
+def _range(cls):
+    _, bits, signed = _INTEGERS[cls]
+    if signed:
+        return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    return 0, (1 << bits) - 1
+
+
+def _isfinite(value):
+    return not (math.isinf(value) or math.isnan(value))
+
+
+def _to_float(value):
+    """value rounded to single precision, or None if it overflows."""
+    try:
+        return struct.unpack('f', struct.pack('f', value))[0]
+    except OverflowError:
+        return None
+
+
+def _literal_type(value):
+    """The type C gives value written as a literal, or None if it cannot be."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, _INTEGER_VALUES):
+        # the literal is the magnitude, negated
+        magnitude = abs(value)
+        for cls in (ctypes.c_int, ctypes.c_long, ctypes.c_longlong):
+            if magnitude <= _range(cls)[1]:
+                return cls
+        return None
+    if isinstance(value, float) and _isfinite(value):
+        return ctypes.c_double
+    return None
+
+
+def _promote(cls):
+    """The integer promotion of cls."""
+    if cls in _INTEGERS and _INTEGERS[cls][0] < _INTEGERS[ctypes.c_int][0]:
+        return ctypes.c_int
+    return cls
+
+
+def _common_type(left, right):
+    """The type of left and right after the usual arithmetic conversions."""
+    for cls in reversed(_FLOATS):
+        if left is cls or right is cls:
+            return cls
+    left, right = _promote(left), _promote(right)
+    if left is right:
+        return left
+    left_rank, left_bits, left_signed = _INTEGERS[left]
+    right_rank, right_bits, right_signed = _INTEGERS[right]
+    if left_signed == right_signed:
+        return left if left_rank >= right_rank else right
+    signed, unsigned = (left, right) if left_signed else (right, left)
+    signed_rank, signed_bits, _ = _INTEGERS[signed]
+    unsigned_rank, unsigned_bits, _ = _INTEGERS[unsigned]
+    if unsigned_rank >= signed_rank:
+        return unsigned
+    if signed_bits > unsigned_bits:
+        return signed
+    return _UNSIGNED[signed]
 
 
-op_map = {
-    C.Op.Add: lambda x, y: x + y,
-    C.Op.Div: lambda x, y: x / y,
-    C.Op.Mul: lambda x, y: x * y,
-    C.Op.Lt: lambda x, y: x < y,
-    C.Op.Sub: lambda x, y: x - y,
+def _convert(value, cls):
+    """
+    value converted to type cls, or None if that is undefined or yields no
+    finite value.
+    """
+    if cls is ctypes.c_bool:
+        return int(value != 0)
+    if cls in _INTEGERS:
+        if isinstance(value, float):
+            if not _isfinite(value):
+                return None
+            value = int(value)
+            low, high = _range(cls)
+            return value if low <= value <= high else None
+        return _wrap(value, cls)
+    value = float(value)
+    if cls is ctypes.c_float:
+        value = _to_float(value)
+    return value if value is not None and _isfinite(value) else None
+
+
+def _wrap(value, cls):
+    """The integer value converted to integer type cls, modulo its width."""
+    low, high = _range(cls)
+    return (value - low) % (high - low + 1) + low
+
+
+def _result(value, cls):
+    """
+    The result of an operation in type cls, whose exact value is value, or
+    None if it overflows a signed or floating type.
+    """
+    if value is None:
+        return None
+    if cls in _INTEGERS:
+        if not _INTEGERS[cls][2]:
+            return _wrap(value, cls)
+        low, high = _range(cls)
+        return value if low <= value <= high else None
+    return _convert(value, cls)
+
+
+def _trunc_div(left, right):
+    quotient = abs(left) // abs(right)
+    return quotient if (left < 0) == (right < 0) else -quotient
+
+
+def _div(left, right, cls):
+    if right == 0:
+        return None
+    if cls in _FLOATS:
+        return left / right
+    return _trunc_div(left, right)
+
+
+def _mod(left, right, cls):
+    if right == 0 or cls in _FLOATS or \
+            _result(_trunc_div(left, right), cls) is None:
+        return None
+    return left - right * _trunc_div(left, right)
+
+
+def _bitwise(operation):
+    def fold(left, right, cls):
+        if cls in _FLOATS:
+            return None
+        return operation(left, right)
+    return fold
+
+
+# operators applied to both operands after the usual arithmetic conversions:
+# op class -> (function of the converted values and their type, whether the
+# result is an int truth value rather than of their type)
+_ARITHMETIC = {
+    Op.Add: (lambda x, y, cls: x + y, False),
+    Op.Sub: (lambda x, y, cls: x - y, False),
+    Op.Mul: (lambda x, y, cls: x * y, False),
+    Op.Div: (_div, False),
+    Op.Mod: (_mod, False),
+    Op.BitAnd: (_bitwise(lambda x, y: x & y), False),
+    Op.BitOr: (_bitwise(lambda x, y: x | y), False),
+    Op.BitXor: (_bitwise(lambda x, y: x ^ y), False),
+    Op.Lt: (lambda x, y, cls: x < y, True),
+    Op.Gt: (lambda x, y, cls: x > y, True),
+    Op.LtE: (lambda x, y, cls: x <= y, True),
+    Op.GtE: (lambda x, y, cls: x >= y, True),
+    Op.Eq: (lambda x, y, cls: x == y, True),
+    Op.NotEq: (lambda x, y, cls: x != y, True),
 }
 
 
-class ConstantFold(ast.NodeTransformer):
-    """ TODO: Support all folding situations """
+def fold_binary(op_class, left, right):
+    """
+    Folds a binary operator on two constants, given as (value, type) pairs.
+    Returns the (value, type) of the result, or None if it cannot be folded.
+    """
+    (left_value, left_type), (right_value, right_type) = left, right
+    if op_class in _ARITHMETIC:
+        operation, truth = _ARITHMETIC[op_class]
+        cls = _common_type(left_type, right_type)
+        left_value = _convert(left_value, cls)
+        right_value = _convert(right_value, cls)
+        if left_value is None or right_value is None:
+            return None
+        value = operation(left_value, right_value, cls)
+        if truth:
+            return int(value), ctypes.c_int
+        value = _result(value, cls)
+        return None if value is None else (value, cls)
+    if op_class is Op.And:
+        return int(left_value != 0 and right_value != 0), ctypes.c_int
+    if op_class is Op.Or:
+        return int(left_value != 0 or right_value != 0), ctypes.c_int
+    if op_class in (Op.BitShL, Op.BitShR):
+        if left_type in _FLOATS or right_type in _FLOATS:
+            return None
+        # each operand is promoted on its own
+        cls = _promote(left_type)
+        value = _convert(left_value, cls)
+        if not 0 <= right_value < _INTEGERS[cls][1]:
+            return None
+        if op_class is Op.BitShR:
+            # gcc shifts negative values arithmetically
+            return value >> right_value, cls
+        if value < 0:
+            return None
+        value = _result(value << right_value, cls)
+        return None if value is None else (value, cls)
+    return None
+
+
+def fold_unary(op_class, arg):
+    """Like fold_binary, for unary operators."""
+    value, cls = arg
+    if op_class is Op.Not:
+        return int(value == 0), ctypes.c_int
+    if op_class not in (Op.AddUnary, Op.SubUnary, Op.BitNot) or \
+            (op_class is Op.BitNot and cls in _FLOATS):
+        return None
+    cls = _promote(cls)
+    value = _convert(value, cls)
+    if op_class is Op.SubUnary:
+        value = _result(-value, cls)
+    elif op_class is Op.BitNot:
+        value = _result(~value, cls)
+    return None if value is None else (value, cls)
+
+
+# -----------------------------------------------------------------------------
+# between nodes and (value, type) pairs
+
+def constant(node):
+    """
+    The (value, type) of node if it is an arithmetic constant (a Constant,
+    or a Constant cast to an arithmetic type), or None.
+    """
+    if type(node) is C.Constant:
+        cls = _literal_type(node.value)
+        return None if cls is None else (node.value, cls)
+    if type(node) is C.Cast and type(node.value) in (C.Constant, C.Cast):
+        cls = type(node.type)
+        inner = constant(node.value)
+        if inner is not None and (cls in _INTEGERS or cls in _FLOATS):
+            value = _convert(inner[0], cls)
+            return None if value is None else (value, cls)
+    return None
+
+
+def to_node(value, cls):
+    """
+    A node for the constant value of type cls (a Constant, cast to cls if
+    its literal would have another type), or None if there is none.
+    """
+    literal = _literal_type(value)
+    if literal is None:
+        return None
+    if literal is cls:
+        return C.Constant(value)
+    return C.Cast(cls(), C.Constant(value))
+
+
+def _pure(node):
+    """Whether evaluating node has no side effects."""
+    for child in ast.walk(node):
+        if isinstance(child, (C.FunctionCall, C.AugAssign)) or \
+                isinstance(child, C.BinaryOp) and \
+                isinstance(child.op, Op.Assign) or \
+                isinstance(child, C.UnaryOp) and \
+                isinstance(child.op, (Op.PreInc, Op.PreDec,
+                                      Op.PostInc, Op.PostDec)):
+            return False
+    return True
+
+
+def _is_int(node, value):
+    """Whether node is the int constant value."""
+    return constant(node) == (value, ctypes.c_int)
+
+
+_TRUTH_OPERATORS = (Op.Lt, Op.Gt, Op.LtE, Op.GtE, Op.Eq, Op.NotEq, Op.And,
+                    Op.Or)
+
+
+def _known_type(node):
+    """
+    The arithmetic type of the expression node, as far as it follows from
+    its constants, casts and typed symbols, or None if it is not known.
+    """
+    value = constant(node)
+    if value is not None:
+        return value[1]
+    if isinstance(node, (C.Cast, C.SymbolRef)):
+        cls = type(node.type)
+        return cls if cls in _INTEGERS or cls in _FLOATS else None
+    if isinstance(node, C.UnaryOp):
+        if isinstance(node.op, Op.Not):
+            return ctypes.c_int
+        if isinstance(node.op, (Op.AddUnary, Op.SubUnary, Op.BitNot)):
+            arg = _known_type(node.arg)
+            return arg and _promote(arg)
+    elif isinstance(node, C.BinaryOp):
+        op_class = type(node.op)
+        if op_class in _TRUTH_OPERATORS:
+            return ctypes.c_int
+        if op_class in (Op.BitShL, Op.BitShR):
+            left = _known_type(node.left)
+            return left and _promote(left)
+        if op_class in _ARITHMETIC:
+            left, right = _known_type(node.left), _known_type(node.right)
+            return left and right and _common_type(left, right)
+    elif isinstance(node, C.TernaryOp):
+        then, elze = _known_type(node.then), _known_type(node.elze)
+        return then and elze and _common_type(then, elze)
+    return None
+
+
+def _keeps_type(node, cls=None):
+    """
+    Whether combining node with an int leaves its type as it is (or turns
+    it into cls instead, if given), as far as its type is known.
+    """
+    known = _known_type(node)
+    return known is None or \
+        _common_type(known, ctypes.c_int) is (cls or known)
+
+
+# binary operators whose operands must be integers
+_INTEGER_OPERANDS = (Op.Mod, Op.BitAnd, Op.BitOr, Op.BitXor, Op.BitShL,
+                     Op.BitShR)
+
+
+class ConstantFold(NodeTransformer):
+    """
+    Folds constant expressions, and simplifies others (x + 0, x * 1,
+    0 && x, ...). In expressions that are known to be integers (array
+    subscripts, operands of %, bitwise operators, ...), sums and products
+    are also reassociated to combine their constant terms: a[i + 1 + 2]
+    becomes a[i + 3]. Floating-point expressions are never reassociated.
+    """
+    fusable = True
+
+    # the identities below only drop int constants, and not where the
+    # other operand is known to be of a type the result would not keep;
+    # x * 0 and 0 - x not for floating x either (they may be -0.0 or NaN,
+    # and +0.0)
+
     def fold_add(self, node):
-        if isinstance(node.left, C.Constant) and node.left.value == 0:
+        if _is_int(node.left, 0) and _keeps_type(node.right):
             return node.right
-        elif isinstance(node.right, C.Constant) and node.right.value == 0:
+        elif _is_int(node.right, 0) and _keeps_type(node.left):
             return node.left
         return node
 
     def fold_sub(self, node):
-        if isinstance(node.left, C.Constant) and node.left.value == 0:
+        if _is_int(node.left, 0) and \
+                _known_type(node.right) not in _FLOATS:
             return C.Sub(node.right)
-        elif isinstance(node.right, C.Constant) and node.right.value == 0:
+        elif _is_int(node.right, 0) and _keeps_type(node.left):
             return node.left
         return node
 
     def fold_mul(self, node):
-        if isinstance(node.left, C.Constant) and node.left.value == 1:
+        if _is_int(node.left, 1) and _keeps_type(node.right):
             return node.right
-        elif isinstance(node.right, C.Constant) and node.right.value == 1:
+        elif _is_int(node.right, 1) and _keeps_type(node.left):
+            return node.left
+        elif _is_int(node.left, 0) and _pure(node.right) and \
+                _keeps_type(node.right, ctypes.c_int):
             return node.left
-        elif isinstance(node.left, C.Constant) and node.left.value == 0:
+        elif _is_int(node.right, 0) and _pure(node.left) and \
+                _keeps_type(node.left, ctypes.c_int):
+            return node.right
+        return node
+
+    def fold_div(self, node):
+        if _is_int(node.right, 1) and _keeps_type(node.left):
             return node.left
-        elif isinstance(node.right, C.Constant) and node.right.value == 0:
+        return node
+
+    def fold_logic(self, node):
+        left = constant(node.left)
+        if left is not None:
+            # the right operand is not evaluated
+            if isinstance(node.op, Op.And) and left[0] == 0:
+                return C.Constant(0)
+            if isinstance(node.op, Op.Or) and left[0] != 0:
+                return C.Constant(1)
+        return node
+
+    def fold_comma(self, node):
+        if _pure(node.left):
             return node.right
         return node
 
     def visit_BinaryOp(self, node):
-        node.left = self.visit(node.left)
-        node.right = self.visit(node.right)
-        if isinstance(node.left, C.Constant) and \
-                isinstance(node.right, C.Constant):
-            return C.Constant(op_map[node.op.__class__](
-                node.left.value, node.right.value))
-        elif isinstance(node.op, C.Op.Add):
+        self.generic_visit(node)
+        op_class = type(node.op)
+        left, right = constant(node.left), constant(node.right)
+        if left is not None and right is not None:
+            folded = fold_binary(op_class, left, right)
+            folded = folded and to_node(*folded)
+            if folded is not None:
+                return folded
+        if op_class is Op.ArrayRef:
+            node = _replace(node, right=_reassociate(node.right))
+        elif op_class in _INTEGER_OPERANDS:
+            node = _replace(node, left=_reassociate(node.left),
+                            right=_reassociate(node.right))
+        return self._simplify(node, op_class)
+
+    def _simplify(self, node, op_class):
+        if op_class is Op.Add:
             return self.fold_add(node)
-        elif isinstance(node.op, C.Op.Sub):
+        elif op_class is Op.Sub:
             return self.fold_sub(node)
-        elif isinstance(node.op, C.Op.Mul):
+        elif op_class is Op.Mul:
             return self.fold_mul(node)
+        elif op_class is Op.Div:
+            return self.fold_div(node)
+        elif op_class in (Op.And, Op.Or):
+            return self.fold_logic(node)
+        elif op_class is Op.Comma:
+            return self.fold_comma(node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        arg = constant(node.arg)
+        if arg is not None:
+            folded = fold_unary(type(node.op), arg)
+            folded = folded and to_node(*folded)
+            if folded is not None:
+                return folded
+        elif isinstance(node.op, Op.SubUnary) and \
+                isinstance(node.arg, C.UnaryOp) and \
+                isinstance(node.arg.op, Op.SubUnary) and \
+                _keeps_type(node.arg.arg):
+            return node.arg.arg
+        return node
+
+    def visit_Cast(self, node):
+        self.generic_visit(node)
+        folded = constant(node)
+        if folded is None or folded == constant(node.value):
+            return node
+        return to_node(*folded) or node
+
+    def visit_TernaryOp(self, node):
+        self.generic_visit(node)
+        cond = constant(node.cond)
+        if cond is None:
+            return node
+        chosen, dropped = (node.then, node.elze) if cond[0] != 0 else \
+            (node.elze, node.then)
+        chosen_value, dropped_value = constant(chosen), constant(dropped)
+        if chosen_value is not None and dropped_value is not None:
+            # the result has the common type of both
+            cls = _common_type(chosen_value[1], dropped_value[1])
+            value = _convert(chosen_value[0], cls)
+            return (value is not None and to_node(value, cls)) or node
+        if dropped_value is not None and dropped_value[1] is ctypes.c_int \
+                and _keeps_type(chosen):
+            return chosen
+        return node
+
+
+# -----------------------------------------------------------------------------
+# reassociation of integer expressions
+
+def _replace(node, **fields):
+    """
+    node, or a copy of it with the given fields if they differ (nodes are
+    not changed in place, see PassManager).
+    """
+    if all(getattr(node, name) is value for name, value in fields.items()):
+        return node
+    node = copy.copy(node)
+    for name, value in fields.items():
+        setattr(node, name, value)
+    return node
+
+
+def _reassociate(node):
+    """
+    Returns node, an expression known to have an integer type, with the
+    constant terms of its sums and factors of its products combined.
+    """
+    if isinstance(node, C.BinaryOp):
+        op_class = type(node.op)
+        if op_class in (Op.Add, Op.Sub):
+            return _reassociate_sum(node)
+        if op_class is Op.Mul:
+            return _reassociate_product(node)
+        if op_class is Op.Div or op_class in _INTEGER_OPERANDS:
+            return _replace(node, left=_reassociate(node.left),
+                            right=_reassociate(node.right))
+    elif isinstance(node, C.UnaryOp) and \
+            isinstance(node.op, (Op.SubUnary, Op.BitNot)):
+        return _replace(node, arg=_reassociate(node.arg))
+    return node
+
+
+def _terms(node, sign, terms):
+    if isinstance(node, C.BinaryOp) and isinstance(node.op, (Op.Add, Op.Sub)):
+        _terms(node.left, sign, terms)
+        _terms(node.right, -sign if isinstance(node.op, Op.Sub) else sign,
+               terms)
+    elif isinstance(node, C.UnaryOp) and isinstance(node.op, Op.SubUnary):
+        _terms(node.arg, -sign, terms)
+    else:
+        terms.append((sign, node))
+    return terms
+
+
+def _combine(values, operation, start):
+    """
+    Combines the constants values, given as (value, type), exactly with
+    operation. Returns the result, or None unless they are all ints and so
+    is the result. Constants of other types are not combined: that would
+    take their own type instead of that of the other terms, e.g. with a
+    64-bit n, n * (unsigned) 65536 * (unsigned) 65536 is not n * 0.
+    """
+    total = start
+    for value, value_type in values:
+        if value_type is not ctypes.c_int:
+            return None
+        total = operation(total, value)
+    return _result(total, ctypes.c_int)
+
+
+def _reassociate_sum(node):
+    constants, others = [], []
+    # whether the sum is written otherwise than it would be rewritten
+    changed = False
+    for sign, term in _terms(node, 1, []):
+        value = constant(term)
+        if value is None:
+            new_term = _reassociate(term)
+            changed = changed or new_term is not term
+            others.append((sign, new_term))
+        else:
+            # i + -2 becomes i - 2
+            changed = changed or sign > 0 and value[0] < 0
+            constants.append((sign * value[0], value[1]))
+    if not others or not changed and len(constants) < 2 and \
+            not any(value == 0 for value, _ in constants):
+        return node
+    value = _combine(constants, lambda x, y: x + y, 0)
+    if value is None:
+        return node
+    result = None
+    for sign, term in others:
+        if result is None:
+            result = term if sign > 0 else C.Sub(term)
+        else:
+            result = C.Add(result, term) if sign > 0 else C.Sub(result, term)
+    if value == 0:
+        return result
+    if value < 0 and _result(-value, ctypes.c_int) is not None:
+        return C.Sub(result, C.Constant(-value))
+    return C.Add(result, to_node(value, ctypes.c_int))
+
+
+def _factors(node, factors):
+    if isinstance(node, C.BinaryOp) and isinstance(node.op, Op.Mul):
+        _factors(node.left, factors)
+        _factors(node.right, factors)
+    else:
+        factors.append(node)
+    return factors
+
+
+def _reassociate_product(node):
+    constants, others = [], []
+    changed = False
+    for factor in _factors(node, []):
+        value = constant(factor)
+        if value is None:
+            new_factor = _reassociate(factor)
+            changed = changed or new_factor is not factor
+            others.append(new_factor)
+        else:
+            constants.append(value)
+    if not others or not changed and len(constants) < 2 and \
+            not any(value == 1 for value, _ in constants):
+        return node
+    value = _combine(constants, lambda x, y: x * y, 1)
+    if value is None:
         return node
+    result = others[0]
+    for factor in others[1:]:
+        result = C.Mul(result, factor)
+    if value == 1:
+        return result
+    return C.Mul(result, to_node(value, ctypes.c_int))
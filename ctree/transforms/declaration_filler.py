@@ -1,9 +1,9 @@
-import ast
 import ctree.c.nodes as C
 import ctypes as ct
+from ctree.visitors import NodeTransformer
 
 
-class DeclarationFiller(ast.NodeTransformer):
+class DeclarationFiller(NodeTransformer):
     def __init__(self):
         self.__environments = [{}]
 
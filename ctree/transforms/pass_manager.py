@@ -0,0 +1,337 @@
+"""
+A pass manager for running a sequence of ast.NodeTransformers over a tree.
+
+Passes declare the node classes they are interested in (by default, those
+they have visit_ methods for). Consecutive passes marked 'fusable' share one
+traversal, which also records what is below each node, so the passes after
+it skip the subtrees they have nothing to do in.
+"""
+
+import ast
+import collections
+import logging
+import time
+
+from ctree.nodes import mark_mutated
+from ctree.visitors import NodeTransformer
+
+log = logging.getLogger(__name__)
+
+# ast.NodeVisitor.visit_Constant dispatches to these for old visitors
+_LEGACY_CONSTANT_VISITORS = ('visit_Num', 'visit_Str', 'visit_Bytes',
+                             'visit_NameConstant', 'visit_Ellipsis')
+
+
+def _visit_method(transformer, class_name):
+    """
+    The visit method transformer has for nodes named class_name, or None
+    if it leaves them to generic_visit.
+    """
+    method = getattr(transformer, "visit_" + class_name, None)
+    if class_name == 'Constant' and method is not None and \
+            getattr(type(transformer), 'visit_Constant') is \
+            getattr(ast.NodeVisitor, 'visit_Constant', None) and \
+            not any(hasattr(transformer, legacy)
+                    for legacy in _LEGACY_CONSTANT_VISITORS):
+        return None
+    return method
+
+
+def interests(transformer):
+    """
+    Returns the names of the node classes transformer is interested in: its
+    'interests' attribute (classes or names), or else the classes it has
+    visit_ methods for. Returns None, for all classes, if it overrides
+    visit() or generic_visit().
+    """
+    declared = getattr(transformer, 'interests', None)
+    if declared is not None:
+        return frozenset(cls if isinstance(cls, str) else cls.__name__
+                         for cls in declared)
+    cls = type(transformer)
+    if cls.visit is not ast.NodeVisitor.visit or \
+            cls.generic_visit not in (ast.NodeVisitor.generic_visit,
+                                      ast.NodeTransformer.generic_visit,
+                                      NodeTransformer.generic_visit):
+        return None
+    return frozenset(name[len("visit_"):] for name in dir(cls)
+                     if name.startswith("visit_") and
+                     _visit_method(transformer, name[len("visit_"):]))
+
+
+class _ClassMasks(dict):
+    """
+    Maps node classes to the masks of the passes interested in them, given
+    the masks for class names and the mask of the passes interested in all.
+    """
+
+    def __init__(self, name_masks, all_mask):
+        dict.__init__(self)
+        self._name_masks = name_masks
+        self._all_mask = all_mask
+
+    def __missing__(self, cls):
+        mask = self[cls] = self._name_masks.get(cls.__name__, 0) | \
+            self._all_mask
+        return mask
+
+
+class _Summary(object):
+    """
+    Records, for nodes of a tree, a bit mask of the passes interested in any
+    of the nodes below them, given the _ClassMasks. Nodes that were not
+    recorded count as holding anything.
+    """
+
+    def __init__(self, masks):
+        self._masks = masks
+        self._below = {}
+        # keeps the recorded nodes alive, so no new node can reuse an id
+        self._nodes = []
+
+    def below(self, node):
+        """The mask of the nodes below node."""
+        return self._below.get(id(node), -1)
+
+    def record(self, node, below):
+        if id(node) not in self._below:
+            self._nodes.append(node)
+        self._below[id(node)] = below
+
+    def summarize(self, node):
+        """
+        Records node and the nodes below it that are not recorded yet, and
+        returns the mask of node and the nodes below it.
+        """
+        below = 0
+        summary = self._below
+        masks = self._masks
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for child in value:
+                    if isinstance(child, ast.AST):
+                        child_below = summary.get(id(child))
+                        if child_below is None:
+                            below |= self.summarize(child)
+                        else:
+                            below |= child_below | masks[type(child)]
+            elif isinstance(value, ast.AST):
+                child_below = summary.get(id(value))
+                if child_below is None:
+                    below |= self.summarize(value)
+                else:
+                    below |= child_below | masks[type(value)]
+        if id(node) not in summary:
+            self._nodes.append(node)
+        summary[id(node)] = below
+        return below | masks[type(node)]
+
+    def known_within(self, node):
+        """
+        The mask of node and the nodes below it, which are recorded first
+        if need be.
+        """
+        below = self._below.get(id(node))
+        if below is None:
+            return self.summarize(node)
+        return below | self._masks[type(node)]
+
+
+def _identity(node):
+    return node
+
+
+class PassManager(object):
+    """
+    Runs transformers (ast.NodeTransformer instances) over trees, in order.
+
+    A transformer whose class sets 'fusable = True' promises that its visit
+    methods only rewrite the node they are given, after its children have
+    been transformed (by calling self.generic_visit(node) first, or not at
+    all), and that they return any new nodes instead of adding them to its
+    fields. Consecutive such passes run in a single bottom-up traversal,
+    each node going through all of their visit methods in turn.
+
+    These traversals also record which passes are interested in the nodes
+    below each node, so the passes after them (fusable or not) skip the
+    subtrees that hold none of their interests(). The record is dropped
+    after passes that are not fusable, which may change anything.
+
+    'timings' maps the name of each pass to the time spent in it over all
+    runs, in seconds; the traversals of fused passes are recorded under
+    'fused traversal'.
+    """
+
+    def __init__(self, passes=()):
+        self.passes = list(passes)
+        self.timings = collections.OrderedDict()
+
+    def add(self, transformer):
+        """Appends transformer to the passes, and returns this manager."""
+        self.passes.append(transformer)
+        return self
+
+    def run(self, tree):
+        """Transforms tree with all passes, and returns the result."""
+        pass_interests = [interests(transformer)
+                          for transformer in self.passes]
+        name_masks = {}
+        all_mask = 0
+        for index, names in enumerate(pass_interests):
+            if names is None:
+                all_mask |= 1 << index
+            for name in names or ():
+                name_masks[name] = name_masks.get(name, 0) | 1 << index
+        masks = _ClassMasks(name_masks, all_mask)
+        summary = _Summary(masks)
+        index = 0
+        groups = self._groups()
+        for group in groups:
+            mask = 0
+            for offset in range(len(group)):
+                mask |= 1 << (index + offset)
+            if getattr(group[0], 'fusable', False):
+                # the last passes need not record anything
+                tree = self._run_fused(group, tree, summary, mask,
+                                       group is not groups[-1])
+            else:
+                tree = self._run_pass(group[0], tree, summary, mask)
+                summary = _Summary(masks)
+            index += len(group)
+        mark_mutated()
+        return tree
+
+    def _groups(self):
+        groups = []
+        for transformer in self.passes:
+            if groups and getattr(transformer, 'fusable', False) and \
+                    getattr(groups[-1][-1], 'fusable', False):
+                groups[-1].append(transformer)
+            else:
+                groups.append([transformer])
+        return groups
+
+    def _record(self, name, elapsed):
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+    def _run_pass(self, transformer, tree, summary, mask):
+        start = time.time()
+        generic_visit = transformer.generic_visit
+
+        def skipping_generic_visit(node):
+            if summary.below(node) & mask:
+                return generic_visit(node)
+            return node
+        transformer.generic_visit = skipping_generic_visit
+        try:
+            tree = transformer.visit(tree)
+        finally:
+            del transformer.generic_visit
+        elapsed = time.time() - start
+        self._record(type(transformer).__name__, elapsed)
+        log.debug("pass %s took %.3f ms", type(transformer).__name__,
+                  elapsed * 1e3)
+        return tree
+
+    def _run_fused(self, group, tree, summary, mask, record=True):
+        start = time.time()
+        elapsed = [0.0] * len(group)
+        timer = time.time
+        rows = {}
+
+        def methods_for(cls):
+            if cls not in rows:
+                row = [_visit_method(transformer, cls.__name__)
+                       for transformer in group]
+                rows[cls] = row if any(row) else None
+            return rows[cls]
+
+        summarized = summary._below
+        recorded = summary._nodes
+        masks = summary._masks
+        summarize = summary.summarize
+
+        def known_within(node):
+            below = summarized.get(id(node))
+            if below is None:
+                return summarize(node)
+            return below | masks[type(node)]
+
+        def visit(node):
+            cls = type(node)
+            if not (summarized.get(id(node), -1) | masks[cls]) & mask:
+                return node
+            below = transform_children(node)
+            if record:
+                if id(node) not in summarized:
+                    recorded.append(node)
+                summarized[id(node)] = below
+            row = methods_for(cls)
+            if row is None:
+                return node
+            for index in range(len(group)):
+                method = row[index]
+                if method is None:
+                    continue
+                method_start = timer()
+                node = method(node)
+                elapsed[index] += timer() - method_start
+                if type(node) is not cls:
+                    if not isinstance(node, ast.AST):
+                        break
+                    cls = type(node)
+                    row = methods_for(cls) or [None] * len(group)
+            return node
+
+        def transform_children(node):
+            # as in ast.NodeTransformer.generic_visit, also returning the
+            # mask of the nodes below node
+            below = 0
+            for field in node._fields:
+                old_value = getattr(node, field, None)
+                if isinstance(old_value, list):
+                    new_values = []
+                    for value in old_value:
+                        if isinstance(value, ast.AST):
+                            value = visit(value)
+                            if value is None:
+                                continue
+                            elif not isinstance(value, ast.AST):
+                                if record:
+                                    for item in value:
+                                        if isinstance(item, ast.AST):
+                                            below |= known_within(item)
+                                new_values.extend(value)
+                                continue
+                            if record:
+                                below |= known_within(value)
+                        new_values.append(value)
+                    old_value[:] = new_values
+                elif isinstance(old_value, ast.AST):
+                    new_node = visit(old_value)
+                    if new_node is None:
+                        delattr(node, field)
+                    else:
+                        setattr(node, field, new_node)
+                        if record:
+                            below |= known_within(new_node)
+            return below
+
+        # children are transformed by the traversal
+        for transformer in group:
+            transformer.generic_visit = _identity
+        try:
+            tree = visit(tree)
+            if record and isinstance(tree, ast.AST):
+                summary.known_within(tree)
+        finally:
+            for transformer in group:
+                del transformer.generic_visit
+        total = time.time() - start
+        for transformer, pass_time in zip(group, elapsed):
+            self._record(type(transformer).__name__, pass_time)
+        self._record('fused traversal', total - sum(elapsed))
+        log.debug("fused passes %s took %.3f ms",
+                  ", ".join(type(t).__name__ for t in group), total * 1e3)
+        return tree
@@ -13,6 +13,15 @@ from ctree import _TYPE_RECOGNIZERS as recognizers
 
 log = logging.getLogger(__name__)
 
+# bumped whenever a type code generator or recognizer is registered, since
+# code generated before may render types differently now
+_registry_generation = 0
+
+
+def registry_generation():
+    """Returns a number that changes whenever the type registries do."""
+    return _registry_generation
+
 
 def register_type_codegenerators(codegen_dict):
     """
@@ -37,6 +46,8 @@ def register_type_codegenerators(codegen_dict):
         assert callable(genfn), "Found a non-callable type_codegen: %s" % genfn
 
     generators.update(codegen_dict)
+    global _registry_generation
+    _registry_generation += 1
 
 
 def register_type_recognizers(typerec_dict):
@@ -61,6 +72,19 @@ def register_type_recognizers(typerec_dict):
         assert callable(genfn), "Found a non-callable type_codegen: %s" % genfn
 
     recognizers.update(typerec_dict)
+    global _registry_generation
+    _registry_generation += 1
+
+
+def _load_numpy_support():
+    """
+    Registers ctree's numpy types (ctree.np) if numpy is in use but they
+    are not registered yet. This must happen before a type is looked up,
+    since numpy types also derive from the types of Python and ctypes
+    (e.g. an ndpointer from c_void_p).
+    """
+    if 'numpy' in sys.modules and 'ctree.np' not in sys.modules:
+        import ctree.np
 
 
 def get_ctype(py_obj):
@@ -70,6 +94,7 @@ def get_ctype(py_obj):
 
     :param py_obj: A python object.
     """
+    _load_numpy_support()
     bases = [type(py_obj)]
     while bases:
         base = bases.pop()
@@ -114,6 +139,7 @@ def codegen_type(ctype):
     assert not isinstance(ctype, type), \
         "Expected a ctypes type instance, not %s, (%s):" % (ctype, type(ctype))
 
+    _load_numpy_support()
     bases = [type(ctype)]
     while bases:
         base = bases.pop()
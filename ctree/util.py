@@ -1,3 +1,4 @@
+import sys
 import logging
 
 log = logging.getLogger(__name__)
@@ -99,3 +100,119 @@ class Timer:  # pragma: no cover
 
     def __exit__(self, *args):
         self.interval = time.clock() - self.start
+
+
+try:
+    from hashlib import blake2b as _digest
+except ImportError:  # pragma: no cover
+    from hashlib import sha256 as _digest
+
+
+def _encode(obj, out, seen=()):
+    """
+    Appends a canonical, process-independent encoding of obj to the list
+    'out'. Containers are encoded structurally, with dict and set members
+    in a fixed order, so equal values always produce equal encodings.
+    'seen' holds the types being encoded, to stop at recursive types.
+    """
+    obj_type = type(obj)
+    if obj is None or obj_type in (bool, int, float, complex):
+        out.append("%s:%r;" % (obj_type.__name__, obj))
+    elif obj_type is str:
+        out.append("str:%d:%s;" % (len(obj), obj))
+    elif obj_type is bytes:
+        out.append("bytes:%d:%r;" % (len(obj), obj))
+    elif isinstance(obj, (tuple, list)):
+        out.append("%s:%d(" % (obj_type.__name__, len(obj)))
+        for item in obj:
+            _encode(item, out, seen)
+        out.append(")")
+    elif isinstance(obj, dict):
+        _encode_unordered(obj_type, obj.items(), out, seen)
+    elif isinstance(obj, (set, frozenset)):
+        _encode_unordered(obj_type, obj, out, seen)
+    elif isinstance(obj, type):
+        _encode_type(obj, out, seen)
+    elif _is_dtype(obj):
+        out.append("dtype:%r;" % (obj.descr if obj.fields else obj.str,))
+    elif hasattr(obj, '_type_') and hasattr(obj, 'value'):
+        # ctypes scalar instance
+        _encode_type(obj_type, out, seen)
+        _encode(obj.value, out, seen)
+    else:
+        # no structure to go on; only deterministic if repr() is
+        out.append("%s.%s:%r;" % (obj_type.__module__, obj_type.__name__, obj))
+
+
+def _encode_unordered(obj_type, items, out, seen):
+    encoded = []
+    for item in items:
+        parts = []
+        _encode(item, parts, seen)
+        encoded.append("".join(parts))
+    encoded.sort()
+    out.append("%s:%d{" % (obj_type.__name__, len(encoded)))
+    out.extend(encoded)
+    out.append("}")
+
+
+def _is_dtype(obj):
+    np = sys.modules.get('numpy')
+    return np is not None and isinstance(obj, np.dtype)
+
+
+# type -> encoding, since types are hashed over and over as parts of configs
+_TYPE_ENCODINGS = {}
+
+
+def _encode_type(cls, out, seen):
+    if not seen:
+        try:
+            out.append(_TYPE_ENCODINGS[cls])
+            return
+        except (KeyError, TypeError):
+            pass
+        parts = []
+        _encode_type_structure(cls, parts, (cls,))
+        encoding = "".join(parts)
+        try:
+            _TYPE_ENCODINGS[cls] = encoding
+        except TypeError:
+            pass
+        out.append(encoding)
+    elif cls in seen:
+        out.append("type:%s.%s;" % (cls.__module__, getattr(
+            cls, '__qualname__', cls.__name__)))
+    else:
+        _encode_type_structure(cls, out, seen + (cls,))
+
+
+def _encode_type_structure(cls, out, seen):
+    out.append("type:%s.%s" % (cls.__module__, getattr(cls, '__qualname__',
+                                                       cls.__name__)))
+    # ctypes types made on the fly (pointers, arrays, function types,
+    # ndpointers) are identified by their structure rather than their name
+    for attr in ('_dtype_', '_ndim_', '_shape_', '_flags_', '_type_',
+                 '_length_', '_argtypes_', '_restype_', '_fields_'):
+        try:
+            value = getattr(cls, attr)
+        except AttributeError:
+            continue
+        out.append("<%s=" % attr)
+        _encode(value, out, seen)
+        out.append(">")
+    out.append(";")
+
+
+def structural_hash(obj):
+    """
+    Returns a hex digest of obj that depends only on its value: it is the
+    same in every process (unlike hash(), which is randomized for strings)
+    and distinguishes values whose str() is the same. Handles the usual
+    contents of a program config: None, numbers, strings, tuples, lists,
+    dicts, sets, classes, numpy dtypes and ctypes types (including
+    ndpointers).
+    """
+    out = []
+    _encode(obj, out)
+    return _digest("".join(out).encode()).hexdigest()[:32]
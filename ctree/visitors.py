@@ -4,4 +4,17 @@ For now, just use visitors defined by Python's AST library.
 import ast
 
 NodeVisitor = ast.NodeVisitor
-NodeTransformer = ast.NodeTransformer
+
+
+class NodeTransformer(ast.NodeTransformer):
+    """
+    An ast.NodeTransformer that starts a new mutation epoch (see
+    ctree.nodes.mark_mutated) as it changes a tree, so that node indexes
+    are rebuilt after it runs.
+    """
+
+    def generic_visit(self, node):
+        # ctree.nodes imports this module
+        from ctree.nodes import mark_mutated
+        mark_mutated()
+        return ast.NodeTransformer.generic_visit(self, node)
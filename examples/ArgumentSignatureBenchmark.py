@@ -0,0 +1,62 @@
+"""
+Measures how long a LazySpecializedFunction takes to find the program config
+of a call, keying on an ArgumentSignature against the old way: a dict of
+ndpointer types from args_to_subconfig, keyed on the hash of its str().
+"""
+
+import ast
+import time
+
+import numpy as np
+
+from ctree.jit import LazySpecializedFunction, ArgumentSignature
+
+
+class SignatureKeyed(LazySpecializedFunction):
+    arg_signature = ArgumentSignature('dtype', 'ndim', 'shape')
+
+
+class StrKeyed(LazySpecializedFunction):
+    def args_to_subconfig(self, args):
+        return {
+            'ptr%d' % i: np.ctypeslib.ndpointer(arg.dtype, arg.ndim, arg.shape)
+            for i, arg in enumerate(args)
+        }
+
+    @staticmethod
+    def _str_hash(o):
+        if isinstance(o, dict):
+            return hash(frozenset(
+                StrKeyed._str_hash(item) for item in o.items()
+            ))
+        return hash(str(o))
+
+    def _config_key(self, program_config):
+        return self.ProgramConfig(self._str_hash(program_config.args_subconfig),
+                                  self._str_hash(program_config.tuner_subconfig))
+
+
+def lookup_time(lsf, calls):
+    """Seconds lsf takes to key each call, and the number of distinct keys."""
+    keys = set()
+    start = time.time()
+    for args in calls:
+        keys.add(lsf._config_key(lsf.get_program_config(args, {})))
+    return time.time() - start, len(keys)
+
+
+def main(calls=10000, repeat=3):
+    arrays = [np.zeros(shape, dtype) for shape in ((16,), (4, 4), (1024,))
+              for dtype in (np.float32, np.float64)]
+    calls = [(arrays[i % len(arrays)], arrays[(i // 2) % len(arrays)])
+             for i in range(calls)]
+    tree = ast.parse("def add(a, b): return a + b")
+    for name, lsf in (("str()", StrKeyed(tree)),
+                      ("signature", SignatureKeyed(tree))):
+        best, distinct = min(lookup_time(lsf, calls) for _ in range(repeat))
+        print("%-10s %d calls, %d configs, %.2f us per call" % (
+            name, len(calls), distinct, best / len(calls) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
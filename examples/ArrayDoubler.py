@@ -13,6 +13,7 @@ from ctree.nodes import Project
 from ctree.transformations import *
 from ctree.jit import LazySpecializedFunction
 from ctree.jit import ConcreteSpecializedFunction
+from ctree.jit import ArgumentSignature
 # from ctypes import CFUNCTYPE
 
 # ---------------------------------------------------------------------------
@@ -20,16 +21,9 @@ from ctree.jit import ConcreteSpecializedFunction
 
 
 class OpTranslator(LazySpecializedFunction):
-    def args_to_subconfig(self, args):
-        """
-        Analyze arguments and return a 'subconfig', a hashable object
-        that classifies them. Arguments with identical subconfigs
-        might be processed by the same generated code.
-        """
-        A = args[0]
-        return {
-            'ptr': np.ctypeslib.ndpointer(A.dtype, A.ndim, A.shape),
-        }
+    # Arguments with the same dtype, ndim and shape are processed by the
+    # same generated code.
+    arg_signature = ArgumentSignature('dtype', 'ndim', 'shape')
 
     def transform(self, py_ast, program_config):
         """
@@ -37,7 +31,7 @@ class OpTranslator(LazySpecializedFunction):
         given in program_config.
         """
         arg_config, tuner_config = program_config
-        array_type = arg_config['ptr']
+        array_type = arg_config[0].as_ctype()
         nItems = np.prod(array_type._shape_)
         inner_type = array_type._dtype_.type()
         kernel_func_name = 'apply'
@@ -76,7 +70,7 @@ class OpTranslator(LazySpecializedFunction):
         proj = Project([c_doubler])
 
         arg_config, tuner_config = program_config
-        array_type = arg_config['ptr']
+        array_type = arg_config[0].as_ctype()
         entry_type = ct.CFUNCTYPE(None, array_type)
 
         concrete_Fn = ArrayFn()
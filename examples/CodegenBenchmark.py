@@ -0,0 +1,59 @@
+"""
+Measures the throughput of C code generation, in nodes per second, on a
+fully unrolled register-blocked kernel like the one dgemm.py generates.
+"""
+
+import ast
+import time
+from ctypes import c_int, c_double, POINTER
+
+from ctree.c.nodes import *
+from ctree.simd.macros import *
+from ctree.simd.types import m256d
+
+
+def rank1_update(i, rx, ry, lda):
+    """One rank-1 update of a rx-by-ry block of 'c', as in dgemm.py."""
+    stmts = [Assign(SymbolRef("a%d" % j),
+                    mm256_load_pd(Add(SymbolRef("A"), Constant(j*4 + i*ry))))
+             for j in range(ry // 4)]
+    for j in range(rx):
+        stmts.append(Assign(SymbolRef("b"),
+                            mm256_set1_pd(ArrayRef(SymbolRef("B"),
+                                                   Constant(i + j*lda)))))
+        for k in range(ry // 4):
+            c_kj = ArrayRef(ArrayRef(SymbolRef("c"), Constant(k)), Constant(j))
+            stmts.append(Assign(c_kj, mm256_add_pd(
+                ArrayRef(ArrayRef(SymbolRef("c"), Constant(k)), Constant(j)),
+                mm256_mul_pd(SymbolRef("a%d" % k), SymbolRef("b")))))
+    return Block(stmts)
+
+
+def kernel(unroll, rx=16, ry=16, lda=1024):
+    decls = [SymbolRef("a%d" % j, m256d()) for j in range(ry // 4)]
+    decls.append(SymbolRef("b", m256d()))
+    loop = For(Assign(SymbolRef("k", c_int()), Constant(0)),
+               Lt(SymbolRef("k"), SymbolRef("K")),
+               AddAssign(SymbolRef("k"), Constant(unroll)),
+               [rank1_update(i, rx, ry, lda) for i in range(unroll)])
+    params = [SymbolRef(name, POINTER(c_double)()) for name in "ABC"]
+    params.append(SymbolRef("K", c_int()))
+    return CFile("kernel", [
+        FunctionDecl(None, "register_dgemm", params, decls + [loop])])
+
+
+def main(unroll=32, repeat=3):
+    tree = kernel(unroll)
+    nodes = sum(1 for _ in ast.walk(tree))
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        program_text = tree.codegen()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%d nodes, %d bytes of C in %.1f ms: %.0f nodes/s" %
+          (nodes, len(program_text), best * 1e3, nodes / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures ConstantFold on an unrolled 2D stencil over a flattened grid, the
+kind of index arithmetic MultiArrayRef-style flattening leaves behind, and
+how much smaller (and quicker for the C compiler) the folded code is.
+"""
+
+import ast
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from ctypes import c_int, c_double, POINTER
+
+import ctree
+from ctree.c.nodes import *
+from ctree.transforms import ConstantFold
+
+
+def flat_index(row, col, width):
+    """The index of (i + row, j + col) in a row-major grid of width columns."""
+    return Add(Mul(Add(SymbolRef("i"), Constant(row)), Constant(width)),
+               Add(Add(SymbolRef("j"), Constant(col)), Constant(0)))
+
+
+def kernel(unroll, radius=2, width=1024):
+    stmts = []
+    for u in range(unroll):
+        value = Constant(0.0)
+        for row in range(-radius, radius + 1):
+            for col in range(-radius, radius + 1):
+                weight = Mul(Constant(1.0 / (2 * radius + 1) ** 2),
+                             Constant(1))
+                value = Add(value, Mul(weight, ArrayRef(
+                    SymbolRef("x"), flat_index(row, col + u, width))))
+        stmts.append(Assign(ArrayRef(SymbolRef("y"), flat_index(0, u, width)),
+                            value))
+    loop = For(Assign(SymbolRef("j", c_int()), Constant(radius)),
+               Lt(SymbolRef("j"), Constant(width - radius - unroll + 1)),
+               AddAssign(SymbolRef("j"), Constant(unroll)),
+               stmts)
+    params = [SymbolRef(name, POINTER(c_double)()) for name in "xy"]
+    params.append(SymbolRef("i", c_int()))
+    return CFile("stencil", [FunctionDecl(None, "stencil", params, [loop])])
+
+
+def compile_time(code):
+    """Seconds the configured C compiler takes on code, or None without it."""
+    compiler = ctree.CONFIG.get('c', 'CC')
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "stencil.c")
+        with open(path, 'w') as source:
+            source.write(code)
+        start = time.time()
+        try:
+            subprocess.check_call([compiler] +
+                                  ctree.CONFIG.get('c', 'CFLAGS').split() +
+                                  ["-c", path, "-o", path + ".o"])
+        except OSError:
+            # no such compiler
+            return None
+        return time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(unroll=64, repeat=3):
+    unfolded = kernel(unroll)
+    nodes = sum(1 for _ in ast.walk(unfolded))
+    best = None
+    for _ in range(repeat):
+        tree = kernel(unroll)
+        start = time.time()
+        folded = ConstantFold().visit(tree)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("folded %d nodes in %.1f ms" % (nodes, best * 1e3))
+
+    for name, code in (("unfolded", unfolded.codegen()),
+                       ("folded", folded.codegen())):
+        seconds = compile_time(code)
+        print("    %-8s %7d bytes of C%s" % (
+            name, len(code),
+            "" if seconds is None else ", compiled in %.0f ms" % (seconds * 1e3)))
+
+
+if __name__ == '__main__':
+    main()
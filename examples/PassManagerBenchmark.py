@@ -0,0 +1,73 @@
+"""
+Compares running a few transformations over a large unrolled AST one after
+the other with running them through a PassManager, which fuses the local
+ones into one traversal and lets each skip subtrees it has nothing to do in.
+"""
+
+import ast
+import time
+from ctypes import c_int, c_double, POINTER
+
+from ctree.c.nodes import *
+from ctree.transforms import ConstantFold, PassManager
+from ctree.transformations import PyCtxScrubber, ResolveGeneratedPathRefs, \
+    Lifter
+
+
+def kernel(unroll, taps=8):
+    """An unrolled 1D stencil, with index arithmetic left to be folded."""
+    stmts = []
+    for u in range(unroll):
+        value = Constant(0.0)
+        for t in range(taps):
+            index = Add(SymbolRef("i"), Add(Constant(u), Constant(t - taps // 2)))
+            value = Add(value, Mul(Mul(Constant(1), SymbolRef("w%d" % t)),
+                                   ArrayRef(SymbolRef("x"), index)))
+        stmts.append(Assign(ArrayRef(SymbolRef("y"),
+                                     Add(SymbolRef("i"), Mul(Constant(u), Constant(1)))),
+                            value))
+    loop = For(Assign(SymbolRef("i", c_int()), Constant(taps)),
+               Lt(SymbolRef("i"), Sub(SymbolRef("n"), Constant(taps))),
+               AddAssign(SymbolRef("i"), Constant(unroll)),
+               stmts)
+    params = [SymbolRef(name, POINTER(c_double)()) for name in "xy"]
+    params.append(SymbolRef("n", c_int()))
+    params.extend(SymbolRef("w%d" % t, c_double()) for t in range(taps))
+    return CFile("stencil", [FunctionDecl(None, "stencil", params, [loop])])
+
+
+def passes():
+    return [ConstantFold(), ResolveGeneratedPathRefs("."), PyCtxScrubber(),
+            Lifter()]
+
+
+def run_sequentially(tree):
+    for transformer in passes():
+        tree = transformer.visit(tree)
+    return tree
+
+
+def main(unroll=128, repeat=3):
+    nodes = sum(1 for _ in ast.walk(kernel(unroll)))
+    results = {}
+    for name, run in (("sequential", run_sequentially),
+                      ("pass manager", PassManager(passes()).run)):
+        best = None
+        for _ in range(repeat):
+            tree = kernel(unroll)
+            start = time.time()
+            tree = run(tree)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = tree.codegen()
+        print("%s: %d nodes in %.1f ms" % (name, nodes, best * 1e3))
+    assert results["sequential"] == results["pass manager"]
+
+    manager = PassManager(passes())
+    manager.run(kernel(unroll))
+    for name, elapsed in manager.timings.items():
+        print("    %-24s %.1f ms" % (name, elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
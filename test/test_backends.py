@@ -0,0 +1,372 @@
+import copy
+import ctypes
+import shutil
+import tempfile
+import unittest
+
+from ctree import CONFIG
+from ctree.backends import BACKENDS, CcBackend, TccModule, get_backend, \
+    use_backend, load_libtcc, build_options, get_cflags
+from ctree.jit import JitModule
+from ctree.c.nodes import CFile
+from ctree.cpp.nodes import CppInclude
+from ctree.store import get_store
+from fixtures.sample_asts import identity_ast, identity, fib_ast, fib
+from test_specfuncs import TestTranslator
+
+
+class RecordingBackend(CcBackend):
+    def __init__(self):
+        super(RecordingBackend, self).__init__()
+        self.compiled = []
+
+    def compile(self, cfile, program_text, program_hash):
+        self.compiled.append(cfile.name)
+        return super(RecordingBackend, self).compile(cfile, program_text,
+                                                     program_hash)
+
+
+class TestBackendSelection(unittest.TestCase):
+    def test_default(self):
+        self.assertIsInstance(get_backend('c'), CcBackend)
+
+    def test_unknown(self):
+        with use_backend('no-such-backend'):
+            with self.assertRaises(ValueError):
+                get_backend('c')
+
+    def test_override(self):
+        BACKENDS['recording'] = backend = RecordingBackend()
+        try:
+            with use_backend('recording'):
+                self.assertIs(get_backend('c'), backend)
+            self.assertIsNot(get_backend('c'), backend)
+        finally:
+            del BACKENDS['recording']
+
+    def test_tiered(self):
+        BACKENDS['recording'] = backend = RecordingBackend()
+        old_fast = CONFIG.get('jit', 'FAST_BACKEND')
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'FAST_BACKEND', 'recording')
+        CONFIG.set('jit', 'CACHE', 'True')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_tiered')
+            build, built = c_fib._build, []
+
+            def recording_build(*args):
+                built.append(build(*args))
+                return built[-1]
+            c_fib._build = recording_build
+            self.assertEqual(c_fib(1), fib(1))
+            self.assertEqual(backend.compiled, ['fib'])
+            for pending in list(c_fib._pending.values()):
+                pending.wait()
+            self.assertEqual(backend.compiled, ['fib'])
+            self.assertEqual(len(built), 2)
+            self.assertIsNot(built[0], built[1])
+            self.assertIs(list(c_fib.concrete_functions.values())[0],
+                          built[1])
+            self.assertEqual(c_fib(1), fib(1))
+            self.assertFalse(c_fib._pending)
+        finally:
+            CONFIG.set('jit', 'FAST_BACKEND', old_fast)
+            CONFIG.set('jit', 'CACHE', old_cache)
+            del BACKENDS['recording']
+
+    def test_tiered_without_cache(self):
+        BACKENDS['recording'] = backend = RecordingBackend()
+        old_fast = CONFIG.get('jit', 'FAST_BACKEND')
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'FAST_BACKEND', 'recording')
+        CONFIG.set('jit', 'CACHE', 'False')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_tiered_without_cache')
+            for _ in range(3):
+                self.assertEqual(c_fib(1), fib(1))
+            # every call is built anew, so there is nothing to tier
+            self.assertEqual(backend.compiled, [])
+            self.assertFalse(c_fib._pending)
+        finally:
+            CONFIG.set('jit', 'FAST_BACKEND', old_fast)
+            CONFIG.set('jit', 'CACHE', old_cache)
+            del BACKENDS['recording']
+
+    def test_tiered_rebuild_once(self):
+        import threading
+        c_fib = TestTranslator(fib_ast, 'test_tiered_rebuild_once')
+        program_config = c_fib.get_program_config((1,), {})
+        key = c_fib._config_key(program_config)
+        release = threading.Event()
+        built = []
+
+        def slow_build(*args):
+            release.wait()
+            built.append(args)
+        self.assertTrue(c_fib._submit(slow_build, program_config, key))
+        self.assertFalse(c_fib._submit(slow_build, program_config, key))
+        pending = c_fib._pending[key]
+        release.set()
+        pending.wait()
+        self.assertEqual(len(built), 1)
+        self.assertFalse(c_fib._pending)
+
+    def test_tiered_rebuild_error(self):
+        c_fib = TestTranslator(fib_ast, 'test_tiered_rebuild_error')
+        program_config = c_fib.get_program_config((1,), {})
+        key = c_fib._config_key(program_config)
+
+        def failing_build(*args):
+            raise ValueError("optimized build failed")
+        c_fib._submit(failing_build, program_config, key)
+        pending = c_fib._pending[key]
+        pending.wait()
+        # logged, and the function already built is kept
+        self.assertTrue(pending.successful())
+        self.assertFalse(c_fib._pending)
+
+
+class TestPrecompiledHeaders(unittest.TestCase):
+    def setUp(self):
+        # a fresh store, so that the programs are compiled
+        self.old_store = CONFIG.get('jit', 'STORE_PATH')
+        self.old_pch = CONFIG.get('jit', 'PRECOMPILED_HEADERS')
+        self.store_path = tempfile.mkdtemp()
+        CONFIG.set('jit', 'STORE_PATH', self.store_path)
+        CONFIG.set('jit', 'PRECOMPILED_HEADERS', 'True')
+
+    def tearDown(self):
+        CONFIG.set('jit', 'STORE_PATH', self.old_store)
+        CONFIG.set('jit', 'PRECOMPILED_HEADERS', self.old_pch)
+        shutil.rmtree(self.store_path)
+
+    def _compile(self, name, includes):
+        tree = copy.deepcopy(identity_ast)
+        tree.name = name
+        cfile = CFile(name, [CppInclude(header) for header in includes] +
+                      [tree], path=CONFIG.get('jit', 'COMPILE_PATH'))
+        mod = JitModule()
+        mod._link_in(cfile._compile(cfile.codegen()))
+        return mod.get_callable(tree.name, tree.get_type())
+
+    def _headers(self):
+        return sorted(path for path, _ in get_store()._entries()
+                      if path.endswith(".h.gch"))
+
+    def test_leading_includes(self):
+        cfile = CFile("test_leading_includes", [
+            CppInclude("math.h"), CppInclude("stdio.h"),
+            CppInclude("local.h", angled_brackets=False),
+            CppInclude("stdlib.h")])
+        self.assertEqual(cfile._leading_includes(),
+                         "#include <math.h>\n#include <stdio.h>\n")
+
+    def test_precompiled_header_reused(self):
+        c_identity = self._compile("test_pch_1", ["math.h", "stddef.h"])
+        self.assertEqual(c_identity(7), identity(7))
+        headers = self._headers()
+        self.assertTrue(headers)
+
+        # a different program starting with the same includes
+        c_identity = self._compile("test_pch_2", ["math.h", "stddef.h"])
+        self.assertEqual(c_identity(7), identity(7))
+        self.assertEqual(self._headers(), headers)
+
+    def test_precompiled_header_used(self):
+        import subprocess
+        import ctree.backends
+        used = []
+
+        def run_compiler(compile_cmd, program_text):
+            if "-include" not in compile_cmd:
+                return real_run_compiler(compile_cmd, program_text)
+            # -H lists the headers read, marking a usable .gch with "!"
+            compiler = subprocess.Popen(compile_cmd + ["-H"],
+                                        stdin=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+            _, headers = compiler.communicate(program_text.encode())
+            self.assertEqual(compiler.returncode, 0)
+            header = compile_cmd[compile_cmd.index("-include") + 1]
+            used.append("! %s.gch" % header in headers.decode().splitlines())
+
+        real_run_compiler = ctree.backends.run_compiler
+        ctree.backends.run_compiler = run_compiler
+        try:
+            c_identity = self._compile("test_pch_used", ["math.h"])
+        finally:
+            ctree.backends.run_compiler = real_run_compiler
+        self.assertEqual(c_identity(7), identity(7))
+        self.assertEqual(used, [True])
+
+
+class TestHotRecompilation(unittest.TestCase):
+    def test_hot_cflags(self):
+        self.assertEqual(get_cflags('c'), CONFIG.get('c', 'CFLAGS'))
+        with build_options(hot=True):
+            self.assertEqual(get_cflags('c'), CONFIG.get('c', 'HOT_CFLAGS'))
+            self.assertEqual(get_cflags('opencl'),
+                             CONFIG.get('opencl', 'CFLAGS'))
+
+    def test_promotion(self):
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'CACHE', 'True')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_promotion')
+            c_fib.hot_calls = 3
+            for i in range(2):
+                self.assertEqual(c_fib(1), fib(1))
+            self.assertFalse(c_fib._pending)
+            cold_csf = list(c_fib.concrete_functions.values())[0]
+
+            self.assertEqual(c_fib(1), fib(1))
+            self.assertEqual(list(c_fib.profiles.values())[0][0], 3)
+            for pending in list(c_fib._pending.values()):
+                pending.wait()
+            hot_csf = list(c_fib.concrete_functions.values())[0]
+            self.assertIsNot(cold_csf, hot_csf)
+            self.assertEqual(c_fib(1), fib(1))
+        finally:
+            CONFIG.set('jit', 'CACHE', old_cache)
+
+    def test_promotion_without_cache(self):
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'CACHE', 'False')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_promotion_without_cache')
+            c_fib.hot_calls = 2
+            build_hot, hot = c_fib._build_hot, []
+
+            def recording_build_hot(*args):
+                hot.append(args)
+                return build_hot(*args)
+            c_fib._build_hot = recording_build_hot
+            for i in range(4):
+                self.assertEqual(c_fib(1), fib(1))
+            # each call builds anew, with HOT_CFLAGS once promoted
+            self.assertEqual(len(hot), 2)
+            self.assertFalse(c_fib._pending)
+        finally:
+            CONFIG.set('jit', 'CACHE', old_cache)
+
+    def test_newer_build_kept(self):
+        c_fib = TestTranslator(fib_ast, 'test_newer_build_kept')
+        program_config = c_fib.get_program_config((1,), {})
+        key = c_fib._config_key(program_config)
+        first, second = next(c_fib._builds), next(c_fib._builds)
+        newer = c_fib._build(program_config, key, second)
+        # started earlier, finished later
+        older = c_fib._build(program_config, key, first)
+        self.assertIsNot(older, newer)
+        self.assertIs(c_fib.concrete_functions[key], newer)
+        latest = c_fib._build(program_config, key)
+        self.assertIs(c_fib.concrete_functions[key], latest)
+
+    def test_failed_promotion(self):
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'CACHE', 'True')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_failed_promotion')
+            c_fib.hot_calls = 1
+
+            def failing_build_hot(*args):
+                raise ValueError("hot build failed")
+            c_fib._build_hot = failing_build_hot
+            self.assertEqual(c_fib(1), fib(1))
+            csf = list(c_fib.concrete_functions.values())[0]
+            for pending in list(c_fib._pending.values()):
+                pending.wait()
+            self.assertFalse(c_fib._pending)
+            self.assertEqual(c_fib(1), fib(1))
+            self.assertIs(list(c_fib.concrete_functions.values())[0], csf)
+        finally:
+            CONFIG.set('jit', 'CACHE', old_cache)
+
+
+class FakeLibtcc(object):
+    """Resolves every symbol to C's abs(), and records deleted states."""
+
+    def __init__(self):
+        import ctypes.util
+        self._abs = ctypes.CDLL(ctypes.util.find_library('c')).abs
+        self.deleted = []
+
+    def tcc_get_symbol(self, state, name):
+        return ctypes.cast(self._abs, ctypes.c_void_p).value
+
+    def tcc_delete(self, state):
+        self.deleted.append(state)
+
+
+class TestTccModule(unittest.TestCase):
+    def test_callable_keeps_module(self):
+        import gc
+        lib = FakeLibtcc()
+        module = TccModule(lib, 1)
+        c_abs = module.get_callable("abs",
+                                    ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int))
+        del module
+        gc.collect()
+        self.assertEqual(lib.deleted, [])
+        self.assertEqual(c_abs(-3), 3)
+        del c_abs
+        gc.collect()
+        self.assertEqual(lib.deleted, [1])
+
+
+@unittest.skipUnless(load_libtcc(), "libtcc not installed")
+class TestTccBackend(unittest.TestCase):
+    def test_identity(self):
+        cfile = CFile("test_tcc_identity", [copy.deepcopy(identity_ast)],
+                      path=tempfile.mkdtemp())
+        with use_backend('tcc'):
+            submodule = cfile._compile(cfile.codegen())
+        mod = JitModule()
+        mod._link_in(submodule)
+        c_identity_fn = mod.get_callable(identity_ast.name,
+                                         identity_ast.get_type())
+        self.assertEqual(identity(3), c_identity_fn(3))
+
+    def test_compile_error(self):
+        cfile = CFile("test_tcc_error", [], path=tempfile.mkdtemp())
+        with use_backend('tcc'):
+            with self.assertRaises(RuntimeError):
+                cfile._compile("this is not C;")
+
+    def test_concurrent_compiles(self):
+        from multiprocessing.pool import ThreadPool
+        cfiles = []
+        for i in range(8):
+            tree = copy.deepcopy(identity_ast)
+            tree.name = "identity_%d" % i
+            cfiles.append(CFile("test_tcc_concurrent_%d" % i, [tree],
+                                path=tempfile.mkdtemp()))
+
+        def compile_cfile(cfile):
+            with use_backend('tcc'):
+                submodule = cfile._compile(cfile.codegen())
+            mod = JitModule()
+            mod._link_in(submodule)
+            tree = cfile.body[0]
+            return mod.get_callable(tree.name, tree.get_type())
+        pool = ThreadPool(4)
+        try:
+            functions = pool.map(compile_cfile, cfiles)
+        finally:
+            pool.close()
+        self.assertEqual([f(i) for i, f in enumerate(functions)],
+                         [identity(i) for i in range(8)])
+
+    def test_tiered(self):
+        old_fast = CONFIG.get('jit', 'FAST_BACKEND')
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'FAST_BACKEND', 'tcc')
+        CONFIG.set('jit', 'CACHE', 'True')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_tcc_tiered')
+            self.assertEqual(c_fib(10), fib(10))
+            for pending in list(c_fib._pending.values()):
+                pending.wait()
+            self.assertEqual(c_fib(10), fib(10))
+        finally:
+            CONFIG.set('jit', 'FAST_BACKEND', old_fast)
+            CONFIG.set('jit', 'CACHE', old_cache)
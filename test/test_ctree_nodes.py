@@ -1,7 +1,12 @@
 import unittest
+import ast
+import copy
 import ctypes as ct
+import pickle
 
 from ctree.c.nodes import *
+from ctree.nodes import mark_mutated
+from ctree.visitors import NodeTransformer
 
 
 class TestCtreeNode(unittest.TestCase):
@@ -24,3 +29,191 @@ class TestCtreeNode(unittest.TestCase):
             tree.find_all(SymbolRef, type=ct.c_int())
         except AttributeError:
             self.fail("find_all should not raise AttributeError")
+
+
+class TestCompactNodes(unittest.TestCase):
+
+    def _tree(self):
+        return For(Assign(SymbolRef("i", ct.c_int()), Constant(0)),
+                   Lt(SymbolRef("i"), Constant(10)),
+                   PostInc(SymbolRef("i")),
+                   [AddAssign(ArrayRef(SymbolRef("a"), SymbolRef("i")),
+                              Constant(1))])
+
+    def test_fields_in_slots(self):
+        node = BinaryOp(SymbolRef("a"), Op.Add(), Constant(1))
+        self.assertEqual(node.__dict__, {})
+        self.assertFalse(node.deleted)
+        self.assertFalse(node._force_parentheses)
+
+    def test_ops_in_slots(self):
+        for name in dir(Op):
+            op_type = getattr(Op, name)
+            if isinstance(op_type, type) and issubclass(op_type, Op._Op):
+                self.assertFalse(hasattr(op_type(), '__dict__'), name)
+
+    def test_extra_attributes(self):
+        node = Constant(1)
+        node._force_parentheses = True
+        node.extra = "extra"
+        self.assertTrue(node._force_parentheses)
+        self.assertFalse(Constant(1)._force_parentheses)
+        self.assertEqual(copy.deepcopy(node).extra, "extra")
+
+    def test_node_visitor(self):
+        class Collector(ast.NodeVisitor):
+            def __init__(self):
+                self.names = []
+
+            def visit_SymbolRef(self, node):
+                self.names.append(node.name)
+
+        collector = Collector()
+        collector.visit(self._tree())
+        self.assertEqual(collector.names, ["i", "i", "i", "a", "i"])
+
+    def test_copy(self):
+        tree = self._tree()
+        for clone in (copy.copy(tree), copy.deepcopy(tree),
+                      pickle.loads(pickle.dumps(tree))):
+            self.assertEqual(clone.codegen(), tree.codegen())
+            self.assertEqual(clone.init.left.type.__class__, ct.c_int)
+
+    def test_equality(self):
+        self.assertEqual(FunctionCall(SymbolRef("f"), [Constant(1)]),
+                         FunctionCall(SymbolRef("f"), [Constant(1)]))
+        self.assertNotEqual(Constant(1), Constant(2))
+        self.assertNotEqual(SymbolRef("a", ct.c_int()), SymbolRef("a"))
+
+
+class TestCodegenDispatch(unittest.TestCase):
+
+    def test_one_visitor_per_output(self):
+        from ctree.c.codegen import CCodeGen
+        created = []
+        init = CCodeGen.__init__
+
+        def counting_init(self, *args, **kwargs):
+            created.append(self)
+            init(self, *args, **kwargs)
+        CCodeGen.__init__ = counting_init
+        try:
+            tree = FunctionDecl(ct.c_int(), "f", [SymbolRef("x", ct.c_int())], [
+                If(Lt(SymbolRef("x"), Constant(0)),
+                   [Return(Mul(SymbolRef("x"), Constant(-1)))]),
+                Return(Add(SymbolRef("x"), FunctionCall(SymbolRef("g"), [])))])
+            tree.codegen()
+        finally:
+            CCodeGen.__init__ = init
+        self.assertEqual(len(created), 1)
+
+    def test_custom_codegen(self):
+        class Custom(CNode):
+            def codegen(self, indent=0):
+                return "custom"
+        tree = FunctionCall(SymbolRef("f"), [Custom(), Constant(1)])
+        self.assertEqual(tree.codegen(), "f(custom, 1)")
+
+    def test_other_family(self):
+        from ctree.cpp.nodes import CppComment
+        tree = Block([CppComment("comment"), Return(Constant(0))])
+        self.assertEqual(tree.codegen(), "{\n    // comment\n    return 0;\n}")
+
+
+class TestNodeIndex(unittest.TestCase):
+
+    def _tree(self):
+        return FunctionDecl(None, "f", [SymbolRef("n", ct.c_int())], [
+            For(Assign(SymbolRef("i", ct.c_int()), Constant(0)),
+                Lt(SymbolRef("i"), SymbolRef("n")),
+                PostInc(SymbolRef("i")),
+                [Assign(ArrayRef(SymbolRef("a"), SymbolRef("i")),
+                        Add(String("x"), Constant(2)))]),
+            Return(Constant(1))])
+
+    def _lookups(self, tree):
+        return [list(tree.find_all(SymbolRef)),
+                list(tree.find_all(SymbolRef, name="i")),
+                list(tree.find_all(Literal)),
+                list(tree.find_all(Constant, value=2)),
+                list(tree.find_all(SymbolRef, name="missing")),
+                [tree.find(For), tree.find(FunctionDecl, name="f")]]
+
+    def test_same_as_walk(self):
+        tree = self._tree()
+        expected = [[id(node) for node in nodes]
+                    for nodes in self._lookups(tree)]
+        tree.index_nodes(attrs=("name", "value"))
+        for _ in range(2):
+            self.assertEqual([[id(node) for node in nodes]
+                              for nodes in self._lookups(tree)], expected)
+
+    def test_mutation_epoch(self):
+        tree = self._tree().index_nodes()
+        self.assertEqual(len(list(tree.find_all(Return))), 1)
+        index = tree._node_index
+        self.assertTrue(index.is_current())
+        mark_mutated()
+        self.assertFalse(index.is_current())
+        self.assertEqual(len(list(tree.find_all(Return))), 1)
+        self.assertTrue(index.is_current())
+
+    def test_nodes_added(self):
+        tree = Block([self._tree()]).index_nodes()
+        self.assertIsNone(tree.find(FunctionDecl, name="g"))
+        tree.body.append(FunctionDecl(None, "g", [], []))
+        mark_mutated()
+        self.assertEqual(tree.find(FunctionDecl, name="g").name, "g")
+        tree.find(For).body.append(Return(Constant(2)))
+        mark_mutated()
+        self.assertEqual(len(list(tree.find_all(Return))), 2)
+
+    def test_nodes_removed(self):
+        tree = Block([self._tree(), FunctionDecl(None, "g", [], [])])
+        tree.index_nodes()
+        self.assertIsNotNone(tree.find(FunctionDecl, name="f"))
+        tree.body.pop(0)
+        mark_mutated()
+        self.assertIsNone(tree.find(FunctionDecl, name="f"))
+        self.assertEqual(len(list(tree.find_all(SymbolRef))), 0)
+
+    def test_nodes_replaced(self):
+        tree = self._tree().index_nodes()
+        self.assertEqual(tree.find(Constant, value=0).value, 0)
+        tree.find(For).init.right = Constant(5)
+        mark_mutated()
+        self.assertIsNone(tree.find(Constant, value=0))
+        self.assertIsNotNone(tree.find(Constant, value=5))
+
+    def test_attribute_changes(self):
+        tree = self._tree().index_nodes()
+        self.assertIsNotNone(tree.find(FunctionDecl, name="f"))
+        tree.name = "g"
+        mark_mutated()
+        self.assertIsNone(tree.find(FunctionDecl, name="f"))
+        self.assertIs(tree.find(FunctionDecl, name="g"), tree)
+
+    def test_stale_until_marked(self):
+        tree = self._tree().index_nodes()
+        tree.find(For).init.right = Constant(5)
+        self.assertIsNotNone(tree.find(Constant, value=0))
+        mark_mutated()
+        self.assertIsNone(tree.find(Constant, value=0))
+
+    def test_node_transformer(self):
+        class Renumber(NodeTransformer):
+            def visit_Constant(self, node):
+                return Constant(node.value + 5)
+
+        tree = self._tree().index_nodes()
+        self.assertIsNotNone(tree.find(Constant, value=0))
+        Renumber().visit(tree)
+        self.assertIsNone(tree.find(Constant, value=0))
+        self.assertIsNotNone(tree.find(Constant, value=5))
+
+    def test_copy(self):
+        tree = self._tree().index_nodes()
+        tree.find(For)
+        self.assertNotIn('_node_index', copy.deepcopy(tree).__dict__)
+        self.assertEqual(Return(Constant(1)).index_nodes(),
+                         Return(Constant(1)))
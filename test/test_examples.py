@@ -28,6 +28,22 @@ class TestAllExamples(unittest.TestCase):
         from examples import ArrayDoubler
         ArrayDoubler.main()
 
+    def test_CodegenBenchmark(self):
+        from examples import CodegenBenchmark
+        CodegenBenchmark.main(unroll=2, repeat=1)
+
+    def test_PassManagerBenchmark(self):
+        from examples import PassManagerBenchmark
+        PassManagerBenchmark.main(unroll=2, repeat=1)
+
+    def test_ConstantFoldBenchmark(self):
+        from examples import ConstantFoldBenchmark
+        ConstantFoldBenchmark.main(unroll=2, repeat=1)
+
+    def test_ArgumentSignatureBenchmark(self):
+        from examples import ArgumentSignatureBenchmark
+        ArgumentSignatureBenchmark.main(calls=10, repeat=1)
+
     def test_TemplateDoubler(self):
         from examples import TemplateDoubler
         TemplateDoubler.main()
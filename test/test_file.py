@@ -14,3 +14,103 @@ class TestFile(CtreeTest):
         int foo;
         double bar();
         """)
+
+    def test_write_code(self):
+        import io
+        loop = For(Assign(SymbolRef("i", c_int()), Constant(0)),
+                   Lt(SymbolRef("i"), Constant(10)),
+                   PostInc(SymbolRef("i")),
+                   [Assign(SymbolRef("x"), SymbolRef("i")), Pass()])
+        tree = CFile("myfile", [FunctionDecl(None, "foo", [], [loop])])
+        stream = io.StringIO()
+        tree.write_code(stream)
+        self.assertEqual(stream.getvalue(), tree.codegen())
+        self._check_code(tree, """\
+        // <file: myfile.c>
+        void foo() {
+            for (int i = 0; i < 10; i ++) {
+                x = i;
+            };
+        };
+        """)
+
+    def test_deleted_statement(self):
+        stmt = Assign(SymbolRef("x"), Constant(1))
+        tree = CFile("myfile", [Block([stmt, Return(SymbolRef("x"))])])
+        stmt.delete()
+        self._check_code(tree, """\
+        // <file: myfile.c>
+        {
+            return x;
+        }
+        """)
+
+
+class TestCodegenMemo(CtreeTest):
+    def setUp(self):
+        import ctree
+        from ctree.codegen import CODEGEN_MEMO
+        self.old_memo = ctree.CONFIG.get('jit', 'CODEGEN_MEMO')
+        ctree.CONFIG.set('jit', 'CODEGEN_MEMO', '16')
+        CODEGEN_MEMO.clear()
+
+    def tearDown(self):
+        import ctree
+        ctree.CONFIG.set('jit', 'CODEGEN_MEMO', self.old_memo)
+
+    def _helper(self, value=2):
+        return FunctionDecl(c_int(), "helper", [SymbolRef("x", c_int())],
+                            [Return(Mul(SymbolRef("x"), Constant(value)))])
+
+    def test_subtree_key(self):
+        from ctree.codegen import subtree_key
+        self.assertEqual(subtree_key(self._helper()),
+                         subtree_key(self._helper()))
+        self.assertNotEqual(subtree_key(self._helper()),
+                            subtree_key(self._helper(3)))
+        self.assertNotEqual(subtree_key(Constant(1)), subtree_key(Constant(1.0)))
+        self.assertNotEqual(subtree_key(SymbolRef("x", c_int())),
+                            subtree_key(SymbolRef("x", c_double())))
+        forced = Constant(1)
+        forced._force_parentheses = True
+        self.assertNotEqual(subtree_key(forced), subtree_key(Constant(1)))
+        deleted = Constant(1)
+        deleted.delete()
+        self.assertIsNone(subtree_key(deleted))
+        extra = Return(Constant(1))
+        extra.label = "done"
+        self.assertNotEqual(subtree_key(extra), subtree_key(Return(Constant(1))))
+
+    def test_registered_types(self):
+        import ctree
+        from ctree.types import register_type_codegenerators
+
+        class c_index(c_int):
+            pass
+
+        def helper():
+            return FunctionDecl(c_int(), "helper", [SymbolRef("x", c_index())],
+                                [Return(SymbolRef("x"))])
+        self.assertIn("int helper(int x)", CFile("myfile", [helper()]).codegen())
+        register_type_codegenerators({c_index: lambda ctype: "index_t"})
+        try:
+            self.assertIn("int helper(index_t x)",
+                          CFile("myfile", [helper()]).codegen())
+        finally:
+            del ctree._TYPE_CODEGENERATORS[c_index]
+
+    def test_reuse(self):
+        first = CFile("myfile", [self._helper()])
+        text = first.codegen()
+        helper = self._helper()
+        helper._codegen_into = lambda *args: self.fail("regenerated")
+        self.assertEqual(CFile("myfile", [helper]).codegen(), text)
+
+    def test_changed(self):
+        CFile("myfile", [self._helper()]).codegen()
+        self._check_code(CFile("myfile", [self._helper(3)]), """\
+        // <file: myfile.c>
+        int helper(int x) {
+            return x * 3;
+        };
+        """)
@@ -1,8 +1,82 @@
+import os
+import sys
+import subprocess
 import unittest
 
+
+def _run_import(code, *flags):
+    """Runs code in a fresh interpreter, returns (stdout, stderr)."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    process = subprocess.Popen([sys.executable] + list(flags) + ['-c', code],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=env)
+    out, err = process.communicate()
+    return out.decode(), err.decode()
+
+
 class TestImport(unittest.TestCase):
+    # time budget in seconds for a cold 'import ctree' (cumulative, as
+    # reported by -X importtime); generous, to catch heavy imports sneaking
+    # back in rather than to measure slow machines
+    IMPORT_TIME_BUDGET = 1.0
+
     def test_import_base(self):
         import ctree
 
     def test_import_nodes(self):
         import ctree.c.nodes
+
+    def test_optional_modules_not_loaded(self):
+        out, _ = _run_import(
+            "import sys, ctree, ctree.jit; print(' '.join(sorted(m for m in "
+            "('numpy', 'pycl', 'pygments', 'ctree.np', 'ctree.visual."
+            "dot_manager') if m in sys.modules)))")
+        self.assertEqual(out.strip(), "")
+
+    def test_numpy_support_loaded_on_use(self):
+        out, _ = _run_import(
+            "import numpy, ctree.c.nodes; from ctree.types import get_ctype; "
+            "print(type(get_ctype(numpy.float32(1))).__name__)")
+        self.assertEqual(out.strip(), "c_float")
+
+    @unittest.skipIf(sys.version_info < (3, 7), "needs -X importtime")
+    def test_import_time(self):
+        _, err = _run_import("import ctree", "-X", "importtime")
+        cumulative = [int(line.split('|')[1]) for line in err.splitlines()
+                      if line.startswith('import time:') and
+                      line.split('|')[2].strip() == 'ctree']
+        self.assertEqual(len(cumulative), 1, err)
+        self.assertLess(cumulative[0] / 1e6, self.IMPORT_TIME_BUDGET)
+
+    def test_ndpointer_codegen(self):
+        # an ndpointer is also a c_void_p, which must not win
+        out, err = _run_import(
+            "import numpy; from ctree.c.nodes import SymbolRef; "
+            "print(SymbolRef('A', numpy.ctypeslib.ndpointer(numpy.float64)())"
+            ".codegen())")
+        self.assertEqual(out.strip(), "double* A", err)
+
+    def test_import_loads_only_base(self):
+        out, _ = _run_import(
+            "import sys, ctree; print(ctree.OCL_ENABLED in (True, False)); "
+            "print(' '.join(sorted(m for m in sys.modules "
+            "if m.startswith('ctree'))))")
+        self.assertEqual(out.split(), ["True", "ctree"])
+
+    def test_ocl_enabled_on_use(self):
+        out, _ = _run_import(
+            "import ctree; print(type(ctree.OCL_ENABLED).__name__); "
+            "enabled = bool(ctree.OCL_ENABLED); "
+            "print(type(ctree.OCL_ENABLED).__name__); "
+            "import sys; print(enabled == ('pycl' in sys.modules))")
+        self.assertEqual(out.split(), ["_LazyValue", "bool", "True"])
+
+    def test_config_txt_on_use(self):
+        out, _ = _run_import(
+            "import ctree; print(type(ctree.CONFIG_TXT).__name__); "
+            "text = ctree.CONFIG_TXT.splitlines(); "
+            "print(type(ctree.CONFIG_TXT).__name__); print('[jit]' in text)")
+        self.assertEqual(out.split(), ["_LazyValue", "str", "True"])
@@ -86,6 +86,158 @@ class TestJit(unittest.TestCase):
         self.assertEqual(l2norm(np.ones(12, dtype=np.float64)),
                          c_l2norm_fn(np.ones(12, dtype=np.float64), 12))
 
+    def test_parallel_project(self):
+        old_jobs = CONFIG.get('jit', 'COMPILE_JOBS')
+        try:
+            for jobs in ('1', '4'):
+                CONFIG.set('jit', 'COMPILE_JOBS', jobs)
+                trees = [copy.deepcopy(identity_ast) for i in range(4)]
+                for i, tree in enumerate(trees):
+                    tree.name = "identity_%d" % i
+                files = [CFile("test_parallel_project_%s_%d" % (jobs, i),
+                               [tree], path=CONFIG.get('jit', 'COMPILE_PATH'))
+                         for i, tree in enumerate(trees)]
+                mod = Project(files).codegen()
+                for tree in trees:
+                    c_identity_fn = mod.get_callable(tree.name,
+                                                     tree.get_type())
+                    self.assertEqual(identity(7), c_identity_fn(7))
+        finally:
+            CONFIG.set('jit', 'COMPILE_JOBS', old_jobs)
+
+    def _cross_file_project(self, name):
+        helper = FunctionDecl(ctypes.c_int(), "%s_twice" % name,
+                              [SymbolRef("x", ctypes.c_int())],
+                              [Return(Mul(SymbolRef("x"), Constant(2)))])
+        prototype = FunctionDecl(ctypes.c_int(), helper.name,
+                                 [SymbolRef("x", ctypes.c_int())])
+        entry = FunctionDecl(ctypes.c_int(), name,
+                             [SymbolRef("x", ctypes.c_int())],
+                             [Return(Add(FunctionCall(SymbolRef(helper.name),
+                                                      [SymbolRef("x")]),
+                                         Constant(1)))])
+        path = CONFIG.get('jit', 'COMPILE_PATH')
+        files = [CFile("%s_helper" % name, [helper], path=path),
+                 CFile("%s_entry" % name, [prototype, entry], path=path)]
+        return Project(files), entry
+
+    def test_linked_project(self):
+        project, entry = self._cross_file_project("test_linked_project")
+        mod = project.codegen()
+        self.assertEqual(len(mod.submodules), 1)
+        c_fn = mod.get_callable(entry.name, entry.get_type())
+        self.assertEqual(c_fn(20), 41)
+
+    def test_linked_project_lto(self):
+        old_lto = CONFIG.get('jit', 'LTO')
+        CONFIG.set('jit', 'LTO', 'True')
+        try:
+            project, entry = self._cross_file_project("test_lto_project")
+            mod = project.codegen()
+            c_fn = mod.get_callable(entry.name, entry.get_type())
+            self.assertEqual(c_fn(20), 41)
+        finally:
+            CONFIG.set('jit', 'LTO', old_lto)
+
+    def test_source_not_saved(self):
+        cfile = CFile("test_source_not_saved", [copy.deepcopy(identity_ast)],
+                      path=tempfile.mkdtemp())
+        so_file = cfile._compile(cfile.codegen())
+        self.assertTrue(os.path.exists(so_file))
+        self.assertFalse(os.path.exists(
+            os.path.join(cfile.path, cfile.get_filename())))
+
+    def test_source_saved(self):
+        old_save = CONFIG.get('jit', 'SAVE_SOURCE')
+        CONFIG.set('jit', 'SAVE_SOURCE', 'True')
+        try:
+            path = tempfile.mkdtemp()
+            cfile = CFile("test_source_saved", [copy.deepcopy(identity_ast)],
+                          path=path)
+            so_file = cfile._compile(cfile.codegen())
+            self.assertTrue(os.path.exists(
+                os.path.join(path, cfile.get_filename())))
+            cached = getFile(os.path.join(path, cfile.get_filename()))
+            self.assertEqual(cached._compile(cached.codegen()), so_file)
+        finally:
+            CONFIG.set('jit', 'SAVE_SOURCE', old_save)
+
+    def test_cache_hit_after_restart(self):
+        import tempfile
+        options = ('COMPILE_PATH', 'STORE_PATH', 'SAVE_SOURCE')
+        old = dict((option, CONFIG.get('jit', option)) for option in options)
+        CONFIG.set('jit', 'COMPILE_PATH', tempfile.mkdtemp())
+        CONFIG.set('jit', 'STORE_PATH', tempfile.mkdtemp())
+        CONFIG.set('jit', 'SAVE_SOURCE', 'False')
+        transformed = []
+
+        class Counting(TestTranslator):
+            def transform(self, tree, program_config):
+                transformed.append(program_config)
+                return super(Counting, self).transform(tree, program_config)
+
+        def f(x):
+            return x + 3
+        try:
+            self.assertEqual(Counting.from_function(f, 'test_restart')(3), 6)
+            # as a new process would, with a new specializer
+            self.assertEqual(Counting.from_function(f, 'test_restart')(3), 6)
+            self.assertEqual(len(transformed), 1)
+            # the build is gone from the store, and no source was saved
+            CONFIG.set('jit', 'STORE_PATH', tempfile.mkdtemp())
+            self.assertEqual(Counting.from_function(f, 'test_restart')(3), 6)
+            self.assertEqual(len(transformed), 2)
+        finally:
+            for option in options:
+                CONFIG.set('jit', option, old[option])
+
+    def test_no_highlight_without_logging(self):
+        import logging
+        import ctree.c.nodes
+
+        def fail(*args):
+            raise AssertionError("highlighted with logging disabled")
+        highlight = ctree.c.nodes.highlight
+        ctree.c.nodes.highlight = fail
+        logger = logging.getLogger('ctree.c.nodes')
+        old_level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            tree = copy.deepcopy(identity_ast)
+            tree.name = "test_no_highlight"
+            cfile = CFile(tree.name, [tree], path=tempfile.mkdtemp())
+            self.assertTrue(cfile._compile(cfile.codegen()))
+        finally:
+            ctree.c.nodes.highlight = highlight
+            logger.setLevel(old_level)
+
+    def test_dump_build_info(self):
+        import json
+        old_dump = CONFIG.get('log', 'DUMP_PATH')
+        dump_path = tempfile.mkdtemp()
+        CONFIG.set('log', 'DUMP_PATH', dump_path)
+        try:
+            cfile = CFile("test_dump_build_info",
+                          [copy.deepcopy(identity_ast)],
+                          path=tempfile.mkdtemp())
+            program_text = cfile.codegen()
+            cfile._compile(program_text)
+            dumps = os.listdir(dump_path)
+            self.assertEqual(len(dumps), 1)
+            with open(os.path.join(dump_path, dumps[0])) as dump_file:
+                info = json.load(dump_file)
+            self.assertEqual(info['source'], program_text)
+            self.assertEqual(info['CFLAGS'], CONFIG.get('c', 'CFLAGS'))
+            self.assertEqual(info['backend'], 'cc')
+        finally:
+            CONFIG.set('log', 'DUMP_PATH', old_dump)
+
+    def test_compile_error(self):
+        import subprocess
+        cfile = CFile("test_compile_error", [], path=tempfile.mkdtemp())
+        with self.assertRaises(subprocess.CalledProcessError):
+            cfile._compile("this is not C;")
+
     def test_getFile(self):
         getFile(os.path.join(CONFIG.get('jit','COMPILE_PATH'),'test_l2norm.c'))
 
@@ -104,3 +256,212 @@ class TestAuxiliary(unittest.TestCase):
 
         c_f = TestTranslator.from_function(f, 'test_from_function')
         self.assertEqual(c_f(3), 6)
+
+    def test_hash_memoized(self):
+        import inspect
+        c_identity = TestTranslator(identity_ast, 'test_hash_memoized')
+        first = hash(c_identity)
+        getsource = inspect.getsource
+
+        def fail(obj):
+            raise AssertionError("re-read source of %s" % obj)
+        inspect.getsource = fail
+        try:
+            self.assertEqual(hash(c_identity), first)
+            other = TestTranslator(identity_ast, 'test_hash_memoized')
+            self.assertEqual(hash(other), first)
+        finally:
+            inspect.getsource = getsource
+
+
+class TestArgumentSignature(unittest.TestCase):
+    def test_classify(self):
+        import numpy as np
+        signature = ArgumentSignature('dtype', 'ndim', 'shape', 'contiguous')
+        A = np.ones((3, 4), dtype=np.float32)
+        info, scalar = signature((A, 2))
+        self.assertEqual(info, ArgInfo(np.ndarray, np.dtype(np.float32), 2,
+                                       (3, 4), None, 'C', None))
+        self.assertEqual(scalar.type, int)
+        self.assertEqual(signature((A.T, 2))[0].contiguous, 'F')
+        self.assertIsNone(signature((A[:, ::2], 2))[0].contiguous)
+
+    def test_cached(self):
+        import numpy as np
+        signature = ArgumentSignature('dtype', 'shape')
+        first = signature((np.ones(12),))
+        self.assertIs(signature((np.zeros(12),)), first)
+        self.assertIsNot(signature((np.ones(12, dtype=np.int32),)), first)
+        self.assertNotEqual(signature((np.ones(13),)), first)
+
+    def test_aligned(self):
+        import numpy as np
+        signature = ArgumentSignature('aligned', alignment=8)
+        A = np.ones(16, dtype=np.int8)
+        offset = -A.__array_interface__['data'][0] % 8
+        self.assertTrue(signature((A[offset:],))[0].aligned)
+        self.assertFalse(signature((A[offset + 1:],))[0].aligned)
+
+    def test_unknown_feature(self):
+        with self.assertRaises(ValueError):
+            ArgumentSignature('colour')
+
+    def test_as_ctype(self):
+        import numpy as np
+        signature = ArgumentSignature('dtype', 'ndim', 'shape', 'contiguous')
+        info, scalar = signature((np.ones(12), 2.0))
+        self.assertIs(info.as_ctype(), np.ctypeslib.ndpointer(
+            np.float64, 1, (12,), 'C_CONTIGUOUS'))
+        self.assertIs(scalar.as_ctype(), ctypes.c_double)
+
+    def test_specializer(self):
+        class SignatureTranslator(LazySpecializedFunction):
+            arg_signature = ArgumentSignature()
+
+            def transform(self, tree, program_config):
+                arg_types = [info.as_ctype()
+                             for info in program_config.args_subconfig]
+                tree = PyBasicConversions().visit(tree.body[0])
+                tree.return_type = arg_types[0]()
+                for param, ty in zip(tree.params, arg_types):
+                    param.type = ty()
+                return [CFile(tree.name, [tree])]
+
+            def finalize(self, transform_result, program_config):
+                arg_types = [info.as_ctype()
+                             for info in program_config.args_subconfig]
+                func_type = ctypes.CFUNCTYPE(arg_types[0], *arg_types)
+                return BasicFunction(transform_result[0].name,
+                                     Project(transform_result), func_type)
+
+        def f(x):
+            return x + 3
+
+        c_f = SignatureTranslator.from_function(f, 'test_arg_signature')
+        self.assertEqual(c_f(3), 6)
+        self.assertEqual(c_f(0.5), 3.5)
+
+    def test_numpy_scalars(self):
+        import numpy as np
+        signature = ArgumentSignature('dtype', 'ndim', 'shape')
+        info, = signature((np.float64(1.0),))
+        self.assertFalse(info.is_array())
+        self.assertIs(info.as_ctype(), ctypes.c_double)
+
+    def test_other_buffers(self):
+        signature = ArgumentSignature('dtype', 'strides')
+        info, = signature((memoryview(b"abcd"),))
+        self.assertEqual(info, ArgInfo(memoryview, None, None, None, None,
+                                       None, None))
+        self.assertFalse(info.is_array())
+
+    def test_keyword_arguments(self):
+        import numpy as np
+        signature = ArgumentSignature('dtype')
+        A = np.ones(4)
+        self.assertEqual(signature((A,), {'scale': 2.0}),
+                         (signature((A,))[0], ('scale', signature((2.0,))[0])))
+        self.assertNotEqual(signature((A,), {'scale': 2.0}),
+                            signature((A,), {'scale': 2}))
+        self.assertEqual(signature((), {'b': 1, 'a': 2.0}),
+                         signature((), {'a': 2.0, 'b': 1}))
+
+    def test_cache_bounded(self):
+        import numpy as np
+        signature = ArgumentSignature('shape')
+        signature.max_cached = 4
+        for n in range(1, 11):
+            signature((np.ones(n),))
+            self.assertLessEqual(len(signature._cache), 4)
+
+    def test_config_key(self):
+        import numpy as np
+
+        class Signed(LazySpecializedFunction):
+            arg_signature = ArgumentSignature('dtype', 'ndim', 'shape')
+
+        spec = Signed(identity_ast, 'test_config_key')
+        config = spec.get_program_config((np.ones((4, 4)),), {})
+        # hashable as is, so used directly without freezing
+        self.assertIs(spec._config_key(config), config)
+        self.assertEqual(spec.get_program_config((np.zeros((4, 4)),), {}),
+                         config)
+        self.assertNotEqual(spec.get_program_config((np.ones((4, 5)),), {}),
+                            config)
+        self.assertNotEqual(
+            spec.get_program_config((np.ones((4, 4)),), {'scale': 2.0}),
+            config)
+
+
+class TestFunctionCache(unittest.TestCase):
+    def test_max_count(self):
+        cache = FunctionCache(max_count=2)
+        cache['a'], cache['b'] = 1, 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(sorted(cache), ['a', 'c'])
+        self.assertIsNone(cache.get('b'))
+
+    def test_max_size(self):
+        cache = FunctionCache(max_size=100)
+        cache._size = lambda csf: csf
+        cache['a'], cache['b'] = 60, 30
+        self.assertEqual(cache.total_size, 90)
+        cache['c'] = 20
+        self.assertEqual(sorted(cache), ['b', 'c'])
+        self.assertEqual(cache.total_size, 50)
+        cache['d'] = 200
+        self.assertEqual(list(cache), ['d'])
+        del cache['d']
+        self.assertEqual(cache.total_size, 0)
+
+    def test_eviction_unloads(self):
+        import gc
+        from ctree import STATS
+        old_max = CONFIG.get('jit', 'MAX_FUNCTIONS')
+        CONFIG.set('jit', 'MAX_FUNCTIONS', '1')
+        try:
+            def f(x):
+                return x + 3
+
+            c_f = TestTranslator.from_function(f, 'test_eviction_unloads')
+            self.assertEqual(c_f(3), 6)
+            gc.collect()
+            evictions = STATS._counter["specialized function cache eviction"]
+            unloads = STATS._counter["shared library unloaded"]
+            self.assertEqual(c_f(0.5), 3.5)
+            gc.collect()
+            self.assertEqual(len(c_f.concrete_functions), 1)
+            self.assertEqual(
+                STATS._counter["specialized function cache eviction"],
+                evictions + 1)
+            self.assertEqual(STATS._counter["shared library unloaded"],
+                             unloads + 1)
+        finally:
+            CONFIG.set('jit', 'MAX_FUNCTIONS', old_max)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = FunctionCache(max_count=1, on_evict=evicted.append)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(evicted, ['a'])
+
+    def test_eviction_forgets_config(self):
+        old_max = CONFIG.get('jit', 'MAX_FUNCTIONS')
+        CONFIG.set('jit', 'MAX_FUNCTIONS', '1')
+        try:
+            def f(x):
+                return x + 3
+
+            c_f = TestTranslator.from_function(f, 'test_eviction_forgets')
+            c_f.hot_calls = 2
+            self.assertEqual(c_f(3), 6)
+            first, = c_f.concrete_functions
+            self.assertIn(first, c_f.profiles)
+            self.assertEqual(c_f(0.5), 3.5)
+            self.assertNotIn(first, c_f.profiles)
+            self.assertNotIn(first, c_f._installed)
+            self.assertNotIn(first, c_f._promoted)
+        finally:
+            CONFIG.set('jit', 'MAX_FUNCTIONS', old_max)
@@ -3,7 +3,7 @@ import unittest
 from ctree.nodes import *
 from ctree.jit import LazySpecializedFunction
 from ctree.jit import ConcreteSpecializedFunction
-from ctree.frontend import dump
+from ctree.frontend import dump, get_ast
 from fixtures.sample_asts import *
 import ctypes
 
@@ -37,6 +37,21 @@ class BasicFunction(ConcreteSpecializedFunction):
         return self._c_function(*args, **kwargs)
 
 
+class DirectFunction(BasicFunction):
+    direct_call = True
+
+    def __call__(self, *args, **kwargs):
+        raise AssertionError("batch() went through __call__")
+
+
+class DirectTranslator(TestTranslator):
+    def finalize(self, transform_result, program_config):
+        proj = Project(transform_result)
+        arg_types = program_config[0]['arg_typesig']
+        func_type = ctypes.CFUNCTYPE(arg_types[0], *arg_types)
+        return DirectFunction(transform_result[0].name, proj, func_type)
+
+
 class BadArgs(LazySpecializedFunction):
     def args_to_subconfig(self, args):
         return {'args': args}
@@ -101,5 +116,155 @@ class TestSpecializers(unittest.TestCase):
         for i in range(20):
             self.assertEqual(c_fib(1), fib(1))
 
+    def test_one_tree_copy_per_miss(self):
+        import copy
+        import ctree.jit
+
+        # Laplacian kernel from examples/stencil_grid, unrolled by hand.
+        def kernel(in_grid, out_grid, n):
+            for x in range(1, n - 1):
+                out_grid[x] = 0.5 * in_grid[x]
+                out_grid[x] += 1.0 * in_grid[x - 1]
+                out_grid[x] += 1.0 * in_grid[x + 1]
+                out_grid[x] += 1.0 * in_grid[x - n]
+                out_grid[x] += 1.0 * in_grid[x + n]
+
+        copies = []
+
+        class CountingCopy(object):
+            @staticmethod
+            def deepcopy(tree):
+                copies.append(tree)
+                return copy.deepcopy(tree)
+
+        class Recorder(TestTranslator):
+            def transform(self, tree, program_config):
+                return [CFile("test_one_tree_copy_per_miss", [])]
+
+            def finalize(self, transform_result, program_config):
+                return NullFunction()
+
+        class NullFunction(ConcreteSpecializedFunction):
+            def __init__(self, *args):
+                pass
+
+            def __call__(self, *args):
+                return None
+
+        real_copy = ctree.jit.copy
+        ctree.jit.copy = CountingCopy
+        try:
+            spec = Recorder(get_ast(kernel), 'test_one_tree_copy_per_miss')
+            spec(1, 2, 3)
+        finally:
+            ctree.jit.copy = real_copy
+        self.assertEqual(len(copies), 1)
+
+    def test_async_compile(self):
+        class AsyncTranslator(TestTranslator):
+            def interpret(self, *args):
+                return "interpreted"
+
+        c_fib = AsyncTranslator(fib_ast, 'test_async_compile',
+                                async_compile=True)
+        self.assertEqual(c_fib(1), "interpreted")
+        for pending in list(c_fib._pending.values()):
+            pending.wait()
+        self.assertEqual(c_fib(1), fib(1))
+        self.assertEqual(len(c_fib.concrete_functions), 1)
+        self.assertFalse(c_fib._pending)
+
+    def test_async_compile_once_per_config(self):
+        import threading
+
+        class AsyncTranslator(TestTranslator):
+            def interpret(self, *args):
+                return "interpreted"
+
+        c_fib = AsyncTranslator(fib_ast, 'test_async_compile_once',
+                                async_compile=True)
+        build, built = c_fib._build, []
+
+        def counting_build(*args):
+            built.append(args)
+            return build(*args)
+        c_fib._build = counting_build
+        threads = [threading.Thread(target=c_fib, args=(1,))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for pending in list(c_fib._pending.values()):
+            pending.wait()
+        self.assertEqual(c_fib(1), fib(1))
+        self.assertEqual(len(built), 1)
+        self.assertFalse(c_fib._pending)
+
+    def test_async_compile_error(self):
+        class Failing(TestTranslator):
+            def interpret(self, *args):
+                return "interpreted"
+
+            def transform(self, tree, program_config):
+                raise ValueError("no code for you")
+
+        c_fib = Failing(fib_ast, 'test_async_compile_error',
+                        async_compile=True)
+        self.assertEqual(c_fib(1), "interpreted")
+        for pending in list(c_fib._pending.values()):
+            pending.wait()
+        with self.assertRaises(ValueError):
+            c_fib(1)
+        self.assertFalse(c_fib._pending)
+
+    def test_async_compile_without_fallback(self):
+        c_fib = TestTranslator(fib_ast, 'test_async_compile_without_fallback',
+                               async_compile=True)
+        self.assertEqual(c_fib(1), fib(1))
+
+    def test_cache_hit_skips_filesystem(self):
+        from ctree import CONFIG
+        old_cache = CONFIG.get('jit', 'CACHE')
+        CONFIG.set('jit', 'CACHE', 'True')
+        try:
+            c_fib = TestTranslator(fib_ast, 'test_cache_hit_skips_filesystem')
+            self.assertEqual(c_fib(1), fib(1))
+            self.assertEqual(len(c_fib.concrete_functions), 1)
+
+            def fail(*args):
+                raise AssertionError("cache hit touched the filesystem")
+            c_fib.config_to_dirname = fail
+            self.assertEqual(c_fib(1), fib(1))
+        finally:
+            CONFIG.set('jit', 'CACHE', old_cache)
+
+    def test_batch(self):
+        c_fib = TestTranslator(fib_ast, 'test_batch')
+        args = [(1,), (2.0,), (3,), (4.0,)]
+        self.assertEqual(c_fib.batch(args), [fib(*a) for a in args])
+
+    def test_batch_direct_call(self):
+        c_gcd = DirectTranslator(gcd_ast, 'test_batch_direct_call')
+        args = [(44, 122), (3, 9), (12, 18)]
+        self.assertEqual(c_gcd.batch(args), [gcd(*a) for a in args])
+        self.assertEqual(c_gcd.map([44, 3], [122, 9]), [gcd(44, 122), gcd(3, 9)])
+        csf, = c_gcd.concrete_functions.values()
+        with self.assertRaises(TypeError):
+            csf.batch([(44, 122), (3,)])
+
+    def test_batch_groups_by_config(self):
+        built = []
+
+        class Recorder(DirectTranslator):
+            def _build(self, program_config, config_key):
+                built.append(program_config)
+                return super(Recorder, self)._build(program_config, config_key)
+
+        c_fib = Recorder(fib_ast, 'test_batch_groups_by_config')
+        args = [(1,), (2.0,), (3,), (4.0,), (5,)]
+        self.assertEqual(c_fib.batch(args), [fib(*a) for a in args])
+        self.assertEqual(len(built), 2)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
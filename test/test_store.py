@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ctree.store import ArtifactStore, compiler_identity, _STALE_TEMP_AGE
+
+
+class TestArtifactStore(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = ArtifactStore(self.path, grace=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _put(self, key, contents):
+        tmp = self.store.temp_path()
+        with open(tmp, 'w') as tmp_file:
+            tmp_file.write(contents)
+        return self.store.put(key, tmp)
+
+    def test_key_is_stable(self):
+        self.assertEqual(ArtifactStore.key("a", "b"), ArtifactStore.key("a", "b"))
+        self.assertNotEqual(ArtifactStore.key("a", "b"), ArtifactStore.key("ab"))
+
+    def test_miss(self):
+        self.assertIsNone(self.store.get(ArtifactStore.key("missing")))
+
+    def test_put_get(self):
+        key = ArtifactStore.key("program")
+        path = self._put(key, "contents")
+        self.assertEqual(self.store.get(key), path)
+        with open(path) as artifact:
+            self.assertEqual(artifact.read(), "contents")
+
+    def test_dedup(self):
+        key = ArtifactStore.key("program")
+        first = self._put(key, "first")
+        second = self._put(key, "second")
+        self.assertEqual(first, second)
+        with open(first) as artifact:
+            self.assertEqual(artifact.read(), "first")
+        self.assertEqual(os.listdir(self.path), [key[:2]])
+
+    def test_lru_eviction(self):
+        self.store.max_size = 10
+        keys = [ArtifactStore.key(str(i)) for i in range(3)]
+        paths = [self._put(key, "x" * 4) for key in keys[:2]]
+        os.utime(paths[0], (1, 1))
+        os.utime(paths[1], (2, 2))
+        self.store.get(keys[0])  # now the most recently used
+        self._put(keys[2], "x" * 4)
+        self.assertIsNotNone(self.store.get(keys[0]))
+        self.assertIsNone(self.store.get(keys[1]))
+        self.assertIsNotNone(self.store.get(keys[2]))
+        self.assertLessEqual(self.store.size(), 10)
+
+    def test_evicted_by_key(self):
+        header, other = ArtifactStore.key("header"), ArtifactStore.key("other")
+        paths = []
+        for key, ext in ((header, ".h"), (header, ".h.gch"), (other, ".so")):
+            tmp = self.store.temp_path(ext)
+            with open(tmp, 'w') as tmp_file:
+                tmp_file.write("x" * 4)
+            paths.append(self.store.put(key, tmp, ext))
+        os.utime(paths[0], (1, 1))
+        os.utime(paths[2], (2, 2))
+        self.store.get(header, ".h.gch")
+        self.store.max_size = 10
+        self.store.evict()
+        # the header counts as used along with its precompiled form
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertFalse(os.path.exists(paths[2]))
+
+    def test_scans_only_when_full(self):
+        self.store.max_size = 10
+        scans = []
+        entries = self.store._entries
+
+        def counting_entries():
+            scans.append(True)
+            return entries()
+        self.store._entries = counting_entries
+        keys = [ArtifactStore.key(str(i)) for i in range(3)]
+        self._put(keys[0], "x" * 4)
+        self.assertEqual(len(scans), 1)
+        # within max_size as far as this store knows
+        self._put(keys[1], "x" * 4)
+        self.assertEqual(len(scans), 1)
+        self._put(keys[2], "x" * 4)
+        self.assertEqual(len(scans), 2)
+        self.assertLessEqual(self.store.size(), 10)
+
+    def test_grace_period(self):
+        self.store.max_size = 10
+        self.store.grace = 60
+        keys = [ArtifactStore.key(str(i)) for i in range(3)]
+        paths = [self._put(key, "x" * 4) for key in keys]
+        # just used, maybe not loaded yet
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+        os.utime(paths[0], (1, 1))
+        self.store.evict()
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertTrue(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(paths[2]))
+
+    def test_stale_temp_files(self):
+        stale, fresh = self.store.temp_path(), self.store.temp_path()
+        old = time.time() - _STALE_TEMP_AGE - 1
+        os.utime(stale, (old, old))
+        self.store.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_compiler_identity(self):
+        self.assertEqual(compiler_identity("no-such-compiler"), "no-such-compiler")
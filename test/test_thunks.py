@@ -0,0 +1,121 @@
+import ctypes
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from ctree import CONFIG
+from ctree.jit import JitModule
+from ctree.c.nodes import FunctionDecl
+from ctree.thunks import thunk_source, make_thunk, get_thunk_module
+from fixtures.sample_asts import *
+
+
+def compile_with_thunks(tree, name):
+    old_thunks = CONFIG.get('jit', 'THUNKS')
+    CONFIG.set('jit', 'THUNKS', 'True')
+    try:
+        mod = JitModule()
+        mod._link_in(CFile("test_thunk_%s" % name, [tree])._compile(tree.codegen()))
+        entry = tree.find(FunctionDecl, name=name)
+        return mod.get_callable(entry.name, entry.get_type())
+    finally:
+        CONFIG.set('jit', 'THUNKS', old_thunks)
+
+
+class TestThunks(unittest.TestCase):
+    def test_scalars(self):
+        c_gcd = compile_with_thunks(gcd_ast, "gcd")
+        self.assertNotIsInstance(c_gcd, ctypes._CFuncPtr)
+        self.assertEqual(gcd(44, 122), c_gcd(44, 122))
+        with self.assertRaises(TypeError):
+            c_gcd(44)
+        with self.assertRaises(TypeError):
+            c_gcd(44, "122")
+
+    def test_float(self):
+        c_choose = compile_with_thunks(choose_ast, "choose")
+        self.assertEqual(choose(0.2, 44, 122), c_choose(0.2, 44, 122))
+        self.assertEqual(choose(0.8, 44, 122), c_choose(0.8, 44, 122))
+
+    def test_ndpointer(self):
+        c_l2norm = compile_with_thunks(l2norm_ast, "l2norm")
+        A = np.ones(12, dtype=np.float64)
+        self.assertEqual(l2norm(A), c_l2norm(A, 12))
+        with self.assertRaises(TypeError):
+            c_l2norm(np.ones(12, dtype=np.float32), 12)
+        with self.assertRaises(TypeError):
+            c_l2norm(np.ones(13, dtype=np.float64), 13)
+        with self.assertRaises(TypeError):
+            c_l2norm(np.ones((3, 4), dtype=np.float64), 12)
+
+    def test_unsupported(self):
+        with self.assertRaises(NotImplementedError):
+            thunk_source(ctypes.CFUNCTYPE(None, ctypes.c_char_p))
+
+    def _rebind(self, tree, name, argtypes):
+        """Returns a thunk calling function name of tree with argtypes."""
+        mod = JitModule()
+        mod._link_in(CFile("test_thunk_%s" % name, [tree])
+                     ._compile(tree.codegen()))
+        entry = tree.find(FunctionDecl, name=name)
+        typesig = ctypes.CFUNCTYPE(entry.get_type()._restype_, *argtypes)
+        return make_thunk(mod._get_c_function(name, typesig), typesig)
+
+    def test_complex(self):
+        c_l2norm = self._rebind(l2norm_ast, "l2norm", [
+            np.ctypeslib.ndpointer(np.complex128, 1, (6,)), ctypes.c_int])
+        # the 6 complex numbers are 12 doubles to the kernel
+        A = np.ones(6, dtype=np.complex128)
+        self.assertEqual(c_l2norm(A, 12), np.sqrt(6))
+        with self.assertRaises(TypeError):
+            c_l2norm(np.ones(6, dtype=np.complex64), 12)
+        with self.assertRaises(TypeError):
+            c_l2norm(np.ones(12, dtype=np.float64)[:6], 12)
+
+    def test_aliased_dtypes(self):
+        c_l2norm = self._rebind(l2norm_ast, "l2norm", [
+            np.ctypeslib.ndpointer(np.int64, 1, (12,)), ctypes.c_int])
+        for dtype in (np.int64, np.longlong):
+            self.assertEqual(c_l2norm(np.zeros(12, dtype=dtype), 12), 0.0)
+        with self.assertRaises(TypeError):
+            c_l2norm(np.zeros(12, dtype=np.uint64), 12)
+        with self.assertRaises(TypeError):
+            c_l2norm(np.zeros(12, dtype=np.float64), 12)
+        with self.assertRaises(TypeError):
+            c_l2norm(np.zeros(12, dtype='>i8'), 12)
+
+    def test_null_function(self):
+        typesig = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int)
+        with self.assertRaises(ValueError):
+            get_thunk_module(typesig).bind(0, None)
+
+    def test_releases_gil(self):
+        flag = SymbolRef("flag")
+        clock = FunctionCall(SymbolRef("clock"), [])
+        wait_ast = CFile("generated", [
+            CppInclude("time.h"),
+            FunctionDecl(c_int(), "wait_for", params=[
+                SymbolRef("flag", np.ctypeslib.ndpointer(
+                    dtype=np.int32, ndim=1, shape=(1,))())], defn=[
+                Assign(SymbolRef("end", c_long()),
+                       Add(clock, Mul(Constant(2),
+                                      SymbolRef("CLOCKS_PER_SEC")))),
+                # gives up after two seconds of CPU time
+                While(And(Eq(ArrayRef(flag, Constant(0)), Constant(0)),
+                          Lt(clock, SymbolRef("end"))), [Pass()]),
+                Return(ArrayRef(flag, Constant(0)))])])
+        c_wait_for = compile_with_thunks(wait_ast, "wait_for")
+        flag = np.zeros(1, dtype=np.int32)
+
+        def set_flag():
+            time.sleep(0.01)
+            flag[0] = 1
+        setter = threading.Thread(target=set_flag)
+        setter.start()
+        try:
+            # the other thread can only set the flag without the GIL
+            self.assertEqual(c_wait_for(flag), 1)
+        finally:
+            setter.join()
@@ -1,4 +1,5 @@
 import unittest
+import ctypes
 import ctree.c.nodes as C
 from ctree.transforms import ConstantFold
 
@@ -80,3 +81,138 @@ class TestConstantFold(unittest.TestCase):
         self.assertEqual(
             str(tree),
             str(C.Assign(C.SymbolRef("c"), C.SymbolRef("b"))))
+
+
+    def test_floating_operands(self):
+        # d * 0 may be -0.0 or NaN, and 0 - d +0.0 where -d is -0.0
+        d = C.Cast(ctypes.c_double(), C.SymbolRef("d"))
+        for tree in (C.Mul(d, C.Constant(0)), C.Mul(C.Constant(0), d),
+                     C.Sub(C.Constant(0), d)):
+            self.assertEqual(ConstantFold().visit(tree).codegen(),
+                             tree.codegen())
+        self.assertIs(ConstantFold().visit(C.Add(d, C.Constant(0))), d)
+
+
+class TestCSemantics(unittest.TestCase):
+    def _fold(self, tree):
+        return ConstantFold().visit(tree).codegen()
+
+    def test_all_operators(self):
+        cases = [
+            (C.Mod(C.Constant(7), C.Constant(3)), "1"),
+            (C.BitAnd(C.Constant(6), C.Constant(3)), "2"),
+            (C.BitOr(C.Constant(6), C.Constant(3)), "7"),
+            (C.BitXor(C.Constant(6), C.Constant(3)), "5"),
+            (C.BitShL(C.Constant(1), C.Constant(4)), "16"),
+            (C.BitShR(C.Constant(-16), C.Constant(2)), "-4"),
+            (C.Lt(C.Constant(1), C.Constant(2)), "1"),
+            (C.GtE(C.Constant(1), C.Constant(2)), "0"),
+            (C.Eq(C.Constant(1.0), C.Constant(1)), "1"),
+            (C.And(C.Constant(2), C.Constant(0.5)), "1"),
+            (C.Or(C.Constant(0), C.Constant(0)), "0"),
+            (C.Add(C.Constant(1.5), C.Constant(1)), "2.5"),
+            (C.Not(C.Constant(3)), "0"),
+            (C.Sub(C.Constant(3)), "-3"),
+            (C.BitNot(C.Constant(0)), "-1"),
+        ]
+        for tree, expected in cases:
+            self.assertEqual(self._fold(tree), expected)
+
+    def test_integer_division(self):
+        self.assertEqual(self._fold(C.Div(C.Constant(-7), C.Constant(2))),
+                         "-3")
+        self.assertEqual(self._fold(C.Mod(C.Constant(-7), C.Constant(2))),
+                         "-1")
+        self.assertEqual(self._fold(C.Div(C.Constant(7.0), C.Constant(2))),
+                         "3.5")
+
+    def test_unsigned_wraps(self):
+        tree = C.Sub(C.Cast(ctypes.c_uint(), C.Constant(0)), C.Constant(1))
+        self.assertEqual(self._fold(tree), "(uint32_t) 4294967295")
+        tree = C.Cast(ctypes.c_uint(), C.Constant(-1))
+        self.assertEqual(self._fold(tree), "(uint32_t) 4294967295")
+
+    def test_undefined_behavior_not_folded(self):
+        for tree in (C.Add(C.Constant(2147483647), C.Constant(1)),
+                     C.Div(C.Constant(1), C.Constant(0)),
+                     C.Mod(C.Constant(1), C.Constant(0)),
+                     C.BitShL(C.Constant(1), C.Constant(32)),
+                     C.BitShL(C.Constant(-1), C.Constant(1))):
+            self.assertEqual(self._fold(tree), tree.codegen())
+
+    def test_literal_types(self):
+        # 2147483648 is a long literal, so there is no overflow
+        tree = C.Add(C.Constant(2147483648), C.Constant(1))
+        self.assertEqual(self._fold(tree), "2147483649")
+        tree = C.Mul(C.Cast(ctypes.c_long(), C.Constant(65536)),
+                     C.Constant(65536))
+        self.assertEqual(self._fold(tree), "4294967296")
+
+    def test_casts(self):
+        self.assertEqual(self._fold(C.Cast(ctypes.c_int(), C.Constant(2.7))),
+                         "2")
+        self.assertEqual(self._fold(C.Cast(ctypes.c_bool(),
+                                           C.Constant(2))), "(bool) 1")
+        tree = C.Cast(ctypes.c_double(), C.SymbolRef("a"))
+        self.assertEqual(self._fold(tree), "(double) a")
+
+    def test_ternary(self):
+        tree = C.TernaryOp(C.Constant(1), C.SymbolRef("a"), C.Constant(2))
+        self.assertEqual(self._fold(tree), "a")
+        tree = C.TernaryOp(C.Constant(0), C.Constant(1), C.Constant(2.0))
+        self.assertEqual(self._fold(tree), "2.0")
+        tree = C.TernaryOp(C.SymbolRef("c"), C.Constant(1), C.Constant(2))
+        self.assertEqual(self._fold(tree), "c ? 1 : 2")
+
+    def test_types_kept(self):
+        # (long) a * 0 is a long 0, and (bool) a + 0 an int
+        for tree in (C.Mul(C.Cast(ctypes.c_long(), C.SymbolRef("a")),
+                           C.Constant(0)),
+                     C.Add(C.Cast(ctypes.c_bool(), C.SymbolRef("a")),
+                           C.Constant(0))):
+            self.assertEqual(self._fold(tree), tree.codegen())
+
+    def test_side_effects_kept(self):
+        tree = C.Mul(C.FunctionCall(C.SymbolRef("f"), []), C.Constant(0))
+        self.assertEqual(self._fold(tree), "f() * 0")
+        tree = C.And(C.Constant(0), C.FunctionCall(C.SymbolRef("f"), []))
+        self.assertEqual(self._fold(tree), "0")
+
+    def test_reassociate_index(self):
+        tree = C.ArrayRef(C.SymbolRef("a"),
+                          C.Add(C.Add(C.SymbolRef("i"), C.Constant(1)),
+                                C.Constant(2)))
+        self.assertEqual(self._fold(tree), "a[(i + 3)]")
+        tree = C.ArrayRef(C.SymbolRef("a"),
+                          C.Sub(C.Add(C.Constant(1), C.SymbolRef("i")),
+                                C.Constant(1)))
+        self.assertEqual(self._fold(tree), "a[i]")
+        tree = C.ArrayRef(C.SymbolRef("a"),
+                          C.Add(C.Mul(C.Mul(C.SymbolRef("i"), C.Constant(4)),
+                                      C.Constant(2)), C.Constant(-3)))
+        self.assertEqual(self._fold(tree), "a[(i * 8 - 3)]")
+
+    def test_only_ints_reassociated(self):
+        # with a 64-bit n, the unsigned constants would wrap on their own
+        tree = C.ArrayRef(C.SymbolRef("a"), C.Mul(
+            C.Mul(C.SymbolRef("n"), C.Cast(ctypes.c_uint(), C.Constant(65536))),
+            C.Cast(ctypes.c_uint(), C.Constant(65536))))
+        self.assertEqual(self._fold(tree), tree.codegen())
+        tree = C.ArrayRef(C.SymbolRef("a"), C.Sub(
+            C.Add(C.SymbolRef("n"), C.Cast(ctypes.c_uint(), C.Constant(1))),
+            C.Constant(2)))
+        self.assertEqual(self._fold(tree), tree.codegen())
+        # nor are ints whose combination overflows
+        tree = C.ArrayRef(C.SymbolRef("a"), C.Mul(
+            C.Mul(C.SymbolRef("n"), C.Constant(65536)), C.Constant(65536)))
+        self.assertEqual(self._fold(tree), tree.codegen())
+
+    def test_floats_not_reassociated(self):
+        tree = C.Add(C.Add(C.SymbolRef("x"), C.Constant(0.1)),
+                     C.Constant(0.2))
+        self.assertEqual(self._fold(tree), tree.codegen())
+
+    def test_not_mutated(self):
+        index = C.Add(C.Add(C.SymbolRef("i"), C.Constant(1)), C.Constant(2))
+        ConstantFold().visit(C.ArrayRef(C.SymbolRef("a"), index))
+        self.assertEqual(index.codegen(), "i + 1 + 2")
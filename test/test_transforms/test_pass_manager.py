@@ -0,0 +1,132 @@
+import ast
+import unittest
+
+import ctree.c.nodes as C
+from ctree.transformations import PyCtxScrubber, Lifter
+from ctree.transforms import ConstantFold, PassManager
+from ctree.transforms.pass_manager import interests
+
+
+class Counter(ast.NodeTransformer):
+    """Counts the SymbolRefs it is run on, and the nodes it traverses."""
+
+    def __init__(self):
+        self.symbols = 0
+        self.traversed = 0
+
+    def visit_SymbolRef(self, node):
+        self.symbols += 1
+        return node
+
+    def generic_visit(self, node):
+        self.traversed += 1
+        return super(Counter, self).generic_visit(node)
+
+
+class Renamer(ast.NodeTransformer):
+    fusable = True
+
+    def visit_SymbolRef(self, node):
+        return C.SymbolRef(node.name.upper())
+
+
+class Doubler(ast.NodeTransformer):
+    """Replaces each constant with twice its value, returning a new node."""
+    fusable = True
+
+    def visit_Constant(self, node):
+        return C.Mul(C.Constant(2), C.Constant(node.value))
+
+
+class Deleter(ast.NodeTransformer):
+    fusable = True
+
+    def visit_Pass(self, node):
+        return None
+
+
+class TestPassManager(unittest.TestCase):
+
+    def _tree(self):
+        return C.Block([
+            C.Assign(C.SymbolRef("a"), C.Add(C.Constant(1), C.Constant(2))),
+            C.Assign(C.SymbolRef("b"), C.Mul(C.SymbolRef("a"), C.Constant(0))),
+            C.Return(C.Constant(3)),
+        ])
+
+    def test_interests(self):
+        self.assertEqual(interests(ConstantFold()),
+                         {"BinaryOp", "UnaryOp", "Cast", "TernaryOp"})
+        self.assertEqual(interests(PyCtxScrubber()), {"Name"})
+        self.assertEqual(interests(Lifter()), {"FunctionDecl", "CFile"})
+        self.assertIsNone(interests(Counter()))
+
+        class Declared(ast.NodeTransformer):
+            interests = (C.Return, "Constant")
+        self.assertEqual(interests(Declared()), {"Return", "Constant"})
+
+    def test_same_result(self):
+        passes = lambda: [ConstantFold(), Renamer(), PyCtxScrubber(),
+                          Lifter(), Doubler(), ConstantFold()]
+        expected = self._tree()
+        for transformer in passes():
+            expected = transformer.visit(expected)
+        manager = PassManager(passes())
+        self.assertEqual(manager.run(self._tree()).codegen(),
+                         expected.codegen())
+        self.assertEqual(expected.codegen(), "{\n    A = 6;\n"
+                                             "    B = 0;\n    return 6;\n}")
+
+    def test_fused(self):
+        manager = PassManager([ConstantFold(), Renamer(), Lifter(), Doubler()])
+        self.assertEqual([len(group) for group in manager._groups()],
+                         [2, 1, 1])
+        tree = manager.run(self._tree())
+        self.assertEqual(tree.codegen(),
+                         "{\n    A = 2 * 3;\n    B = 2 * 0;\n"
+                         "    return 2 * 3;\n}")
+
+    def test_fused_removal(self):
+        tree = C.Block([C.Pass(), C.Return(C.SymbolRef("a"))])
+        tree = PassManager([Deleter(), Renamer()]).run(tree)
+        self.assertEqual(tree.codegen(), "{\n    return A;\n}")
+
+    def test_skips_subtrees(self):
+        tree = C.CFile("file", [
+            C.FunctionDecl(None, "f", [], [
+                C.Assign(C.SymbolRef("a"), C.Add(C.Constant(1), C.Constant(2)))
+            ])])
+        lifter = Lifter()
+        traversed = []
+        generic_visit = lifter.generic_visit
+
+        def counting_generic_visit(node):
+            traversed.append(type(node).__name__)
+            return generic_visit(node)
+        lifter.generic_visit = counting_generic_visit
+        PassManager([ConstantFold(), lifter]).run(tree)
+        # the function holds nothing for Lifter
+        self.assertEqual(traversed, ["CFile"])
+
+    def test_no_interests(self):
+        counter = Counter()
+        PassManager([ConstantFold(), counter]).run(self._tree())
+        # a * 0 was folded
+        self.assertEqual(counter.symbols, 2)
+        self.assertGreater(counter.traversed, 1)
+
+    def test_timings(self):
+        manager = PassManager().add(ConstantFold()).add(Renamer()) \
+                               .add(Counter())
+        manager.run(self._tree())
+        self.assertEqual(list(manager.timings),
+                         ["ConstantFold", "Renamer", "fused traversal",
+                          "Counter"])
+        for elapsed in manager.timings.values():
+            self.assertGreaterEqual(elapsed, 0.0)
+
+    def test_invalidates_node_indexes(self):
+        tree = self._tree().index_nodes()
+        self.assertEqual(len(list(tree.find_all(C.BinaryOp))), 4)
+        tree = PassManager([ConstantFold()]).run(tree)
+        self.assertEqual(len(list(tree.find_all(C.BinaryOp))), 2)
@@ -3,6 +3,7 @@ import unittest
 from ctree.util import truncate
 from ctree.util import lower_case_underscore_to_camel_case
 from ctree.util import singleton
+from ctree.util import structural_hash
 
 
 class TestTruncate(unittest.TestCase):
@@ -60,3 +61,51 @@ class TestLowerCaseUnderscoreToCamelCase(unittest.TestCase):
             'ThisIsAName'
         )
 
+
+class TestStructuralHash(unittest.TestCase):
+    def test_equal_values(self):
+        self.assertEqual(structural_hash({'a': (1, 2.0), 'b': [None, 'x']}),
+                         structural_hash({'b': [None, 'x'], 'a': (1, 2.0)}))
+        self.assertEqual(structural_hash(frozenset([1, 2, 3])),
+                         structural_hash(frozenset([3, 2, 1])))
+
+    def test_distinct_values(self):
+        values = [1, 1.0, True, '1', (1,), [1], {1: 1}, None, 'None']
+        hashes = set(structural_hash(value) for value in values)
+        self.assertEqual(len(hashes), len(values))
+
+    def test_ctypes(self):
+        import ctypes
+        import numpy as np
+        ndpointer = np.ctypeslib.ndpointer
+        self.assertEqual(structural_hash(ndpointer(np.float64, 1, (12,))),
+                         structural_hash(ndpointer(np.float64, 1, (12,))))
+        self.assertNotEqual(structural_hash(ndpointer(np.float64, 1, (12,))),
+                            structural_hash(ndpointer(np.float64, 1, (13,))))
+        self.assertNotEqual(
+            structural_hash(ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int)),
+            structural_hash(ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_long)))
+        self.assertNotEqual(structural_hash(np.dtype(np.float32)),
+                            structural_hash(np.dtype(np.float64)))
+
+    def test_recursive_type(self):
+        import ctypes
+
+        class Node(ctypes.Structure):
+            pass
+        Node._fields_ = [('next', ctypes.POINTER(Node)), ('x', ctypes.c_int)]
+        self.assertEqual(structural_hash(Node), structural_hash(Node))
+
+    def test_stable_across_processes(self):
+        import os
+        import sys
+        import subprocess
+        code = ("import numpy as np; from ctree.util import structural_hash; "
+                "print(structural_hash({'ptr': np.ctypeslib.ndpointer("
+                "np.float64, 2, (3, 4)), 'names': frozenset(['a', 'b'])}))")
+        digests = set()
+        for seed in ('1', '2'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            digests.add(subprocess.check_output([sys.executable, '-c', code],
+                                                env=env).strip())
+        self.assertEqual(len(digests), 1)